@@ -0,0 +1,371 @@
+"""
+Transaction history tiering.
+
+``inventory_stocktransaction`` only needs recent movements: the reports
+read the rollups, and the ledger (see ledger.py) starts from snapshots.
+``archive_transactions`` (``manage.py archive_transactions``) moves whole
+calendar months older than HORIZON_DAYS out of it into a cold tier:
+
+* ``collection``: one ``inventory_stocktransaction_archive_YYYY_MM``
+  collection per month, with the history indexes;
+* ``file``: one zstd-compressed NDJSON file per month under ROOT
+  (``stocktransaction-YYYY-MM.ndjson.zst``, newest first, MongoDB
+  extended JSON), needing the zstandard package.
+
+Documents are copied in batches and only then deleted from the hot
+collection, so an interrupted run loses nothing and can simply be run
+again. Rollups are left in place. Before moving anything the job takes a
+ledger snapshot round, so the archived entries are behind a snapshot.
+
+``inventory_archive_state`` records which months went to which tier and
+``archived_until``, the start of the first month still entirely hot.
+``history`` pages through hot and cold transactions as one newest-first
+sequence and only reads the cold tiers when the requested window reaches
+back past ``archived_until``; ``cold_transactions`` does the same for the
+ledger's replays.
+
+Settings live in INVENTORY_ARCHIVE; see DEFAULTS.
+"""
+import io
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+from bson import json_util
+from django.conf import settings
+from django.utils import timezone
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import BulkWriteError
+
+from . import versions
+from .pagination import Page, decode_cursor, encode_cursor, keyset_page
+
+STATE = 'inventory_archive_state'
+HOT = versions.TRANSACTIONS
+TIERS = ('collection', 'file')
+
+DEFAULTS = {
+    # Months that ended more than this long ago are archived.
+    'HORIZON_DAYS': 365,
+    'TIER': 'collection',
+    # Directory of the file tier; default BASE_DIR / 'archive'.
+    'ROOT': None,
+    'COMPRESSION_LEVEL': 10,
+    'BATCH_SIZE': 1000,
+}
+
+# Newest first; the order of product_detail's history pages.
+HISTORY_SORT = [('transaction_date', DESCENDING), ('_id', DESCENDING)]
+
+ARCHIVE_INDEXES = [
+    IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+    IndexModel([('product_id', ASCENDING), ('transaction_date', DESCENDING),
+                ('_id', DESCENDING)],
+               name='product_history'),
+    IndexModel([('transaction_date', DESCENDING), ('_id', DESCENDING)], name='recent'),
+]
+
+DUPLICATE_KEY = 11000
+
+
+def archive_options():
+    """DEFAULTS overridden by settings.INVENTORY_ARCHIVE."""
+    options = dict(DEFAULTS, **getattr(settings, 'INVENTORY_ARCHIVE', {}))
+    options['ROOT'] = Path(options['ROOT'] or Path(settings.BASE_DIR) / 'archive')
+    return options
+
+
+def utc_naive(moment):
+    # Documents come back from pymongo as naive UTC datetimes.
+    if moment is not None and timezone.is_aware(moment):
+        return moment.astimezone(dt_timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def month_start(moment):
+    return utc_naive(moment).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+def month_key(month):
+    return f'{month:%Y-%m}'
+
+
+def collection_name(key):
+    return f'{HOT}_archive_{key.replace("-", "_")}'
+
+
+def file_path(key, root=None):
+    return Path(root or archive_options()['ROOT']) / f'stocktransaction-{key}.ndjson.zst'
+
+
+def archive_state(db):
+    """``{'archived_until': datetime or None, 'months': {'YYYY-MM': tier}}``."""
+    state = db[STATE].find_one({'_id': HOT}) or {}
+    return {'archived_until': state.get('archived_until'), 'months': state.get('months', {})}
+
+
+def archived_until(db):
+    """Start of the first month that is entirely hot, or None if nothing is archived."""
+    return archive_state(db)['archived_until']
+
+
+# File tier
+
+def _read_file(path):
+    import zstandard
+
+    with open(path, 'rb') as raw, zstandard.ZstdDecompressor().stream_reader(raw) as reader:
+        for line in io.TextIOWrapper(reader, encoding='utf-8'):
+            if line.strip():
+                yield json_util.loads(line)
+
+
+def _write_file(path, documents, level):
+    # Written to a temporary file and renamed, so readers never see half a month.
+    import zstandard
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            with zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=False) as out:
+                for document in documents:
+                    out.write(json_util.dumps(document).encode() + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _sort_key(document):
+    return document['transaction_date'], document['_id']
+
+
+# Archiving
+
+def _register(db, month, tier):
+    # Before anything is deleted, so readers already look in the cold tier.
+    db[STATE].update_one(
+        {'_id': HOT},
+        {'$set': {f'months.{month_key(month)}': tier, 'updated_at': timezone.now()},
+         '$max': {'archived_until': next_month(month)}},
+        upsert=True)
+
+
+def _insert_ignoring_duplicates(collection, documents):
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as exc:
+        if any(e['code'] != DUPLICATE_KEY for e in exc.details['writeErrors']):
+            raise
+
+
+def _archive_month(db, month, tier, options):
+    match = {'transaction_date': {'$gte': month, '$lt': next_month(month)}}
+    hot = db[HOT]
+    key = month_key(month)
+    # A month stays in the tier it was first archived to.
+    tier = archive_state(db)['months'].get(key, tier)
+    _register(db, month, tier)
+
+    moved = 0
+    if tier == 'collection':
+        target = db[collection_name(key)]
+        target.create_indexes(ARCHIVE_INDEXES)
+        while True:
+            documents = list(hot.find(match).limit(options['BATCH_SIZE']))
+            if not documents:
+                return moved
+            _insert_ignoring_duplicates(target, documents)
+            hot.delete_many({'_id': {'$in': [d['_id'] for d in documents]}})
+            moved += len(documents)
+
+    # One file per month: late arrivals are merged into it and it is rewritten.
+    path = file_path(key, options['ROOT'])
+    documents = list(hot.find(match))
+    if not documents:
+        return moved
+    merged = {d['_id']: d for d in (_read_file(path) if path.exists() else ())}
+    merged.update((d['_id'], d) for d in documents)
+    _write_file(path, sorted(merged.values(), key=_sort_key, reverse=True),
+                options['COMPRESSION_LEVEL'])
+    for start in range(0, len(documents), options['BATCH_SIZE']):
+        batch = documents[start:start + options['BATCH_SIZE']]
+        hot.delete_many({'_id': {'$in': [d['_id'] for d in batch]}})
+    return len(documents)
+
+
+def archive_transactions(db, horizon_days=None, tier=None, dry_run=False, progress=None):
+    """
+    Move transactions of the months that ended more than ``horizon_days``
+    ago to ``tier``. Returns ``{'YYYY-MM': transactions}``; with
+    ``dry_run`` only counts them.
+    """
+    from .ledger import take_snapshots
+
+    options = archive_options()
+    tier = tier or options['TIER']
+    if tier not in TIERS:
+        raise ValueError(f'Unknown archive tier "{tier}"')
+    horizon_days = options['HORIZON_DAYS'] if horizon_days is None else horizon_days
+    horizon = month_start(timezone.now() - timedelta(days=horizon_days))
+
+    oldest = db[HOT].find_one({'transaction_date': {'$lt': horizon}}, {'transaction_date': 1},
+                              sort=[('transaction_date', ASCENDING)])
+    if oldest is None:
+        return {}
+    if not dry_run:
+        take_snapshots(db)
+
+    moved = {}
+    month = month_start(oldest['transaction_date'])
+    while month < horizon:
+        if dry_run:
+            count = db[HOT].count_documents(
+                {'transaction_date': {'$gte': month, '$lt': next_month(month)}})
+        else:
+            count = _archive_month(db, month, tier, options)
+        if count:
+            moved[month_key(month)] = count
+            if progress:
+                progress(month_key(month), count)
+        month = next_month(month)
+    if moved and not dry_run:
+        versions.bump(db, versions.TRANSACTIONS)
+    return moved
+
+
+# Reading
+
+def _window(product_ids=None, transaction_type=None, since=None, until=None):
+    """A Mongo query and the equivalent predicate for file-tier documents."""
+    since, until = utc_naive(since), utc_naive(until)
+    query = {}
+    if product_ids is not None:
+        product_ids = set(product_ids)
+        query['product_id'] = {'$in': sorted(product_ids)}
+    if transaction_type:
+        query['transaction_type'] = transaction_type
+    if since or until:
+        query['transaction_date'] = {k: v for k, v in (('$gte', since), ('$lt', until)) if v}
+
+    def matches(document):
+        date = document.get('transaction_date')
+        return ((product_ids is None or document.get('product_id') in product_ids)
+                and (not transaction_type or document.get('transaction_type') == transaction_type)
+                and (since is None or date >= since) and (until is None or date < until))
+    return query, matches
+
+
+def cold_months(db, since=None, until=None):
+    """``(month, tier)`` of the archived months overlapping [since, until), newest first."""
+    since, until = utc_naive(since), utc_naive(until)
+    months = []
+    for key, tier in archive_state(db)['months'].items():
+        month = datetime.strptime(key, '%Y-%m')
+        if (since is None or next_month(month) > since) and (until is None or month < until):
+            months.append((month, tier))
+    return sorted(months, reverse=True)
+
+
+def _not_hot(db, documents):
+    # While a month is being moved its documents are in both tiers.
+    ids = [d['id'] for d in documents if d.get('id')]
+    hot = set(db[HOT].distinct('id', {'id': {'$in': ids}})) if ids else set()
+    return [d for d in documents if d.get('id') not in hot]
+
+
+def cold_transactions(db, product_ids=None, since=None, until=None, batch_size=None):
+    """
+    Archived transactions of ``product_ids`` dated in [since, until), month
+    by month, newest month first. Reads nothing when the window is
+    entirely after ``archived_until``.
+    """
+    batch_size = batch_size or archive_options()['BATCH_SIZE']
+    query, matches = _window(product_ids, since=since, until=until)
+    for month, tier in cold_months(db, since, until):
+        key = month_key(month)
+        if tier == 'collection':
+            documents = db[collection_name(key)].find(query, batch_size=batch_size)
+        elif file_path(key).exists():
+            documents = filter(matches, _read_file(file_path(key)))
+        else:
+            continue
+        batch = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                yield from _not_hot(db, batch)
+                batch = []
+        yield from _not_hot(db, batch)
+
+
+def _project(document, projection):
+    if not projection:
+        return document
+    return {k: v for k, v in document.items() if k == '_id' or k in projection}
+
+
+def _cold_page(db, query, matches, since, until, limit, cursor, projection):
+    """Up to ``limit`` archived documents after ``cursor``, in HISTORY_SORT order."""
+    position = None
+    if cursor:
+        values = decode_cursor(cursor)
+        position = (values[0], values[1])
+        # Months after the cursor hold nothing for this page.
+        newest = position[0] + timedelta(microseconds=1)
+        until = min(until, newest) if until else newest
+    items = []
+    for month, tier in cold_months(db, since, until):
+        key = month_key(month)
+        needed = limit - len(items)
+        if tier == 'collection':
+            items.extend(keyset_page(db[collection_name(key)], query, HISTORY_SORT, needed,
+                                     cursor, projection).items)
+        elif file_path(key).exists():
+            for document in _read_file(file_path(key)):
+                if matches(document) and (position is None or _sort_key(document) < position):
+                    items.append(_project(document, projection))
+                    if len(items) >= limit:
+                        break
+        if len(items) >= limit:
+            break
+    return items
+
+
+def history(db, product_id=None, transaction_type=None, since=None, until=None, page_size=50,
+            cursor=None, projection=None):
+    """
+    One page of transactions, newest first, across the hot collection and
+    the archive; ``cursor`` is the previous page's ``next_cursor``. The
+    cold tiers are only read when the page reaches back past
+    ``archived_until``. Raises InvalidCursor for a bad cursor.
+    """
+    query, matches = _window(None if product_id is None else [product_id], transaction_type,
+                             since, until)
+    hot = keyset_page(db[HOT], query, HISTORY_SORT, page_size, cursor, projection)
+
+    boundary = archived_until(db)
+    if boundary is None or (since is not None and utc_naive(since) >= boundary):
+        return hot
+    if hot.next_cursor and hot.items[-1]['transaction_date'] >= boundary:
+        # The whole page is newer than anything archived.
+        return hot
+
+    cold = _cold_page(db, query, matches, utc_naive(since), utc_naive(until), page_size + 1, cursor,
+                      projection)
+    merged = {d['_id']: d for d in cold}
+    merged.update((d['_id'], d) for d in hot.items)
+    items = sorted(merged.values(), key=_sort_key, reverse=True)
+    more = hot.next_cursor is not None or len(items) > page_size
+    items = items[:page_size]
+    return Page(items, encode_cursor([items[-1].get(f) for f, _ in HISTORY_SORT])
+                if more and items else None)
@@ -0,0 +1,166 @@
+"""
+Async versions of the read-heavy views, for deployments served over ASGI.
+
+They build the same context as their counterparts in views.py but query
+MongoDB through Motor and run independent queries concurrently with
+``asyncio.gather``. Anything that still needs the synchronous stack
+(session-backed auth, cached lookups, search, rendering with context
+processors) goes through ``sync_to_async``.
+
+urls.py routes to these instead of the sync views when
+INVENTORY_ASYNC_VIEWS is set.
+"""
+import asyncio
+import functools
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.shortcuts import render
+
+from . import exports, lookups, repository, rollups, versions
+from .lowstock import LOW_STOCK_PROJECTION
+from .mongo import db, get_async_db
+from .pagination import (InvalidCursor, Page, jsonable, keyset_page_async, next_page_url,
+                         page_size_from)
+from .responsecache import versioned_page
+from .search import search_products
+from .summary import SUMMARY_ID, rebuild_summary
+from .views import (DASHBOARD_LOW_STOCK_LIMIT, PRODUCT_LIST_FIELDS, PRODUCT_LIST_SORT,
+                    REFERENCE_FIELDS, REPORT_LOW_STOCK_QUERY, REPORT_LOW_STOCK_SORT,
+                    TOP_SELLING_FIELDS, _dashboard_context, _product_list_query,
+                    _report_window, _stock_report_context)
+
+async_render = sync_to_async(render)
+
+
+def async_login_required(view):
+    # login_required only wraps sync views, and request.user hits the
+    # session store, so resolve it in a thread.
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if not is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+async def _summary(adb):
+    stats = await adb.inventory_summary.find_one({'_id': SUMMARY_ID})
+    if stats is None:
+        stats = await sync_to_async(rebuild_summary)(db)
+    return stats
+
+
+@async_login_required
+async def dashboard(request):
+    adb = get_async_db()
+    stats, low_stock, recent_transactions, recent_suppliers = await asyncio.gather(
+        _summary(adb),
+        adb.inventory_product.find(
+            {'active': True, 'is_low_stock': True}, LOW_STOCK_PROJECTION
+        ).sort([('stock_deficit', -1), ('id', 1)]).to_list(DASHBOARD_LOW_STOCK_LIMIT),
+        adb.inventory_stocktransaction.find().sort('transaction_date', -1).to_list(5),
+        adb.inventory_supplier.find(
+            {}, {'id': 1, 'name': 1, 'email': 1}).sort('created_at', -1).to_list(5),
+    )
+    context = _dashboard_context(stats, low_stock, recent_transactions, recent_suppliers)
+    return await async_render(request, 'inventory/dashboard.html', context)
+
+
+@async_login_required
+@versioned_page(versions.PRODUCTS, versions.CATEGORIES, versions.SUPPLIERS)
+async def product_list(request):
+    adb = get_async_db()
+    query = _product_list_query(request)
+    search_query = request.GET.get('search')
+    page_size = page_size_from(request)
+
+    # The category list usually comes from the in-process cache, so it is
+    # fetched alongside the page rather than after it.
+    if search_query:
+        page_task = sync_to_async(search_products, thread_sensitive=False)(
+            db, search_query, query, limit=page_size, projection=PRODUCT_LIST_FIELDS)
+    else:
+        page_task = keyset_page_async(
+            adb.inventory_product, query, sort=PRODUCT_LIST_SORT, page_size=page_size,
+            cursor=request.GET.get('cursor'), projection=PRODUCT_LIST_FIELDS)
+    categories_task = sync_to_async(lookups.categories, thread_sensitive=False)(db)
+    try:
+        page, categories = await asyncio.gather(page_task, categories_task)
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid cursor')
+    if search_query:
+        page = Page(page, None)
+    products = page.items
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'results': [jsonable(p) for p in products],
+            'next_cursor': page.next_cursor,
+        })
+
+    await repository.attach_async(adb, products, 'category_id', 'supplier_id',
+                                  projection=REFERENCE_FIELDS)
+
+    return await async_render(request, 'inventory/product_list.html', {
+        'products': products,
+        'categories': categories,
+        'next_cursor': page.next_cursor,
+        'next_url': next_page_url(request, page.next_cursor),
+    })
+
+
+@async_login_required
+@versioned_page(versions.PRODUCTS, versions.CATEGORIES, versions.SUPPLIERS,
+                versions.ROLLUPS, period=3600)
+async def stock_report(request):
+    export = request.GET.get('export')
+    if export:
+        if export not in exports.FORMATS:
+            return HttpResponseBadRequest('Unknown export format')
+        return await sync_to_async(exports.export_stock_report)(db, export)
+
+    window = _report_window(request)
+    if window is None:
+        return HttpResponseBadRequest('Invalid report window')
+    since, until, window_label = window
+
+    adb = get_async_db()
+    products, low_stock, top_selling = await asyncio.gather(
+        adb.inventory_product.find({'active': True}).to_list(None),
+        adb.inventory_product.find(REPORT_LOW_STOCK_QUERY).sort(
+            REPORT_LOW_STOCK_SORT).to_list(None),
+        adb[rollups.COLLECTION].aggregate(
+            rollups.top_products_pipeline(since, until, 'OUT', limit=5)).to_list(None),
+    )
+    top_products, _ = await asyncio.gather(
+        adb.inventory_product.find({'id': {'$in': [row['_id'] for row in top_selling]}},
+                                   TOP_SELLING_FIELDS).to_list(None),
+        repository.attach_async(adb, products + low_stock, 'category_id', 'supplier_id',
+                                projection=REFERENCE_FIELDS),
+    )
+
+    context = _stock_report_context(products, low_stock, top_selling, top_products,
+                                    window_label)
+    return await async_render(request, 'inventory/stock_report.html', context)
+
+
+@async_login_required
+async def supplier_detail(request, pk):
+    adb = get_async_db()
+    supplier, products = await asyncio.gather(
+        adb.inventory_supplier.find_one({'id': pk, 'active': True}),
+        adb.inventory_product.find({'supplier_id': pk, 'active': True}).to_list(None),
+    )
+    if not supplier:
+        raise Http404("Supplier not found")
+
+    context = {
+        'supplier': supplier,
+        'products': products,
+        'total_products': len(products),
+        'total_value': sum(float(p.get('price', 0)) * p.get('stock_quantity', 0) for p in products)
+    }
+    return await async_render(request, 'inventory/supplier_detail.html', context)
@@ -0,0 +1,324 @@
+"""
+Helpers for the benchmark management commands.
+
+Benchmarks run against a scratch database on the configured server so
+they never touch real inventory data.
+``mongomock_client`` stands in for the server where there is none.
+"""
+import math
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import (DeleteMany, DeleteOne, InsertOne, MongoClient, ReplaceOne, UpdateOne,
+                     monitoring)
+from pymongo.errors import BulkWriteError, OperationFailure
+from pymongo.results import BulkWriteResult
+
+from .mongo import client_options, database_name
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts commands (round trips) sent through a client."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+    def started(self, event):
+        with self._lock:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def bench_database(suffix='bench'):
+    """Return ``(client, db, counter)`` for a scratch database."""
+    counter = CommandCounter()
+    client = MongoClient(event_listeners=[counter], **client_options())
+    return client, client[f'{database_name()}_{suffix}'], counter
+
+
+def _per_op_bulk_write(self, requests, ordered=True, **kwargs):
+    # bulk_write as one call per operation. mongomock 4.3 builds its bulk
+    # from pymongo's operation objects, whose newer signatures it rejects.
+    counts = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0}
+    upserted, errors = [], []
+    for index, op in enumerate(requests):
+        try:
+            if isinstance(op, InsertOne):
+                self.insert_one(op._doc)
+                counts['nInserted'] += 1
+            elif isinstance(op, (DeleteOne, DeleteMany)):
+                delete = self.delete_one if isinstance(op, DeleteOne) else self.delete_many
+                counts['nRemoved'] += delete(op._filter).deleted_count
+            else:
+                if isinstance(op, ReplaceOne):
+                    result = self.replace_one(op._filter, op._doc, upsert=bool(op._upsert))
+                else:
+                    update = self.update_one if isinstance(op, UpdateOne) else self.update_many
+                    extra = {'array_filters': op._array_filters} if op._array_filters else {}
+                    result = update(op._filter, op._doc, upsert=bool(op._upsert), **extra)
+                counts['nMatched'] += result.matched_count
+                counts['nModified'] += result.modified_count
+                if result.upserted_id is not None:
+                    counts['nUpserted'] += 1
+                    upserted.append({'index': index, '_id': result.upserted_id})
+        except OperationFailure as exc:
+            errors.append({'index': index, 'code': exc.code, 'errmsg': str(exc),
+                           'op': getattr(op, '_doc', None) or op._filter})
+            if ordered:
+                break
+    details = dict(counts, upserted=upserted, writeErrors=errors, writeConcernErrors=[])
+    if errors:
+        raise BulkWriteError(details)
+    return BulkWriteResult(details, True)
+
+
+def _parse_nested(parse):
+    # mongomock only evaluates an expression at the top of a field; the
+    # outbox entries built by stock.movement_update are documents and
+    # arrays with expressions inside.
+    def nested(parser, expression):
+        if isinstance(expression, list):
+            return [nested(parser, e) for e in expression]
+        if isinstance(expression, dict) and expression and not any(
+                key.startswith('$') for key in expression):
+            return {key: nested(parser, value) for key, value in expression.items()}
+        return parse(parser, expression)
+    nested.inventory_patched = True
+    return nested
+
+
+def mongomock_client():
+    """
+    An in-memory mongomock client, for ``bench_views --mongomock`` and the
+    tests, with bulk_write and nested pipeline expressions made to work as
+    the app uses them. Raises ImportError without mongomock.
+    """
+    import mongomock
+    from mongomock import aggregate
+
+    mongomock.Collection.bulk_write = _per_op_bulk_write
+    if not getattr(aggregate._Parser.parse, 'inventory_patched', False):
+        aggregate._Parser.parse = _parse_nested(aggregate._Parser.parse)
+    return mongomock.MongoClient()
+
+
+def measure(fn, counter=None, repeat=5):
+    """
+    Run ``fn`` ``repeat`` times and return the median latency in
+    milliseconds and the number of round trips made by one call.
+    """
+    timings = []
+    trips = 0
+    for _ in range(repeat):
+        if counter is not None:
+            counter.reset()
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+        if counter is not None:
+            trips = counter.count
+    return statistics.median(timings), trips
+
+
+def storage_stats(collection):
+    """Document count, data, storage and index bytes of ``collection``."""
+    stats = next(collection.aggregate([{'$collStats': {'storageStats': {}}}]), {})
+    storage = stats.get('storageStats', {})
+    return {key: storage.get(key, 0)
+            for key in ('count', 'size', 'storageSize', 'totalIndexSize')}
+
+
+def percentiles(timings, points=(50, 95, 99)):
+    """Nearest-rank percentiles of ``timings`` as ``{point: value}``."""
+    ordered = sorted(timings)
+    if not ordered:
+        return {point: None for point in points}
+    return {point: ordered[max(math.ceil(point / 100 * len(ordered)) - 1, 0)]
+            for point in points}
+
+
+def login_cookie(username):
+    """A session cookie header value logged in as ``username``."""
+    from importlib import import_module
+
+    from django.conf import settings
+    from django.contrib.auth import (BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY,
+                                     get_user_model)
+
+    user = get_user_model().objects.get(username=username)
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+
+
+def http_load(urls, total, concurrency, headers=None, timeout=30):
+    """
+    Request ``urls`` round-robin ``total`` times from ``concurrency``
+    threads. Entries are URLs to GET or ``(url, data)`` pairs to POST as a
+    form, with a made-up CSRF token sent as both cookie and header.
+    Returns ``(timings_ms, errors, elapsed_seconds)``.
+    """
+    from django.conf import settings
+    from django.utils.crypto import get_random_string
+
+    csrf_token = get_random_string(64)
+    post_headers = dict(headers or {}, **{'X-CSRFToken': csrf_token})
+    cookie = f'{settings.CSRF_COOKIE_NAME}={csrf_token}'
+    post_headers['Cookie'] = f'{post_headers["Cookie"]}; {cookie}' if 'Cookie' in post_headers \
+        else cookie
+
+    def fetch(n):
+        entry = urls[n % len(urls)]
+        if isinstance(entry, tuple):
+            url, data = entry
+            request = urllib.request.Request(url, urllib.parse.urlencode(data).encode(),
+                                             headers=post_headers)
+        else:
+            request = urllib.request.Request(entry, headers=headers or {})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                response.read()
+                ok = response.status == 200
+        except (urllib.error.URLError, OSError):
+            ok = False
+        return (time.perf_counter() - start) * 1000, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fetch, range(total)))
+    elapsed = time.perf_counter() - start
+    return [ms for ms, _ in results], sum(1 for _, ok in results if not ok), elapsed
+
+
+BENCH_USER_BACKEND = 'inventory.bench.BenchUserBackend'
+
+
+def bench_user():
+    """An unsaved staff user, so in-process runs need no auth database."""
+    from django.contrib.auth import get_user_model
+
+    return get_user_model()(pk=0, username='bench', is_staff=True, is_active=True)
+
+
+class BenchUserBackend:
+    """Resolves the session of ``bench_session_cookie`` to ``bench_user``."""
+
+    def authenticate(self, request, **credentials):
+        return None
+
+    def get_user(self, user_id):
+        return bench_user() if user_id == 0 else None
+
+
+def bench_settings():
+    """
+    Settings overrides for in-process runs: signed-cookie sessions and the
+    bench user backend, so requests never touch the auth or session tables.
+    """
+    from django.conf import settings
+
+    return {
+        'SESSION_ENGINE': 'django.contrib.sessions.backends.signed_cookies',
+        'AUTHENTICATION_BACKENDS': [BENCH_USER_BACKEND, *settings.AUTHENTICATION_BACKENDS],
+    }
+
+
+def bench_session_cookie():
+    """The session cookie value logging in as bench_user (under bench_settings)."""
+    from importlib import import_module
+
+    from django.conf import settings
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+
+    user = bench_user()
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = BENCH_USER_BACKEND
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return session.session_key
+
+
+def client_load(requests, total, concurrency, session_cookie):
+    """
+    The in-process counterpart of http_load: run ``requests`` (paths to GET
+    or ``(path, data)`` pairs to POST) through the Django test client, one
+    client per thread. Returns ``(timings_ms, errors, elapsed_seconds,
+    commands)`` where ``commands`` lists the Mongo commands per request as
+    counted by the profiling middleware (empty if it is disabled).
+    """
+    from django.conf import settings
+    from django.test import Client
+
+    local = threading.local()
+
+    def fetch(n):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = Client(raise_request_exception=False)
+            client.cookies[settings.SESSION_COOKIE_NAME] = session_cookie
+        entry = requests[n % len(requests)]
+        start = time.perf_counter()
+        if isinstance(entry, tuple):
+            response = client.post(*entry)
+            ok = response.status_code in (200, 302)
+        else:
+            response = client.get(entry)
+            ok = response.status_code == 200
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        profile = getattr(response.wsgi_request, 'mongo_profile', None)
+        return elapsed_ms, ok, profile.commands if profile is not None else None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(fetch, range(total)))
+    elapsed = time.perf_counter() - start
+    return ([ms for ms, _, _ in results], sum(1 for _, ok, _ in results if not ok), elapsed,
+            [c for _, _, c in results if c is not None])
+
+
+def compare_runs(baseline, current, threshold=0.2):
+    """
+    Regressions of ``current`` against ``baseline``, two lists of result
+    rows as written by bench_views. Rows are matched on mode, scale,
+    endpoint and concurrency; a row regresses when its p95 latency grows or
+    its throughput drops by more than ``threshold``, or when it makes more
+    Mongo commands per request. Returns ``(row, metric, old, new)`` tuples.
+    """
+    def key(row):
+        return row['mode'], row['scale'], row['endpoint'], row['concurrency']
+
+    previous = {key(row): row for row in baseline}
+    regressions = []
+    for row in current:
+        old = previous.get(key(row))
+        if old is None:
+            continue
+        if old.get('p95') and row.get('p95') and row['p95'] > old['p95'] * (1 + threshold):
+            regressions.append((row, 'p95', old['p95'], row['p95']))
+        if old.get('rps') and row.get('rps') is not None and \
+                row['rps'] < old['rps'] * (1 - threshold):
+            regressions.append((row, 'rps', old['rps'], row['rps']))
+        if old.get('commands') is not None and row.get('commands') is not None and \
+                row['commands'] > old['commands']:
+            regressions.append((row, 'commands', old['commands'], row['commands']))
+    return regressions
@@ -0,0 +1,142 @@
+"""
+Two-tier read-through cache.
+
+The first tier is an in-process LRU with a TTL. The optional second tier is
+any Django cache alias (locmem, file-based, Redis, ...) shared between
+processes. A miss in both tiers calls the loader and fills both.
+
+Invalidation clears the local tier of the current process and the shared
+tier. Other processes' local entries would only expire after LOCAL_TTL, so
+callers that can read a version of the data (see versions.py) pass it to
+``get_or_load``: entries are stored with the version they were loaded at
+and one cached for any other version is reloaded, in every process.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize=256, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _current(entry, version):
+    # Entries are (version, value) pairs.
+    return isinstance(entry, tuple) and len(entry) == 2 and entry[0] == version
+
+
+class TieredCache:
+    def __init__(self, prefix, local_maxsize=256, local_ttl=60, shared_alias=None, shared_ttl=300):
+        self.prefix = prefix
+        self.local = LRUCache(local_maxsize, local_ttl)
+        self.shared_alias = shared_alias
+        self.shared_ttl = shared_ttl
+        self._lock = threading.Lock()
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @property
+    def shared(self):
+        return caches[self.shared_alias] if self.shared_alias else None
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def get_or_load(self, key, loader, version=None):
+        """
+        The cached value of ``key``, else ``loader()``. With ``version``,
+        read before loading, only a value loaded at that version is used.
+        """
+        entry = self.local.get(key, _MISSING)
+        if _current(entry, version):
+            self._count('local_hits')
+            return entry[1]
+
+        shared = self.shared
+        if shared is not None:
+            entry = shared.get(self._key(key), _MISSING)
+            if _current(entry, version):
+                self._count('shared_hits')
+                self.local.set(key, entry)
+                return entry[1]
+
+        self._count('misses')
+        entry = (version, loader())
+        self.local.set(key, entry)
+        if shared is not None:
+            shared.set(self._key(key), entry, self.shared_ttl)
+        return entry[1]
+
+    def invalidate(self, *keys):
+        shared = self.shared
+        for key in keys:
+            self.local.delete(key)
+            if shared is not None:
+                shared.delete(self._key(key))
+        self._count('invalidations')
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_ratio'] = round((lookups - stats['misses']) / lookups, 3) if lookups else None
+        stats['local_size'] = len(self.local)
+        stats['shared_alias'] = self.shared_alias
+        return stats
+
+
+def tiered_cache(prefix):
+    """A TieredCache configured from settings.INVENTORY_CACHE."""
+    conf = getattr(settings, 'INVENTORY_CACHE', {})
+    return TieredCache(
+        prefix,
+        local_maxsize=conf.get('LOCAL_MAXSIZE', 256),
+        local_ttl=conf.get('LOCAL_TTL', 60),
+        shared_alias=conf.get('SHARED_ALIAS'),
+        shared_ttl=conf.get('SHARED_TTL', 300),
+    )
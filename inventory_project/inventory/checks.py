@@ -0,0 +1,49 @@
+from django.core.checks import Tags, Warning, register
+from pymongo.errors import PyMongoError
+
+from .indexes import collection_scans, diff_indexes
+from .mongo import get_db
+from .timeseries import configured_layout, layout
+
+
+@register(Tags.database)
+def check_mongo_indexes(app_configs, databases=None, **kwargs):
+    """
+    Warn about missing declared indexes, hot queries that would be
+    answered by a collection scan and a transactions layout other than the
+    configured one. Runs with ``manage.py check --database
+    default`` and before ``migrate``, so a deploy surfaces it at startup.
+    """
+    if not databases:
+        return []
+
+    errors = []
+    try:
+        db = get_db()
+        for collection, name, status in diff_indexes(db):
+            if status in ('missing', 'changed'):
+                errors.append(Warning(
+                    f'Index {collection}.{name} is {status}.',
+                    hint=f'Run "manage.py ensure_indexes'
+                         f'{" --rebuild" if status == "changed" else ""}".',
+                    id='inventory.W001',
+                ))
+        for collection, query, sort in collection_scans(db):
+            errors.append(Warning(
+                f'Query {query} on {collection} (sort {sort}) uses a collection scan.',
+                hint='Run "manage.py ensure_indexes" or add an index to inventory.indexes.INDEXES.',
+                id='inventory.W002',
+            ))
+        if layout(db) != configured_layout():
+            errors.append(Warning(
+                f'inventory_stocktransaction is {layout(db)}, INVENTORY_TIMESERIES '
+                f'asks for {configured_layout()}.',
+                hint=f'Run "manage.py convert_transactions --to {configured_layout()}".',
+                id='inventory.W004',
+            ))
+    except PyMongoError as exc:
+        errors.append(Warning(
+            f'Could not verify MongoDB indexes: {exc}',
+            id='inventory.W003',
+        ))
+    return errors
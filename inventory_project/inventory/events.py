@@ -0,0 +1,295 @@
+"""
+Change-stream event bus.
+
+``EventBus`` tails one change stream over the watched inventory collections
+and hands the changes, in batches, to the subscribers registered with
+``subscribe`` (see subscribers.py for the built-in ones: cache
+invalidation, rollups, derived product fields and reference names). Run it
+with ``manage.py run_event_bus``, one process per consumer name.
+
+* A reader thread pulls changes into a bounded queue. When subscribers fall
+  behind the queue fills up and the reader stops pulling, so the backlog
+  waits in the oplog instead of in memory.
+* The dispatcher takes up to BATCH_SIZE changes, or what arrived within
+  MAX_WAIT seconds, and calls each subscriber once with the changes it
+  asked for. A failing subscriber is retried with backoff; after RETRIES
+  the bus stops.
+* After every subscriber has handled a batch, the resume token of its last
+  change is saved in ``inventory_event_offsets``, and a restarted bus
+  resumes from there. Delivery is therefore at least once: subscribers
+  must be idempotent, and must only write when something is stale so that
+  their own writes to watched collections settle after one more event.
+* If the token has fallen off the oplog, the bus starts from the present
+  and calls each subscriber's ``resync`` to rebuild what it missed.
+
+Change streams need a replica set. A single local node is enough:
+
+    mongod --replSet rs0 --dbpath /tmp/rs0 && mongosh --eval 'rs.initiate()'
+    MONGO_REPLICA_SET=rs0 python manage.py run_event_bus
+
+Settings live in INVENTORY_EVENTS; see DEFAULTS.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+from pymongo.errors import OperationFailure
+
+from . import versions
+
+logger = logging.getLogger('inventory.events')
+
+OFFSETS = 'inventory_event_offsets'
+
+WATCHED = (versions.PRODUCTS, versions.TRANSACTIONS, versions.CATEGORIES, versions.SUPPLIERS)
+OPERATIONS = ('insert', 'update', 'replace', 'delete')
+
+DEFAULTS = {
+    # Subscriber names to run; None for all registered subscribers.
+    'SUBSCRIBERS': None,
+    'BATCH_SIZE': 500,
+    'MAX_WAIT': 0.5,
+    'QUEUE_SIZE': 5000,
+    'RETRIES': 5,
+    'STATS_INTERVAL': 60,
+}
+
+# The resume token can no longer be used: InvalidResumeToken,
+# ChangeStreamFatalError, ChangeStreamHistoryLost.
+LOST_TOKEN_CODES = (260, 280, 286)
+
+
+def event_options():
+    """DEFAULTS overridden by settings.INVENTORY_EVENTS."""
+    return dict(DEFAULTS, **getattr(settings, 'INVENTORY_EVENTS', {}))
+
+
+@dataclass
+class Subscriber:
+    name: str
+    collections: Tuple[str, ...]
+    operations: Tuple[str, ...]
+    handle: Callable
+    resync: Optional[Callable] = None
+
+    def wants(self, change):
+        return (change['ns']['coll'] in self.collections
+                and change['operationType'] in self.operations)
+
+
+SUBSCRIBERS = {}
+
+
+def subscribe(*collections, operations=OPERATIONS, name=None, resync=None):
+    """
+    Register ``handle(db, changes)`` for changes to ``collections``. It is
+    called with a list of change documents (with ``fullDocument`` looked up
+    for updates) in oplog order. ``resync(db)``, if given, is called instead
+    for changes that were lost.
+    """
+    def register(handle):
+        key = name or handle.__name__
+        SUBSCRIBERS[key] = Subscriber(key, tuple(collections), tuple(operations), handle, resync)
+        return handle
+    return register
+
+
+def registered(names=None):
+    """The registered subscribers, or those named in ``names``."""
+    from . import subscribers  # noqa: F401  (registers the built-in ones)
+
+    if names is None:
+        return list(SUBSCRIBERS.values())
+    unknown = set(names) - set(SUBSCRIBERS)
+    if unknown:
+        raise KeyError(f'Unknown subscribers: {", ".join(sorted(unknown))}')
+    return [SUBSCRIBERS[name] for name in names]
+
+
+def load_token(db, consumer):
+    offset = db[OFFSETS].find_one({'_id': consumer})
+    return offset.get('token') if offset else None
+
+
+def save_token(db, consumer, token, events=0):
+    db[OFFSETS].update_one(
+        {'_id': consumer},
+        {'$set': {'token': token, 'updated_at': timezone.now()}, '$inc': {'events': events}},
+        upsert=True)
+
+
+# Queue items are (kind, payload) pairs.
+_CHANGE, _CHECKPOINT, _RESYNC = 'change', 'checkpoint', 'resync'
+
+
+class EventBus:
+    """Tails the watched collections for one consumer; see the module docstring."""
+
+    def __init__(self, db, subscribers, consumer='default', options=None):
+        self.db = db
+        self.subscribers = subscribers
+        self.consumer = consumer
+        self.options = dict(event_options(), **(options or {}))
+        self.collections = sorted({c for s in subscribers for c in s.collections})
+        self._queue = queue.Queue(maxsize=self.options['QUEUE_SIZE'])
+        self._stop = threading.Event()
+        self._error = None
+        self._last_change = time.monotonic()
+        self.stats = {'events': 0, 'batches': 0, 'lag_seconds': None,
+                      'reader_blocked_seconds': 0, 'retries': 0, 'resyncs': 0}
+
+    def pipeline(self):
+        operations = sorted({o for s in self.subscribers for o in s.operations})
+        return [{'$match': {'ns.coll': {'$in': self.collections},
+                            'operationType': {'$in': operations}}}]
+
+    def stop(self):
+        self._stop.set()
+
+    # Reader thread
+
+    def _put(self, item):
+        """Blocking put that gives up when the bus stops: the back-pressure point."""
+        started = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        self.stats['reader_blocked_seconds'] += time.monotonic() - started
+
+    def _read(self):
+        token = load_token(self.db, self.consumer)
+        try:
+            while not self._stop.is_set():
+                try:
+                    with self.db.watch(self.pipeline(), full_document='updateLookup',
+                                       resume_after=token, max_await_time_ms=500,
+                                       batch_size=self.options['BATCH_SIZE']) as stream:
+                        checkpoint = token
+                        while not self._stop.is_set():
+                            change = stream.try_next()
+                            if change is not None:
+                                self._put((_CHANGE, change))
+                                token = checkpoint = change['_id']
+                            elif stream.resume_token and stream.resume_token != checkpoint:
+                                # Idle: the token still advances, so a restart
+                                # need not rescan the oplog we have passed.
+                                checkpoint = stream.resume_token
+                                self._put((_CHECKPOINT, checkpoint))
+                except OperationFailure as exc:
+                    if token is None or exc.code not in LOST_TOKEN_CODES:
+                        raise
+                    logger.warning('resume token of %s is no longer usable (%s); '
+                                   'resyncing and starting from now', self.consumer, exc)
+                    token = None
+                    self._put((_RESYNC, None))
+        except BaseException as exc:
+            self._error = exc
+            self._stop.set()
+
+    # Dispatcher
+
+    def _next_batch(self):
+        """Up to BATCH_SIZE items, waiting at most MAX_WAIT after the first."""
+        try:
+            items = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.options['MAX_WAIT']
+        while len(items) < self.options['BATCH_SIZE'] and items[-1][0] != _RESYNC:
+            remaining = deadline - time.monotonic()
+            try:
+                items.append(self._queue.get(timeout=max(remaining, 0)) if remaining > 0
+                             else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _call(self, subscriber, method, *args):
+        attempt = 0
+        while True:
+            try:
+                return method(self.db, *args)
+            except Exception:
+                attempt += 1
+                if attempt > self.options['RETRIES']:
+                    raise
+                self.stats['retries'] += 1
+                delay = min(2 ** attempt * 0.1, 10)
+                logger.exception('subscriber %s failed, retrying in %.1fs', subscriber.name,
+                                 delay)
+                time.sleep(delay)
+
+    def dispatch(self, changes):
+        """Hand a batch of changes to every subscriber that wants some of them."""
+        for subscriber in self.subscribers:
+            wanted = [c for c in changes if subscriber.wants(c)]
+            if wanted:
+                self._call(subscriber, subscriber.handle, wanted)
+
+    def resync(self):
+        self.stats['resyncs'] += 1
+        for subscriber in self.subscribers:
+            if subscriber.resync is not None:
+                self._call(subscriber, subscriber.resync)
+
+    def _process(self, items):
+        changes = []
+        token = None
+        for kind, payload in items:
+            if kind == _RESYNC:
+                self.resync()
+            elif kind == _CHANGE:
+                changes.append(payload)
+                token = payload['_id']
+            else:
+                token = payload
+        if changes:
+            self.dispatch(changes)
+            self.stats['events'] += len(changes)
+            self.stats['batches'] += 1
+            self._last_change = time.monotonic()
+            cluster_time = changes[-1].get('clusterTime')
+            if cluster_time is not None:
+                self.stats['lag_seconds'] = max(0, round(time.time() - cluster_time.time, 1))
+        if token is not None:
+            save_token(self.db, self.consumer, token, len(changes))
+
+    def run(self, until_idle=None):
+        """
+        Tail and dispatch until ``stop()`` is called, or no change has
+        arrived for ``until_idle`` seconds. Re-raises a reader or
+        subscriber failure; the saved token makes a restart safe.
+        """
+        reader = threading.Thread(target=self._read, name=f'inventory-events-{self.consumer}',
+                                  daemon=True)
+        reader.start()
+        logger.info('consumer %s watching %s for %s', self.consumer,
+                    ', '.join(self.collections), ', '.join(s.name for s in self.subscribers))
+        last_stats = time.monotonic()
+        try:
+            while not self._stop.is_set() or not self._queue.empty():
+                if self._error is not None:
+                    break
+                self._process(self._next_batch())
+                now = time.monotonic()
+                if now - last_stats >= self.options['STATS_INTERVAL']:
+                    last_stats = now
+                    logger.info(json.dumps({'consumer': self.consumer,
+                                            'queued': self._queue.qsize(), **self.stats}))
+                if until_idle is not None and now - self._last_change >= until_idle:
+                    break
+        finally:
+            self._stop.set()
+            reader.join(timeout=5)
+        if self._error is not None:
+            raise self._error
+        return self.stats
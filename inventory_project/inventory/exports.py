@@ -0,0 +1,149 @@
+"""
+Streaming exports of the stock report.
+
+Rows come straight off the product cursor in batches and are written
+out as they arrive, so memory stays flat regardless of catalogue size and
+CSV/NDJSON downloads start before the query has finished. XLSX is built
+with openpyxl's write-only workbook in a temporary file (the format is a
+zip archive and cannot be emitted incrementally) and then streamed.
+"""
+import csv
+import io
+import json
+import tempfile
+
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from . import repository
+
+COLUMNS = [
+    ('name', 'Product'),
+    ('sku', 'SKU'),
+    ('category', 'Category'),
+    ('supplier', 'Supplier'),
+    ('stock_quantity', 'Stock'),
+    ('reorder_level', 'Reorder Level'),
+    ('price', 'Price'),
+    ('value', 'Value'),
+    ('low_stock', 'Low Stock'),
+]
+
+FORMATS = ('csv', 'ndjson', 'xlsx')
+
+# Rows per chunk handed to the WSGI server.
+ROWS_PER_CHUNK = 500
+
+
+PRODUCT_FIELDS = {'_id': 0, 'name': 1, 'sku': 1, 'category': 1, 'category_id': 1,
+                  'supplier': 1, 'supplier_id': 1, 'stock_quantity': 1, 'reorder_level': 1,
+                  'price': 1}
+NAME_FIELDS = {'_id': 0, 'id': 1, 'name': 1}
+
+
+def _rows(batch):
+    for product in batch:
+        stock = product.get('stock_quantity') or 0
+        price = product.get('price') or 0
+        category, supplier = product.get('category_doc'), product.get('supplier_doc')
+        yield [
+            product.get('name'),
+            product.get('sku'),
+            category['name'] if category else product.get('category'),
+            supplier['name'] if supplier else product.get('supplier'),
+            product.get('stock_quantity'),
+            product.get('reorder_level'),
+            product.get('price'),
+            stock * price,
+            stock <= (product.get('reorder_level') or 0),
+        ]
+
+
+def iter_stock_report(db, batch_size=1000):
+    """
+    Yield report rows as lists in COLUMNS order. Category and supplier
+    names are resolved per batch of products, one query each.
+    """
+    cursor = db.inventory_product.find({'active': True}, PRODUCT_FIELDS, batch_size=batch_size)
+    with cursor:
+        batch = []
+        for product in cursor:
+            batch.append(product)
+            if len(batch) >= batch_size:
+                yield from _rows(_resolve(db, batch))
+                batch = []
+        if batch:
+            yield from _rows(_resolve(db, batch))
+
+
+def _resolve(db, batch):
+    for kind in ('category', 'supplier'):
+        loaded = repository.get_many(db, kind, [p.get(f'{kind}_id') for p in batch],
+                                     NAME_FIELDS)
+        for product in batch:
+            product[f'{kind}_doc'] = loaded.get(product.get(f'{kind}_id'))
+    return batch
+
+
+def _csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([label for _, label in COLUMNS])
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % ROWS_PER_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _ndjson_chunks(rows):
+    fields = [field for field, _ in COLUMNS]
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(fields, row)), default=str))
+        if len(lines) == ROWS_PER_CHUNK:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def _xlsx_file(rows):
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Stock Report')
+    sheet.append([label for _, label in COLUMNS])
+    for row in rows:
+        sheet.append(row)
+    output = tempfile.TemporaryFile()
+    workbook.save(output)
+    output.seek(0)
+    return output
+
+
+def export_stock_report(db, fmt, batch_size=1000):
+    """Return a streaming response for ``fmt`` (one of FORMATS)."""
+    filename = f'stock_report_{timezone.now():%Y%m%d_%H%M}.{fmt}'
+    rows = iter_stock_report(db, batch_size)
+
+    if fmt == 'xlsx':
+        return FileResponse(
+            _xlsx_file(rows), as_attachment=True, filename=filename,
+            content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+    if fmt == 'csv':
+        response = StreamingHttpResponse(_csv_chunks(rows), content_type='text/csv')
+    else:
+        response = StreamingHttpResponse(_ndjson_chunks(rows), content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,201 @@
+"""
+Demand forecasting and reorder-point recommendations.
+
+Daily OUT quantities for a chunk of products are loaded from the day
+rollups (see rollups.py) into a products x days NumPy matrix, and every
+statistic is computed for the whole chunk at once:
+
+* moving average over the last ``window`` days;
+* simple exponential smoothing with factor ``alpha``, as one dot product
+  with the closed-form weights;
+* standard deviation of daily demand over the history;
+* lead-time demand = forecast x lead time;
+* safety stock = z(service level) x std x sqrt(lead time).
+
+The recommended reorder level is ``ceil(lead-time demand + safety stock)``.
+It is stored on the product as ``recommended_reorder_level`` and only
+replaces ``reorder_level`` when applied. Large catalogues are split into
+chunks that can be spread over a process pool.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from statistics import NormalDist
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from pymongo import UpdateOne
+
+from . import versions
+from .lowstock import LOW_STOCK_EXPRESSIONS
+from .rollups import COLLECTION as ROLLUP_COLLECTION, bucket_start
+
+DEFAULTS = {
+    'HISTORY_DAYS': 365,
+    'WINDOW': 28,
+    'ALPHA': 0.3,
+    'METHOD': 'smoothing',
+    'LEAD_TIME_DAYS': 7,
+    'SERVICE_LEVEL': 0.95,
+}
+METHODS = ('smoothing', 'moving_average')
+
+
+def forecast_options(**overrides):
+    """DEFAULTS, then settings.INVENTORY_FORECAST, then ``overrides``."""
+    options = dict(DEFAULTS, **getattr(settings, 'INVENTORY_FORECAST', {}))
+    options.update({k: v for k, v in overrides.items() if v is not None})
+    return options
+
+
+def load_demand(db, product_ids, days, until=None):
+    """
+    A ``len(product_ids) x days`` float matrix of daily OUT quantities
+    ending with the day of ``until`` (default today).
+    """
+    end = bucket_start(until or timezone.now(), 'day')
+    start = end - timedelta(days=days - 1)
+    row_of = {product_id: row for row, product_id in enumerate(product_ids)}
+    rows, cols, quantities = [], [], []
+    cursor = db[ROLLUP_COLLECTION].find(
+        {'granularity': 'day', 'product_id': {'$in': list(product_ids)},
+         'bucket': {'$gte': start, '$lte': end}, 'out_qty': {'$gt': 0}},
+        {'_id': 0, 'product_id': 1, 'bucket': 1, 'out_qty': 1},
+    )
+    for bucket in cursor:
+        rows.append(row_of[bucket['product_id']])
+        cols.append((bucket_start(bucket['bucket'], 'day') - start).days)
+        quantities.append(bucket['out_qty'])
+    demand = np.zeros((len(product_ids), days))
+    if rows:
+        demand[np.array(rows), np.array(cols)] = quantities
+    return demand
+
+
+def smoothing_weights(days, alpha):
+    # Level after the last day with the first day as the initial level:
+    # alpha * (1 - alpha) ** age for every day but the first.
+    weights = alpha * (1 - alpha) ** np.arange(days - 1, -1, -1, dtype=float)
+    weights[0] = (1 - alpha) ** (days - 1)
+    return weights
+
+
+def forecast(demand, lead_times, window=28, alpha=0.3, method='smoothing',
+             service_level=0.95):
+    """
+    Vectorised forecast for every row of ``demand``. ``lead_times`` is a
+    per-row array of lead times in days. Returns a dict of per-row arrays.
+    """
+    days = demand.shape[1]
+    moving_average = demand[:, -min(window, days):].mean(axis=1)
+    smoothed = demand @ smoothing_weights(days, alpha)
+    daily = smoothed if method == 'smoothing' else moving_average
+    std = demand.std(axis=1, ddof=1) if days > 1 else np.zeros(len(demand))
+
+    lead_times = np.asarray(lead_times, dtype=float)
+    lead_time_demand = daily * lead_times
+    safety_stock = NormalDist().inv_cdf(service_level) * std * np.sqrt(lead_times)
+    reorder_level = np.ceil(lead_time_demand + safety_stock).astype(np.int64)
+    return {
+        'moving_average': moving_average,
+        'smoothed': smoothed,
+        'daily_demand': daily,
+        'demand_std': std,
+        'lead_time_demand': lead_time_demand,
+        'safety_stock': safety_stock,
+        'reorder_level': np.maximum(reorder_level, 0),
+    }
+
+
+def write_recommendations(db, product_ids, result, apply=False):
+    """Store the recommendations in one unordered bulk write."""
+    now = timezone.now()
+    ops = []
+    for row, product_id in enumerate(product_ids):
+        reorder_level = int(result['reorder_level'][row])
+        fields = {
+            'recommended_reorder_level': reorder_level,
+            'forecast': {
+                'daily_demand': round(float(result['daily_demand'][row]), 3),
+                'demand_std': round(float(result['demand_std'][row]), 3),
+                'lead_time_demand': round(float(result['lead_time_demand'][row]), 3),
+                'safety_stock': round(float(result['safety_stock'][row]), 3),
+                'computed_at': now,
+            },
+        }
+        if apply:
+            update = [{'$set': {**{k: {'$literal': v} for k, v in fields.items()},
+                                'reorder_level': reorder_level}},
+                      {'$set': LOW_STOCK_EXPRESSIONS}]
+        else:
+            update = {'$set': fields}
+        ops.append(UpdateOne({'id': product_id}, update))
+    if ops:
+        db.inventory_product.bulk_write(ops, ordered=False)
+        versions.bump(db, versions.PRODUCTS)
+    return len(ops)
+
+
+def forecast_chunk(db, products, options, apply=False, dry_run=False):
+    """
+    Forecast and store recommendations for ``products``, a list of
+    ``(product_id, lead_time_days or None)``. Returns the result arrays.
+    """
+    product_ids = [product_id for product_id, _ in products]
+    lead_times = [lead_time or options['LEAD_TIME_DAYS'] for _, lead_time in products]
+    demand = load_demand(db, product_ids, options['HISTORY_DAYS'])
+    result = forecast(demand, lead_times, options['WINDOW'], options['ALPHA'],
+                      options['METHOD'], options['SERVICE_LEVEL'])
+    if not dry_run:
+        write_recommendations(db, product_ids, result, apply)
+    return result
+
+
+def _worker(products, options, apply, dry_run):
+    # Runs in a pool process; mongo.get_db() gives it its own client.
+    from .mongo import get_db
+
+    result = forecast_chunk(get_db(), products, options, apply, dry_run)
+    return len(products), int((result['reorder_level'] > 0).sum())
+
+
+def iter_chunks(db, chunk_size):
+    """Active products as lists of ``(id, lead_time_days)``."""
+    chunk = []
+    for product in db.inventory_product.find({'active': True},
+                                             {'_id': 0, 'id': 1, 'lead_time_days': 1}):
+        chunk.append((product['id'], product.get('lead_time_days')))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def forecast_catalogue(db, options, apply=False, dry_run=False, chunk_size=20000, workers=1,
+                       progress=None):
+    """
+    Forecast every active product, ``chunk_size`` at a time, in this
+    process or across ``workers`` processes. Returns
+    ``(products, products_with_nonzero_reorder_level)``.
+    """
+    total = nonzero = 0
+    if workers <= 1:
+        for chunk in iter_chunks(db, chunk_size):
+            result = forecast_chunk(db, chunk, options, apply, dry_run)
+            total += len(chunk)
+            nonzero += int((result['reorder_level'] > 0).sum())
+            if progress:
+                progress(total)
+        return total, nonzero
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_worker, chunk, options, apply, dry_run)
+                   for chunk in iter_chunks(db, chunk_size)]
+        for future in futures:
+            count, chunk_nonzero = future.result()
+            total += count
+            nonzero += chunk_nonzero
+            if progress:
+                progress(total)
+    return total, nonzero
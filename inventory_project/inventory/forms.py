@@ -2,7 +2,27 @@ from .models import Product, Category, Supplier
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
+from django.urls import reverse_lazy
 from .models import Product, Supplier, Category, StockTransaction
+from . import lookups
+from .mongo import db
+from .search import PRODUCT_AUTOCOMPLETE_FIELDS, normalise
+
+
+class AutocompleteInput(forms.TextInput):
+    # A plain text input that static/js/main.js fills in from a JSON
+    # autocomplete endpoint, so no options are rendered server-side.
+    def __init__(self, url, attrs=None):
+        super().__init__(attrs)
+        self.url = url
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context['widget']['attrs'].update({
+            'data-autocomplete-url': str(self.url),
+            'autocomplete': 'off',
+        })
+        return context
 
 
 class CustomUserCreationForm(UserCreationForm):
@@ -21,8 +41,9 @@ class CustomUserCreationForm(UserCreationForm):
 
 class ProductForm(forms.Form):
     name = forms.CharField(max_length=100)
-    category = forms.ModelChoiceField(queryset=Category.objects.all(),required=False,to_field_name='name')
-    supplier = forms.ModelChoiceField(queryset=Supplier.objects.all(),required=False,to_field_name='name')
+    category = forms.ChoiceField(required=False)
+    supplier = forms.CharField(max_length=100, required=False, widget=AutocompleteInput(
+        reverse_lazy('supplier_autocomplete')))
     sku = forms.CharField(max_length=100)
     description = forms.CharField(widget=forms.Textarea(attrs={'rows': 3}))
     price = forms.DecimalField(min_value=0, decimal_places=2)
@@ -36,6 +57,10 @@ class ProductForm(forms.Form):
         self.fields['sku'].required = True
         self.fields['description'].required = True
 
+        # Choices come from the cached lookup tables, keyed by name
+        self.fields['category'].choices = [('', '---------')] + [
+            (c['name'], c['name']) for c in lookups.categories(db)]
+
         # Add Bootstrap classes
         for field in self.fields:
             self.fields[field].widget.attrs['class'] = 'form-control'
@@ -43,12 +68,46 @@ class ProductForm(forms.Form):
         # Add placeholders
         self.fields['name'].widget.attrs['placeholder'] = 'Enter product name'
         self.fields['sku'].widget.attrs['placeholder'] = 'Enter SKU'
+        self.fields['supplier'].widget.attrs['placeholder'] = 'Start typing a supplier name'
         self.fields['description'].widget.attrs['placeholder'] = 'Enter product description'
 
         # Add help text
         self.fields['reorder_level'].help_text = 'Minimum stock level before reorder alert'
         self.fields['image'].help_text = 'Upload product image (optional)'
 
+    def clean_supplier(self):
+        supplier = self.cleaned_data['supplier']
+        if supplier and supplier not in lookups.supplier_ids(db):
+            raise forms.ValidationError(f'Unknown supplier "{supplier}".')
+        return supplier
+
+
+class ProductEditForm(ProductForm):
+    # The stock figure the form was opened with; the save only changes stock
+    # if it still is this (see stock.adjust_stock).
+    stock_quantity_seen = forms.IntegerField(widget=forms.HiddenInput)
+
+
+class ProductImportForm(forms.Form):
+    # Validates one imported row with ProductForm's field rules. Category
+    # and supplier are given by name and resolved by the importer.
+    name = forms.CharField(max_length=100)
+    category = forms.CharField(max_length=100, required=False)
+    supplier = forms.CharField(max_length=100, required=False)
+    sku = forms.CharField(max_length=100)
+    description = forms.CharField()
+    price = forms.DecimalField(min_value=0, decimal_places=2)
+    stock_quantity = forms.IntegerField(min_value=0)
+    reorder_level = forms.IntegerField(min_value=0)
+
+
+class ProductImportUploadForm(forms.Form):
+    file = forms.FileField(help_text='CSV with a header row, or NDJSON (one product per line)')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['file'].widget.attrs['class'] = 'form-control'
+
 
 class SupplierForm(forms.Form):
     name = forms.CharField(max_length=100)
@@ -65,17 +124,44 @@ class SupplierForm(forms.Form):
 
 
 class StockTransactionForm(forms.Form):
-    product = forms.ModelChoiceField(queryset=Product.objects.all(), to_field_name='name')
+    product = forms.CharField(max_length=100, help_text='SKU or product name', widget=AutocompleteInput(
+        reverse_lazy('product_autocomplete')))
     transaction_type = forms.ChoiceField(choices=StockTransaction.TRANSACTION_TYPES)
     quantity = forms.IntegerField(min_value=1)
     notes = forms.CharField(widget=forms.Textarea(attrs={'rows': 3}), required=False)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, page_product=None, **kwargs):
         super().__init__(*args, **kwargs)
+        # The product whose page the form is on: the only one it may move.
+        self.page_product = page_product
         # Add Bootstrap classes
         for field in self.fields:
             self.fields[field].widget.attrs['class'] = 'form-control'
 
+    def clean_product(self):
+        # Resolved with the same indexed lookups as the autocomplete endpoint
+        value = normalise(self.cleaned_data['product'])
+        for field in ('search_sku', 'search_name'):
+            product = db.inventory_product.find_one(
+                {field: value, 'active': True}, PRODUCT_AUTOCOMPLETE_FIELDS)
+            if product:
+                break
+        else:
+            raise forms.ValidationError('Unknown product.')
+        if self.page_product and product['id'] != self.page_product['id']:
+            raise forms.ValidationError(
+                f'This form moves stock of {self.page_product.get("name")} only.')
+        return product
+
+
+class StockMovementLineForm(forms.Form):
+    # One line of a bulk movement batch: the StockTransactionForm rules,
+    # with the product identified by SKU.
+    sku = forms.CharField(max_length=100)
+    transaction_type = forms.ChoiceField(choices=StockTransaction.TRANSACTION_TYPES)
+    quantity = forms.IntegerField(min_value=1)
+    notes = forms.CharField(required=False)
+
 
 class CategoryForm(forms.Form):
     name = forms.CharField(max_length=100)
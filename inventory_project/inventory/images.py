@@ -0,0 +1,492 @@
+"""
+Product images: content-addressed storage, background thumbnails and serving.
+
+Uploads are streamed into files named by the SHA-256 of their bytes, so a
+picture uploaded twice, or for several products, is stored once:
+
+    MEDIA_ROOT/products/originals/ab/abcd….jpg
+    MEDIA_ROOT/products/variants/ab/abcd…-thumb.webp   (and .jpg, per size)
+
+The request only hashes and moves the upload. Resized WebP and JPEG
+variants for each of SIZES are written by a per-process worker pool, which
+then sets them on every product with that image:
+
+    'image': 'products/originals/ab/abcd….jpg',
+    'image_hash': 'abcd…',
+    'image_variants': {'thumb': {'webp': …, 'jpeg': …, 'width': 128, 'height': 96}, …},
+    'image_status': 'pending' | 'ready' | 'failed',
+
+``serve`` answers ``/images/<hash>/<size>.<ext>`` (``original.<ext>`` for
+the upload itself). The URLs never change content, so responses are
+cacheable for a year, and support conditional and range requests; with
+SENDFILE set the body is left to the front-end server (nginx
+``X-Accel-Redirect`` or Apache/lighttpd ``X-Sendfile``).
+
+The process_product_images command moves images stored before this scheme
+into it, regenerates missing variants and prunes unreferenced files.
+
+Settings live in INVENTORY_IMAGES; see DEFAULTS.
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.urls import reverse
+from django.utils.http import parse_etags
+from PIL import Image, ImageOps
+
+logger = logging.getLogger('inventory.images')
+
+DEFAULTS = {
+    # Size name -> longest side in pixels. Images are never upscaled.
+    'SIZES': {'thumb': 128, 'large': 800},
+    'WEBP_QUALITY': 80,
+    'JPEG_QUALITY': 85,
+    'WORKERS': 2,
+    'MAX_AGE': 365 * 24 * 3600,
+    # None, 'x-accel-redirect' or 'x-sendfile'
+    'SENDFILE': None,
+    # URL prefix of the nginx internal location aliased to MEDIA_ROOT
+    'SENDFILE_PREFIX': '/protected-media/',
+}
+
+ORIGINALS = 'products/originals'
+VARIANTS = 'products/variants'
+INCOMING = 'products/incoming'
+
+# Variant format -> (Pillow format, file extension, content type)
+FORMATS = {
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+}
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp', 'BMP': 'bmp',
+              'TIFF': 'tif'}
+CONTENT_TYPES = {ext: Image.MIME.get(fmt, 'application/octet-stream')
+                 for fmt, ext in EXTENSIONS.items()}
+CONTENT_TYPES.update({ext: content_type for _, ext, content_type in FORMATS.values()})
+
+CHUNK_SIZE = 256 * 1024
+
+_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+_NAME = re.compile(r'^(\w+)\.(\w+)$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def image_options():
+    """DEFAULTS overridden by settings.INVENTORY_IMAGES."""
+    return dict(DEFAULTS, **getattr(settings, 'INVENTORY_IMAGES', {}))
+
+
+def _absolute(relative):
+    return os.path.join(settings.MEDIA_ROOT, relative)
+
+
+def original_path(digest, extension):
+    return f'{ORIGINALS}/{digest[:2]}/{digest}.{extension}'
+
+
+def variant_path(digest, size, fmt):
+    return f'{VARIANTS}/{digest[:2]}/{digest}-{size}.{FORMATS[fmt][1]}'
+
+
+def _format_of(path):
+    with Image.open(path) as image:
+        return image.format, image.size
+
+
+def _store(source, digest, extension, move):
+    relative = original_path(digest, extension)
+    target = _absolute(relative)
+    if os.path.exists(target):
+        # Already stored by an earlier upload of the same bytes.
+        if move:
+            os.remove(source)
+        return relative
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if move:
+        file_move_safe(source, target, allow_overwrite=True)
+    else:
+        with open(source, 'rb') as src, tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(target), delete=False) as out:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                out.write(chunk)
+        os.replace(out.name, target)
+    return relative
+
+
+def _fields(relative, digest, dimensions):
+    variants = existing_variants(digest)
+    return {
+        'image': relative,
+        'image_hash': digest,
+        'image_width': dimensions[0],
+        'image_height': dimensions[1],
+        'image_variants': variants or {},
+        'image_status': 'ready' if variants else 'pending',
+    }
+
+
+def store_upload(upload):
+    """
+    Stream an uploaded image into the content-addressed store and return
+    the image fields to set on its product. Temporary uploads are moved
+    rather than copied. ``schedule`` the hash once the product is saved.
+    """
+    digest = hashlib.sha256()
+    if hasattr(upload, 'temporary_file_path'):
+        # Already on disk: hash it, then move it into the store.
+        source = upload.temporary_file_path()
+        for chunk in upload.chunks(CHUNK_SIZE):
+            digest.update(chunk)
+    else:
+        incoming = _absolute(INCOMING)
+        os.makedirs(incoming, exist_ok=True)
+        fd, source = tempfile.mkstemp(dir=incoming, suffix='.upload')
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in upload.chunks(CHUNK_SIZE):
+                digest.update(chunk)
+                out.write(chunk)
+    # forms.ImageField has already opened it with Pillow.
+    image = getattr(upload, 'image', None)
+    if image is not None:
+        fmt, dimensions = image.format, image.size
+    else:
+        fmt, dimensions = _format_of(source)
+    extension = EXTENSIONS.get(fmt, (fmt or 'bin').lower())
+    digest = digest.hexdigest()
+    return _fields(_store(source, digest, extension, True), digest, dimensions)
+
+
+def store_file(path):
+    """store_upload for an image already on disk (left in place)."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    fmt, dimensions = _format_of(path)
+    digest = digest.hexdigest()
+    return _fields(_store(path, digest, EXTENSIONS.get(fmt, fmt.lower()), False), digest,
+                   dimensions)
+
+
+def existing_variants(digest, options=None):
+    """The variants of ``digest`` when every one of them is on disk, else None."""
+    options = options or image_options()
+    variants = {}
+    for size in options['SIZES']:
+        paths = {fmt: variant_path(digest, size, fmt) for fmt in FORMATS}
+        if not all(os.path.exists(_absolute(p)) for p in paths.values()):
+            return None
+        with Image.open(_absolute(paths['jpeg'])) as image:
+            width, height = image.size
+        variants[size] = dict(paths, width=width, height=height)
+    return variants
+
+
+def _save(image, relative, fmt, options):
+    target = _absolute(relative)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    pillow_format = FORMATS[fmt][0]
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(target), delete=False) as out:
+        if pillow_format == 'JPEG':
+            if image.mode not in ('RGB', 'L'):
+                # Flatten transparency onto white; JPEG has no alpha.
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                rgba = image.convert('RGBA')
+                background.paste(rgba, mask=rgba.getchannel('A'))
+                image = background
+            image.save(out, 'JPEG', quality=options['JPEG_QUALITY'], optimize=True,
+                       progressive=True)
+        else:
+            image.save(out, 'WEBP', quality=options['WEBP_QUALITY'], method=4)
+    os.replace(out.name, target)
+
+
+def generate_variants(digest, original, options=None):
+    """
+    Write the WebP and JPEG variants of the original at ``original``
+    (relative to MEDIA_ROOT) and return them, largest size first.
+    """
+    options = options or image_options()
+    sizes = sorted(options['SIZES'].items(), key=lambda item: -item[1])
+    variants = {}
+    with Image.open(_absolute(original)) as image:
+        # JPEGs decode straight to a reduced scale when that is enough.
+        image.draft('RGB', (sizes[0][1], sizes[0][1]))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        for size, longest in sizes:
+            # Each size is reduced from the previous, larger one.
+            image.thumbnail((longest, longest), Image.LANCZOS, reducing_gap=3.0)
+            paths = {}
+            for fmt in FORMATS:
+                paths[fmt] = variant_path(digest, size, fmt)
+                _save(image, paths[fmt], fmt, options)
+            variants[size] = dict(paths, width=image.width, height=image.height)
+    return variants
+
+
+def process(db, digest, original, force=False):
+    """
+    Generate the variants of one stored image (unless already on disk, or
+    with ``force``) and record them on every product using it. Returns the
+    variants, or None if generation failed.
+    """
+    from . import versions
+
+    try:
+        variants = ((None if force else existing_variants(digest))
+                    or generate_variants(digest, original))
+    except Exception:
+        logger.exception('could not generate variants of %s', original)
+        db.inventory_product.update_many({'image_hash': digest},
+                                         {'$set': {'image_status': 'failed'}})
+        return None
+    result = db.inventory_product.update_many(
+        {'image_hash': digest},
+        {'$set': {'image_variants': variants, 'image_status': 'ready'}})
+    if result.modified_count:
+        versions.bump(db, versions.PRODUCTS)
+    return variants
+
+
+class _Workers:
+    """Per-process thread pool generating variants off the request path."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._queued = set()
+
+    def submit(self, db, digest, original):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive a fork.
+                self._executor = ThreadPoolExecutor(
+                    max_workers=image_options()['WORKERS'],
+                    thread_name_prefix='inventory-images')
+                self._pid = os.getpid()
+                self._queued = set()
+            if digest in self._queued:
+                return None
+            self._queued.add(digest)
+            return self._executor.submit(self._run, db, digest, original)
+
+    def _run(self, db, digest, original):
+        try:
+            return process(db, digest, original)
+        finally:
+            with self._lock:
+                self._queued.discard(digest)
+
+
+_workers = _Workers()
+
+
+def schedule(db, fields):
+    """Queue variant generation for the image ``fields`` from store_upload, if pending."""
+    if fields.get('image_status') == 'pending':
+        return _workers.submit(db, fields['image_hash'], fields['image'])
+    return None
+
+
+def adopt_legacy(db):
+    """
+    Copy images uploaded before content addressing (``image`` set but no
+    ``image_hash``) into the store and point their products at it. Returns
+    ``(adopted, missing)``; the old files are left for ``prune``.
+    """
+    adopted = missing = 0
+    for product in db.inventory_product.find(
+            {'image': {'$type': 'string', '$ne': ''}, 'image_hash': {'$exists': False}},
+            {'id': 1, 'image': 1}):
+        path = _absolute(product['image'])
+        if not os.path.isfile(path):
+            logger.warning('image %s of product %s is missing', product['image'],
+                           product.get('id'))
+            missing += 1
+            continue
+        db.inventory_product.update_one({'_id': product['_id']}, {'$set': store_file(path)})
+        adopted += 1
+    return adopted, missing
+
+
+def pending(db, force=False):
+    """``{hash: original}`` of the stored images whose variants are not ready."""
+    query = {'image_hash': {'$exists': True}}
+    if not force:
+        query['image_status'] = {'$ne': 'ready'}
+    return {p['image_hash']: p['image']
+            for p in db.inventory_product.find(query, {'_id': 0, 'image_hash': 1, 'image': 1})}
+
+
+def prune(db, dry_run=False, grace=3600):
+    """
+    Delete stored originals and variants that no product (active or not)
+    uses, abandoned incoming files, and legacy uploads under products/ no
+    product names any more. Files changed in the last ``grace`` seconds
+    are kept: a product may be about to reference them. Returns the paths
+    (relative to MEDIA_ROOT) removed, or that would be with ``dry_run``.
+    """
+    hashes = set(db.inventory_product.distinct('image_hash'))
+    named = {name.replace('\\', '/') for name in db.inventory_product.distinct('image')
+             if isinstance(name, str)}
+    cutoff = time.time() - grace
+    removed = []
+    for directory, _, filenames in os.walk(_absolute('products')):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            relative = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+            if relative.startswith((ORIGINALS + '/', VARIANTS + '/')):
+                keep = filename[:64] in hashes
+            elif relative.startswith(INCOMING + '/'):
+                keep = False
+            else:
+                keep = relative in named
+            if keep or os.path.getmtime(path) > cutoff:
+                continue
+            removed.append(relative)
+            if not dry_run:
+                os.remove(path)
+    return removed
+
+
+def image_url(product, size, fmt='jpeg'):
+    """URL of a product's ``size`` variant in ``fmt``, or None if not generated yet."""
+    variant = (product.get('image_variants') or {}).get(size)
+    if not variant or not product.get('image_hash'):
+        return None
+    return reverse('product_image', args=[product['image_hash'],
+                                          f'{size}.{FORMATS[fmt][1]}'])
+
+
+def original_url(product):
+    if not product.get('image_hash') or not product.get('image'):
+        return None
+    extension = product['image'].rsplit('.', 1)[-1]
+    return reverse('product_image', args=[product['image_hash'], f'original.{extension}'])
+
+
+def _resolve(digest, name):
+    match = _NAME.match(name)
+    if not _DIGEST.match(digest) or not match:
+        raise Http404('Image not found')
+    size, extension = match.groups()
+    if size == 'original':
+        relative = original_path(digest, extension)
+    else:
+        fmt = next((f for f, (_, ext, _) in FORMATS.items() if ext == extension), None)
+        if fmt is None or size not in image_options()['SIZES']:
+            raise Http404('Image not found')
+        relative = variant_path(digest, size, fmt)
+    return relative, CONTENT_TYPES.get(extension, 'application/octet-stream')
+
+
+def _byte_range(header, length):
+    """
+    ``(start, end)`` (inclusive) for a single ``bytes=`` range, None to
+    ignore the header, or ``()`` when it cannot be satisfied.
+    """
+    match = _RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        # Multiple or malformed ranges: send the whole file.
+        return None
+    first, last = match.groups()
+    if first == '':
+        start, end = max(0, length - int(last)), length - 1
+    else:
+        start = int(first)
+        end = min(int(last), length - 1) if last else length - 1
+    if start >= length or start > end:
+        return ()
+    return start, end
+
+
+class _RangeFile:
+    """Reads ``length`` bytes of ``f`` from its current position."""
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def serve(request, digest, name):
+    """Response for one stored image or variant; see the module docstring."""
+    relative, content_type = _resolve(digest, name)
+    path = _absolute(relative)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404('Image not found')
+    options = image_options()
+    # Content-addressed: the same URL always has the same bytes.
+    etag = f'"{digest}-{name}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={options["MAX_AGE"]}, immutable',
+        'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+        'Accept-Ranges': 'bytes',
+    }
+
+    def with_headers(response):
+        for key, value in headers.items():
+            response[key] = value
+        return response
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+        return with_headers(HttpResponseNotModified())
+
+    sendfile = options['SENDFILE']
+    if sendfile == 'x-accel-redirect':
+        # nginx sends the body and handles Range itself.
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = options['SENDFILE_PREFIX'].rstrip('/') + '/' + relative
+        return with_headers(response)
+    if sendfile == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return with_headers(response)
+
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = _byte_range(range_header, stat.st_size)
+    if byte_range == ():
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return with_headers(response)
+
+    f = open(path, 'rb')
+    if byte_range is None:
+        # FileResponse hands real files to wsgi.file_wrapper (sendfile).
+        return with_headers(FileResponse(f, content_type=content_type))
+    start, end = byte_range
+    f.seek(start)
+    response = FileResponse(_RangeFile(f, end - start + 1), status=206,
+                            content_type=content_type)
+    response['Content-Length'] = end - start + 1
+    response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    return with_headers(response)
@@ -0,0 +1,251 @@
+"""
+Streaming product import from CSV or NDJSON.
+
+Rows are read lazily, validated with ProductImportForm and upserted on
+``sku`` in chunked, unordered bulk_writes, so memory use depends on the
+chunk size rather than the file size. Category and supplier names are
+resolved to ids through the cached lookup maps. The stock of a new
+product is its opening ledger entry (see stock.opening_entry), put in its
+outbox by the upsert and delivered after the import.
+
+Only active products are updated. A row whose SKU belongs to nothing but
+soft-deleted products is skipped rather than bringing a deleted product
+back or creating a new one behind the user's back. Each chunk reads its
+products before and after the write and applies the difference to the
+dashboard summary, so an import costs the summary as much as its rows.
+"""
+import csv
+import json
+import time
+
+from django.utils import timezone
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from . import lookups, repository, summary, versions
+from .forms import ProductImportForm
+from .lowstock import LOW_STOCK_EXPRESSIONS
+from .search import product_search_fields
+from .stock import OUTBOX, drain_outbox, opening_entry
+
+FORMATS = ('csv', 'ndjson')
+
+
+def detect_format(filename):
+    return 'ndjson' if filename.lower().endswith(('.ndjson', '.jsonl', '.json')) else 'csv'
+
+
+def iter_rows(stream, fmt):
+    """Yield one dict per row from a text stream."""
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            row = {'__error__': f'Invalid JSON: {exc}'}
+        yield row if isinstance(row, dict) else {'__error__': 'Expected a JSON object'}
+
+
+class ImportReport:
+    def __init__(self, keep_rejects=100):
+        self.processed = 0
+        self.imported = 0
+        self.inserted = 0
+        self.updated = 0
+        self.rejected = 0
+        self.skipped = 0
+        # Rejected and skipped rows, up to keep_rejects of them.
+        self.rejects = []
+        self.keep_rejects = keep_rejects
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def _keep(self, row_number, sku, errors):
+        if len(self.rejects) < self.keep_rejects:
+            self.rejects.append({'row': row_number, 'sku': sku, 'errors': errors})
+
+    def reject(self, row_number, sku, errors):
+        self.rejected += 1
+        self._keep(row_number, sku, errors)
+
+    def skip(self, row_number, sku, errors):
+        self.skipped += 1
+        self._keep(row_number, sku, errors)
+
+    @property
+    def rows_per_second(self):
+        return round(self.processed / self.elapsed, 1) if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'processed': self.processed,
+            'imported': self.imported,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'rejected': self.rejected,
+            'skipped': self.skipped,
+            'rejects': self.rejects,
+            'elapsed_seconds': round(self.elapsed, 3),
+            'rows_per_second': self.rows_per_second,
+        }
+
+
+def _deleted_skus(db, skus, active):
+    """The SKUs in ``skus`` held only by soft-deleted products."""
+    missing = [sku for sku in set(skus) if sku not in active]
+    if not missing:
+        return set()
+    return set(db.inventory_product.distinct('sku', {'sku': {'$in': missing}, 'active': False}))
+
+
+def _flush(db, ops, row_numbers, skus, report, reject):
+    fields = {**summary.PRODUCT_FIELDS, 'sku': 1}
+    before = {p['sku']: p for p in db.inventory_product.find(
+        {'sku': {'$in': skus}, 'active': True}, fields)}
+    deleted = _deleted_skus(db, skus, before)
+    if deleted:
+        kept = []
+        for i, sku in enumerate(skus):
+            if sku in deleted:
+                reject(row_numbers[i], sku,
+                       {'sku': ['Belongs to a deleted product; the row was skipped.']},
+                       skipped=True)
+            else:
+                kept.append(i)
+        ops = [ops[i] for i in kept]
+        row_numbers = [row_numbers[i] for i in kept]
+        skus = [skus[i] for i in kept]
+    if not ops:
+        report.elapsed = time.perf_counter() - report.started
+        return
+
+    try:
+        result = db.inventory_product.bulk_write(ops, ordered=False)
+    except BulkWriteError as exc:
+        result = None
+        details = exc.details
+        report.imported += len(ops) - len(details.get('writeErrors', []))
+        report.inserted += details.get('nUpserted', 0)
+        report.updated += details.get('nModified', 0)
+        for error in details.get('writeErrors', []):
+            index = error['index']
+            reject(row_numbers[index], skus[index],
+                   {'__all__': [error.get('errmsg', 'Write failed')]})
+    if result is not None:
+        report.imported += len(ops)
+        report.inserted += result.upserted_count
+        report.updated += result.modified_count
+
+    # Rows that failed to write leave their product as it was, or absent.
+    changes = [(before.get(p['sku']), p) for p in db.inventory_product.find(
+        {'sku': {'$in': skus}, 'active': True}, fields)]
+    summary.products_changed(db, changes)
+    report.elapsed = time.perf_counter() - report.started
+
+
+def import_products(db, rows, chunk_size=1000, progress=None, on_reject=None, keep_rejects=100):
+    """
+    Upsert products from an iterable of row dicts.
+
+    Existing products (matched by SKU among the active ones) get their
+    catalogue fields updated but keep their stock; ``stock_quantity`` only
+    seeds new products. Rows for SKUs held only by deleted products are
+    skipped and counted in ``report.skipped``.
+    ``progress(report)`` is called after every chunk and
+    ``on_reject(row_number, sku, errors)`` for every rejected row.
+    """
+    report = ImportReport(keep_rejects)
+    categories = lookups.category_ids(db)
+    suppliers = lookups.supplier_ids(db)
+    ops, row_numbers, skus = [], [], []
+
+    def reject(row_number, sku, errors, skipped=False):
+        (report.skip if skipped else report.reject)(row_number, sku, errors)
+        if on_reject:
+            on_reject(row_number, sku, errors)
+
+    for row_number, row in enumerate(rows, start=1):
+        report.processed += 1
+        sku = row.get('sku')
+        if '__error__' in row:
+            reject(row_number, sku, {'__all__': [row['__error__']]})
+            continue
+
+        form = ProductImportForm(row)
+        if not form.is_valid():
+            reject(row_number, sku, {k: list(v) for k, v in form.errors.items()})
+            continue
+        data = form.cleaned_data
+
+        errors = {}
+        category_id = supplier_id = None
+        if data['category']:
+            category_id = categories.get(data['category'])
+            if category_id is None:
+                errors['category'] = [f'Unknown category "{data["category"]}".']
+        if data['supplier']:
+            supplier_id = suppliers.get(data['supplier'])
+            if supplier_id is None:
+                errors['supplier'] = [f'Unknown supplier "{data["supplier"]}".']
+        if errors:
+            reject(row_number, data['sku'], errors)
+            continue
+
+        now = timezone.now()
+        catalogue = {
+            'name': data['name'],
+            'description': data['description'],
+            'price': float(data['price']),
+            'reorder_level': data['reorder_level'],
+            'category': data['category'] or None,
+            'category_id': category_id,
+            'supplier': data['supplier'] or None,
+            'supplier_id': supplier_id,
+            'updated_at': now,
+            **product_search_fields(data),
+        }
+        # A pipeline update, so the low-stock fields can be derived from
+        # whichever stock the product ends up with. $ifNull plays the part
+        # of $setOnInsert; $literal keeps user text from being read as
+        # field paths. An insert takes ``active`` from the filter.
+        product_id = repository.new_id()
+        opening = opening_entry(product_id, data['stock_quantity'], data['name'])
+        inserting = {'$eq': [{'$ifNull': ['$id', None]}, None]}
+        ops.append(UpdateOne(
+            {'sku': data['sku'], 'active': True},
+            [
+                {'$set': {
+                    **{field: {'$literal': value} for field, value in catalogue.items()},
+                    'id': {'$ifNull': ['$id', product_id]},
+                    'stock_quantity': {'$ifNull': ['$stock_quantity', data['stock_quantity']]},
+                    'ledger_sequence': {'$ifNull': ['$ledger_sequence', 1 if opening else 0]},
+                    OUTBOX: {'$cond': [inserting, {'$literal': [opening] if opening else []},
+                                       {'$ifNull': [f'${OUTBOX}', []]}]},
+                    'created_at': {'$ifNull': ['$created_at', now]},
+                }},
+                {'$set': LOW_STOCK_EXPRESSIONS},
+            ],
+            upsert=True,
+        ))
+        row_numbers.append(row_number)
+        skus.append(data['sku'])
+
+        if len(ops) >= chunk_size:
+            _flush(db, ops, row_numbers, skus, report, reject)
+            ops, row_numbers, skus = [], [], []
+            if progress:
+                progress(report)
+
+    if ops:
+        _flush(db, ops, row_numbers, skus, report, reject)
+    if report.imported:
+        drain_outbox(db)
+        versions.bump(db, versions.PRODUCTS)
+    report.elapsed = time.perf_counter() - report.started
+    if progress:
+        progress(report)
+    return report
@@ -0,0 +1,286 @@
+"""
+Declared indexes for the raw pymongo collections used by the views.
+
+INDEXES is the single source of truth (TIMESERIES_INDEXES stands in for
+the transactions entry when that collection is time-series);
+``ensure_indexes`` compares it with what the server has and creates
+whatever is missing. HOT_QUERIES lists the query shapes the views run on
+every request so they can be checked with explain() for collection scans.
+"""
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+
+ACTIVE = {'active': True}
+
+INDEXES = {
+    'inventory_product': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        # Among active products only, so a deleted product's SKU can be reused.
+        IndexModel([('sku', ASCENDING)], name='sku_unique', unique=True,
+                   partialFilterExpression=ACTIVE),
+        # Trailing _id keys match the keyset pagination sort order.
+        IndexModel([('category_id', ASCENDING), ('name', ASCENDING), ('_id', ASCENDING)],
+                   name='active_by_category',
+                   partialFilterExpression=ACTIVE),
+        IndexModel([('supplier_id', ASCENDING), ('name', ASCENDING), ('_id', ASCENDING)],
+                   name='active_by_supplier',
+                   partialFilterExpression=ACTIVE),
+        IndexModel([('name', ASCENDING), ('_id', ASCENDING)], name='active_by_name',
+                   partialFilterExpression=ACTIVE),
+        # Low-stock list sorted by severity; covers lowstock.LOW_STOCK_PROJECTION.
+        IndexModel([('active', ASCENDING), ('is_low_stock', ASCENDING),
+                    ('stock_deficit', DESCENDING), ('id', ASCENDING), ('name', ASCENDING),
+                    ('stock_quantity', ASCENDING), ('reorder_level', ASCENDING)],
+                   name='low_stock',
+                   partialFilterExpression={'is_low_stock': True}),
+        # Search tiers (see search.py): anchored prefixes on the normalised
+        # fields and one weighted text index for everything else. The
+        # trailing keys cover the autocomplete projection.
+        IndexModel([('search_sku', ASCENDING), ('active', ASCENDING), ('id', ASCENDING),
+                    ('sku', ASCENDING), ('name', ASCENDING)],
+                   name='search_sku',
+                   partialFilterExpression=ACTIVE),
+        IndexModel([('search_name', ASCENDING), ('active', ASCENDING), ('id', ASCENDING),
+                    ('sku', ASCENDING), ('name', ASCENDING)],
+                   name='search_name',
+                   partialFilterExpression=ACTIVE),
+        IndexModel([('name', TEXT), ('sku', TEXT), ('supplier', TEXT), ('description', TEXT)],
+                   name='search_text',
+                   weights={'sku': 10, 'name': 5, 'supplier': 2, 'description': 1},
+                   partialFilterExpression=ACTIVE),
+        # Only products with undelivered stock transactions (see stock.py).
+        IndexModel([('pending_transactions.id', ASCENDING)], name='pending_transactions',
+                   partialFilterExpression={'pending_transactions.id': {'$exists': True}}),
+    ],
+    'inventory_category': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('name', ASCENDING)], name='active_by_name',
+                   partialFilterExpression=ACTIVE),
+    ],
+    'inventory_supplier': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('name', ASCENDING), ('_id', ASCENDING)], name='active_by_name',
+                   partialFilterExpression=ACTIVE),
+        IndexModel([('created_at', DESCENDING)], name='created_at'),
+        IndexModel([('search_name', ASCENDING), ('active', ASCENDING), ('id', ASCENDING),
+                    ('name', ASCENDING)],
+                   name='search_name',
+                   partialFilterExpression=ACTIVE),
+        IndexModel([('search_contact', ASCENDING)], name='search_contact',
+                   partialFilterExpression=ACTIVE),
+        IndexModel([('search_email', ASCENDING)], name='search_email',
+                   partialFilterExpression=ACTIVE),
+        IndexModel([('name', TEXT), ('contact_person', TEXT), ('email', TEXT)],
+                   name='search_text',
+                   weights={'name': 5, 'contact_person': 3, 'email': 1},
+                   partialFilterExpression=ACTIVE),
+    ],
+    'inventory_stocktransaction': [
+        IndexModel([('id', ASCENDING)], name='id_unique', unique=True),
+        IndexModel([('product_id', ASCENDING), ('transaction_date', DESCENDING),
+                    ('_id', DESCENDING)],
+                   name='product_history'),
+        IndexModel([('transaction_type', ASCENDING), ('transaction_date', DESCENDING)],
+                   name='type_by_date'),
+        IndexModel([('transaction_date', DESCENDING)], name='recent'),
+        # Ledger order (see ledger.py); entries from before the ledger have no sequence.
+        IndexModel([('product_id', ASCENDING), ('sequence', ASCENDING)],
+                   name='ledger_sequence', unique=True,
+                   partialFilterExpression={'sequence': {'$exists': True}}),
+    ],
+    'inventory_stock_snapshots': [
+        IndexModel([('product_id', ASCENDING), ('taken_at', DESCENDING)],
+                   name='product_snapshots'),
+    ],
+    'inventory_stock_rollup': [
+        IndexModel([('product_id', ASCENDING), ('granularity', ASCENDING),
+                    ('bucket', ASCENDING)],
+                   name='bucket_unique', unique=True),
+        # Window scans for top-N reports.
+        IndexModel([('granularity', ASCENDING), ('bucket', ASCENDING), ('product_id', ASCENDING)],
+                   name='window'),
+        IndexModel([('expire_at', ASCENDING)], name='expire_at', expireAfterSeconds=0),
+    ],
+}
+
+# inventory_stocktransaction as a time-series collection (see
+# timeseries.py), which takes neither unique nor partial indexes. The
+# server creates metaField_timeField itself from 6.3 on.
+TIMESERIES_INDEXES = [
+    IndexModel([('product_id', ASCENDING), ('transaction_date', ASCENDING)],
+               name='product_id_1_transaction_date_1'),
+    IndexModel([('id', ASCENDING)], name='id'),
+    IndexModel([('product_id', ASCENDING), ('transaction_date', DESCENDING),
+                ('_id', DESCENDING)],
+               name='product_history'),
+    IndexModel([('transaction_type', ASCENDING), ('transaction_date', DESCENDING)],
+               name='type_by_date'),
+    IndexModel([('transaction_date', DESCENDING)], name='recent'),
+    IndexModel([('product_id', ASCENDING), ('sequence', ASCENDING)], name='ledger_sequence'),
+]
+
+# (collection, filter, sort) for queries issued on every page view.
+HOT_QUERIES = [
+    ('inventory_product', {'id': 'x', 'active': True}, None),
+    ('inventory_product', {'supplier_id': 'x', 'active': True}, None),
+    ('inventory_product', {'category_id': 'x', 'active': True}, None),
+    ('inventory_product', {'active': True, 'is_low_stock': True},
+     [('stock_deficit', DESCENDING), ('id', ASCENDING)]),
+    ('inventory_product', {'active': True, 'search_sku': 'x'}, None),
+    ('inventory_product', {'active': True, 'search_name': {'$regex': '^x'}},
+     [('search_name', ASCENDING)]),
+    ('inventory_supplier', {'active': True, 'search_name': {'$regex': '^x'}},
+     [('search_name', ASCENDING)]),
+    ('inventory_category', {'id': 'x'}, None),
+    ('inventory_supplier', {'id': 'x', 'active': True}, None),
+    ('inventory_supplier', {}, [('created_at', DESCENDING)]),
+    ('inventory_stocktransaction', {'product_id': 'x'},
+     [('transaction_date', DESCENDING)]),
+    ('inventory_stocktransaction', {}, [('transaction_date', DESCENDING)]),
+    ('inventory_stock_rollup',
+     {'granularity': 'day', 'bucket': {'$gte': datetime(2000, 1, 1)}}, None),
+]
+
+# Options that change what an index is; anything else (e.g. background)
+# is ignored when comparing against the server.
+_COMPARED_OPTIONS = ('unique', 'sparse', 'partialFilterExpression',
+                     'expireAfterSeconds', 'collation', 'weights')
+
+
+def _spec(document):
+    key = document['key']
+    if hasattr(key, 'items'):
+        key = key.items()
+    return {
+        'key': list(key),
+        'options': {k: document[k] for k in _COMPARED_OPTIONS if k in document},
+    }
+
+
+def _normalise(spec):
+    # The server reports numeric directions as floats or ints depending on
+    # how the index was built, so compare them as ints.
+    key = [(field, int(direction) if isinstance(direction, (int, float)) else direction)
+           for field, direction in spec['key']]
+    # Text indexes are reported with their fields folded into _fts/_ftsx;
+    # the fields themselves show up in weights.
+    if any(direction == TEXT for _, direction in key):
+        folded = []
+        for field, direction in key:
+            if direction == TEXT or field in ('_fts', '_ftsx'):
+                if ('_fts', TEXT) not in folded:
+                    folded.extend([('_fts', TEXT), ('_ftsx', 1)])
+            else:
+                folded.append((field, direction))
+        key = folded
+    return key, spec['options']
+
+
+def declared_indexes(db, collection):
+    """The INDEXES of ``collection``, or TIMESERIES_INDEXES for time-series transactions."""
+    from .timeseries import TRANSACTIONS, uses_timeseries
+
+    if collection == TRANSACTIONS and uses_timeseries(db):
+        return TIMESERIES_INDEXES
+    return INDEXES[collection]
+
+
+def diff_indexes(db, collections=None):
+    """
+    Compare declared and existing indexes.
+
+    Returns a list of ``(collection, name, status)`` where status is one of
+    ``ok``, ``missing``, ``changed`` or ``extra``.
+    """
+    results = []
+    for collection in INDEXES:
+        if collections and collection not in collections:
+            continue
+        models = declared_indexes(db, collection)
+        existing = db[collection].index_information()
+        declared_names = set()
+        for model in models:
+            wanted = model.document
+            name = wanted['name']
+            declared_names.add(name)
+            if name not in existing:
+                results.append((collection, name, 'missing'))
+                continue
+            current = dict(existing[name], name=name)
+            if _normalise(_spec(current)) != _normalise(_spec(wanted)):
+                results.append((collection, name, 'changed'))
+            else:
+                results.append((collection, name, 'ok'))
+        for name in existing:
+            if name != '_id_' and name not in declared_names:
+                results.append((collection, name, 'extra'))
+    return results
+
+
+def ensure_indexes(db, collections=None, rebuild=False, drop_extra=False, dry_run=False):
+    """
+    Bring the server in line with INDEXES. Safe to run repeatedly: indexes
+    that already match are left alone. ``changed`` indexes are only dropped
+    and recreated when ``rebuild`` is set, ``extra`` ones only when
+    ``drop_extra`` is set.
+
+    Returns ``(collection, name, status, action, error)`` per index. An
+    index the server refuses to build (e.g. a unique index over duplicate
+    values) does not stop the others; its ``error`` is the server's message.
+    """
+    report = []
+    for collection, name, status in diff_indexes(db, collections):
+        action = None
+        if status == 'missing':
+            action = 'create'
+        elif status == 'changed' and rebuild:
+            action = 'rebuild'
+        elif status == 'extra' and drop_extra:
+            action = 'drop'
+
+        error = None
+        if action and not dry_run:
+            coll = db[collection]
+            try:
+                if action in ('rebuild', 'drop'):
+                    coll.drop_index(name)
+                if action in ('create', 'rebuild'):
+                    model = next(m for m in declared_indexes(db, collection)
+                                 if m.document['name'] == name)
+                    coll.create_indexes([model])
+            except OperationFailure as exc:
+                error = str(exc.details.get('errmsg') if exc.details else exc)
+        report.append((collection, name, status, action, error))
+    return report
+
+
+def _winning_stages(plan):
+    stages = [plan.get('stage')]
+    for child in ('inputStage', 'queryPlan'):
+        if child in plan:
+            stages.extend(_winning_stages(plan[child]))
+    for child in plan.get('inputStages', []):
+        stages.extend(_winning_stages(child))
+    return stages
+
+
+def uses_collection_scan(db, collection, query, sort=None):
+    cursor = db[collection].find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+    return 'COLLSCAN' in _winning_stages(plan)
+
+
+def collection_scans(db):
+    """Return the HOT_QUERIES whose winning plan is a collection scan."""
+    scans = []
+    for collection, query, sort in HOT_QUERIES:
+        try:
+            if uses_collection_scan(db, collection, query, sort):
+                scans.append((collection, query, sort))
+        except OperationFailure:
+            continue
+    return scans
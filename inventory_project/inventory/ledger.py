@@ -0,0 +1,307 @@
+"""
+Stock ledger: snapshots, point-in-time stock and verification.
+
+``inventory_stocktransaction`` is the ledger. Every change to a product's
+``stock_quantity`` is one entry (see stock.py) carrying the product's next
+``sequence`` number, its signed effect on stock (IN and ADJ add, OUT
+subtracts) and the resulting ``balance``. Entries are only ever appended.
+
+``take_snapshots`` stores ``{product_id, taken_at, sequence, stock}`` in
+``inventory_stock_snapshots`` for every product whose ledger moved since
+its last snapshot; run ``manage.py snapshot_stock`` periodically (e.g.
+hourly from cron). Snapshots bound the work of the readers:
+
+* ``as_of`` reconstructs stock at any moment from the latest snapshot
+  before it, replaying only the entries after that snapshot; without one
+  it starts from the next snapshot (or the live stock) and replays
+  backwards. Both scans are ``(product_id, sequence)`` index ranges
+  summed on the server.
+* ``verify`` recomputes current stock from the last snapshot (or, with
+  ``full``, from the first entry) in parallel batches and reports
+  products whose stock, sequence numbers or last balance disagree with
+  their ledger.
+
+Entries moved to the archive (see archive.py) are read back from there
+when an as-of moment or a full verification reaches into the archived
+range.
+
+Entries are ordered by sequence; ``transaction_date`` is taken just before
+the write, so as-of results are exact up to movements made within the
+same few milliseconds.
+
+Settings live in INVENTORY_LEDGER; see DEFAULTS.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from pymongo import UpdateOne
+
+from . import archive
+from .stock import ADJUSTMENT, OUTBOX, stock_delta
+
+SNAPSHOTS = 'inventory_stock_snapshots'
+
+DEFAULTS = {
+    # Products per snapshot round, as-of query and verifier batch
+    'BATCH_SIZE': 500,
+    # Verifier batches checked in parallel
+    'WORKERS': 4,
+}
+
+# Signed effect of an entry on stock, as stock.stock_delta computes it
+DELTA_EXPRESSION = {'$cond': [{'$in': ['$transaction_type', ['IN', ADJUSTMENT]]},
+                              '$quantity', {'$multiply': ['$quantity', -1]}]}
+
+
+def ledger_options():
+    """DEFAULTS overridden by settings.INVENTORY_LEDGER."""
+    return dict(DEFAULTS, **getattr(settings, 'INVENTORY_LEDGER', {}))
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def take_snapshots(db, batch_size=None):
+    """
+    Snapshot the stock of every product whose ledger moved since its last
+    snapshot. Returns the number of snapshots taken.
+    """
+    batch_size = batch_size or ledger_options()['BATCH_SIZE']
+    moved = db.inventory_product.find(
+        {'$expr': {'$ne': [{'$ifNull': ['$ledger_sequence', 0]},
+                           {'$ifNull': ['$ledger_snapshot_sequence', 0]}]}},
+        {'_id': 0, 'id': 1, 'stock_quantity': 1, 'ledger_sequence': 1},
+        batch_size=batch_size)
+    taken = 0
+    for products in _batches(moved, batch_size):
+        # One document read is consistent: stock is exactly the sum of the
+        # entries up to ledger_sequence, delivered from the outbox or not.
+        now = timezone.now()
+        db[SNAPSHOTS].insert_many([
+            {'product_id': p['id'], 'taken_at': now, 'sequence': p.get('ledger_sequence', 0),
+             'stock': p.get('stock_quantity', 0)}
+            for p in products])
+        db.inventory_product.bulk_write([
+            UpdateOne({'id': p['id']},
+                      {'$set': {'ledger_snapshot_sequence': p.get('ledger_sequence', 0)}})
+            for p in products], ordered=False)
+        taken += len(products)
+    return taken
+
+
+def _nearest_snapshots(db, product_ids, at=None, after=False):
+    """
+    ``{product_id: snapshot}`` with the latest snapshot taken at or before
+    ``at`` (or the latest of all), or with ``after`` the earliest one
+    taken after ``at``.
+    """
+    match = {'product_id': {'$in': list(product_ids)}}
+    if at is not None:
+        match['taken_at'] = {'$gt': at} if after else {'$lte': at}
+    return {
+        s['_id']: s['snapshot'] for s in db[SNAPSHOTS].aggregate([
+            {'$match': match},
+            {'$sort': {'product_id': 1, 'taken_at': 1 if after else -1}},
+            {'$group': {'_id': '$product_id', 'snapshot': {'$first': '$$ROOT'}}},
+        ])
+    }
+
+
+def _pending(db, products):
+    """
+    Outbox entries of ``products`` not yet in the transactions collection,
+    as ``{product_id: [entry, ...]}``. Normally empty.
+    """
+    entries = [e for p in products for e in p.get(OUTBOX, ()) if 'sequence' in e]
+    if not entries:
+        return {}
+    delivered = set(db.inventory_stocktransaction.distinct(
+        'id', {'id': {'$in': [e['id'] for e in entries]}}))
+    pending = {}
+    for entry in entries:
+        if entry['id'] not in delivered:
+            pending.setdefault(entry['product_id'], []).append(entry)
+    return pending
+
+
+def _sum_deltas(db, ranges):
+    """
+    ``{product_id: (delta, entries, last_sequence, last_balance)}`` over the
+    entries in ``ranges``, a list of ``(product_id, sequences, dates)``
+    query operator dicts; ``dates`` may be None.
+    """
+    branches = []
+    for product_id, sequences, dates in ranges:
+        branch = {'product_id': product_id, 'sequence': sequences}
+        if dates:
+            branch['transaction_date'] = dates
+        branches.append(branch)
+    if not branches:
+        return {}
+    return {
+        row['_id']: (row['delta'], row['entries'], row['last_sequence'], row['last_balance'])
+        for row in db.inventory_stocktransaction.aggregate([
+            {'$match': {'$or': branches}},
+            {'$sort': {'product_id': 1, 'sequence': 1}},
+            {'$group': {'_id': '$product_id', 'delta': {'$sum': DELTA_EXPRESSION},
+                        'entries': {'$sum': 1}, 'last_sequence': {'$last': '$sequence'},
+                        'last_balance': {'$last': '$balance'}}},
+        ])
+    }
+
+
+def _outside(db, products, cold_since=None, cold=False):
+    """
+    Entries of ``products`` that are not in the transactions collection:
+    undelivered outbox entries and, with ``cold``, archived entries from
+    ``cold_since`` on (see archive.py). ``{product_id: [entry, ...]}``.
+    """
+    entries = _pending(db, products)
+    if cold:
+        for entry in archive.cold_transactions(db, [p['id'] for p in products], cold_since):
+            if 'sequence' in entry:
+                entries.setdefault(entry['product_id'], []).append(entry)
+    return entries
+
+
+def _outside_delta(entries, sequences, test=lambda entry: True):
+    selected = [e for e in entries if sequences[0] < e['sequence'] <= sequences[1] and test(e)]
+    return sum(stock_delta(e['transaction_type'], e['quantity']) for e in selected), selected
+
+
+def _as_of_batch(db, at, products):
+    forward = _nearest_snapshots(db, [p['id'] for p in products], at)
+    backward = _nearest_snapshots(
+        db, [p['id'] for p in products if p['id'] not in forward], at, after=True)
+    # Archived entries are only read when ``at`` is in the archived range,
+    # from a day before the oldest snapshot replayed forward (clock slack).
+    at_utc = archive.utc_naive(at)
+    boundary = archive.archived_until(db)
+    outside = _outside(
+        db, products,
+        min([s['taken_at'] for s in forward.values()] + [at_utc]) - timedelta(days=1),
+        cold=boundary is not None and at_utc < boundary)
+
+    # Forward from the snapshot before ``at``: add the entries after it up
+    # to ``at``. Otherwise back from the next snapshot, or from the live
+    # stock: subtract the entries after ``at`` up to it.
+    ranges, bases = [], {}
+    for product in products:
+        pid = product['id']
+        if pid in forward:
+            snapshot = forward[pid]
+            sequences = (snapshot['sequence'], float('inf'))
+            ranges.append((pid, {'$gt': snapshot['sequence']}, {'$lte': at}))
+            bases[pid] = (snapshot['stock'], 1, sequences)
+        else:
+            snapshot = backward.get(pid) or {'stock': product.get('stock_quantity', 0),
+                                             'sequence': product.get('ledger_sequence', 0)}
+            sequences = (0, snapshot['sequence'])
+            ranges.append((pid, {'$gt': 0, '$lte': snapshot['sequence']}, {'$gt': at}))
+            bases[pid] = (snapshot['stock'], -1, sequences)
+
+    sums = _sum_deltas(db, ranges)
+    stock = {}
+    for pid, (base, sign, sequences) in bases.items():
+        delta = sums[pid][0] if pid in sums else 0
+        delta += _outside_delta(
+            outside.get(pid, ()), sequences,
+            lambda e: (e['transaction_date'] <= at_utc) == (sign > 0))[0]
+        stock[pid] = base + sign * delta
+    return stock
+
+
+def as_of(db, at, product_ids=None, batch_size=None):
+    """
+    ``{product_id: stock}`` at the moment ``at`` for ``product_ids`` (default
+    all products). Products created after ``at`` are left out.
+    """
+    batch_size = batch_size or ledger_options()['BATCH_SIZE']
+    query = {'$or': [{'created_at': {'$lte': at}}, {'created_at': None}]}
+    if product_ids is not None:
+        query['id'] = {'$in': list(product_ids)}
+    products = db.inventory_product.find(
+        query, {'_id': 0, 'id': 1, 'stock_quantity': 1, 'ledger_sequence': 1, OUTBOX: 1},
+        batch_size=batch_size)
+    stock = {}
+    for batch in _batches(products, batch_size):
+        stock.update(_as_of_batch(db, at, batch))
+    return stock
+
+
+def verify_batch(db, products, full=False):
+    """
+    Drift reports for ``products`` (documents with id, sku, stock_quantity,
+    ledger_sequence and the outbox): one dict per product whose stock is
+    not what its ledger adds up to, whose ledger is missing sequence
+    numbers, or whose last entry's balance is not its stock.
+    """
+    snapshots = {} if full else _nearest_snapshots(db, [p['id'] for p in products])
+    # Archived entries are behind the snapshot archiving takes first.
+    outside = _outside(db, products, cold=full)
+    bases = {p['id']: snapshots.get(p['id'], {'stock': 0, 'sequence': 0}) for p in products}
+    sums = _sum_deltas(db, [(pid, {'$gt': base['sequence']}, None)
+                            for pid, base in bases.items()])
+
+    drift = []
+    for product in products:
+        pid = product['id']
+        base = bases[pid]
+        sequence = product.get('ledger_sequence', 0)
+        delta, entries, last_sequence, balance = sums.get(pid, (0, 0, base['sequence'], None))
+        outside_delta, selected = _outside_delta(outside.get(pid, ()),
+                                                 (base['sequence'], float('inf')))
+        delta += outside_delta
+        entries += len(selected)
+        for entry in selected:
+            if entry['sequence'] > (last_sequence or 0):
+                last_sequence, balance = entry['sequence'], entry['balance']
+
+        stock = product.get('stock_quantity', 0)
+        expected = base['stock'] + delta
+        missing = sequence - base['sequence'] - entries
+        if expected != stock or missing or (balance is not None and balance != stock):
+            drift.append({'product_id': pid, 'sku': product.get('sku'), 'stock': stock,
+                          'ledger_stock': expected, 'missing_entries': missing,
+                          'last_balance': balance, 'ledger_sequence': sequence})
+    return drift
+
+
+def verify(db, full=False, batch_size=None, workers=None, progress=None):
+    """
+    Check every product's stock against its ledger, ``batch_size`` products
+    per batch over ``workers`` threads. Products that drift are checked
+    once more, so movements made during the run are not reported. Returns
+    ``(products_checked, drift_reports)``.
+    """
+    options = ledger_options()
+    batch_size = batch_size or options['BATCH_SIZE']
+    fields = {'_id': 0, 'id': 1, 'sku': 1, 'stock_quantity': 1, 'ledger_sequence': 1, OUTBOX: 1}
+
+    def check(batch):
+        return len(batch), verify_batch(db, batch, full)
+
+    checked, suspects = 0, []
+    batches = _batches(db.inventory_product.find({}, fields, batch_size=batch_size), batch_size)
+    with ThreadPoolExecutor(max_workers=max(1, workers or options['WORKERS'])) as executor:
+        for count, drift in executor.map(check, batches):
+            checked += count
+            suspects.extend(drift)
+            if progress:
+                progress(checked)
+
+    drift = []
+    for batch in _batches([s['product_id'] for s in suspects], batch_size):
+        drift.extend(verify_batch(
+            db, list(db.inventory_product.find({'id': {'$in': batch}}, fields)), full))
+    return checked, drift
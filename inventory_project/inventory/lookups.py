@@ -0,0 +1,72 @@
+"""
+Cached category and supplier lookup tables.
+
+Product forms, the product list filter and the importer need the active
+categories/suppliers and name<->id maps on nearly every request. They are
+served from a TieredCache and invalidated by the category and supplier
+write views. Each read also checks the collection's version counter (one
+small query, as versioned_page does), so a write made by another process
+is seen at once rather than after LOCAL_TTL.
+"""
+from . import versions
+from .caching import tiered_cache
+
+cache = tiered_cache('lookups')
+
+CATEGORY_KEYS = ('categories', 'category_ids', 'category_names')
+SUPPLIER_KEYS = ('suppliers', 'supplier_ids', 'supplier_names')
+
+
+def _active(collection):
+    return [
+        {'id': d['id'], 'name': d['name']}
+        for d in collection.find({'active': True}, {'_id': 0, 'id': 1, 'name': 1}).sort('name', 1)
+        if d.get('id') and d.get('name')
+    ]
+
+
+def _load(db, collection, key, loader):
+    (version,), _ = versions.current(db, (collection,))
+    return cache.get_or_load(key, loader, version)
+
+
+def categories(db):
+    """Active categories as ``[{'id', 'name'}]`` sorted by name."""
+    return _load(db, versions.CATEGORIES, 'categories', lambda: _active(db.inventory_category))
+
+
+def suppliers(db):
+    """Active suppliers as ``[{'id', 'name'}]`` sorted by name."""
+    return _load(db, versions.SUPPLIERS, 'suppliers', lambda: _active(db.inventory_supplier))
+
+
+def category_ids(db):
+    """Category name -> id."""
+    return _load(db, versions.CATEGORIES, 'category_ids',
+                 lambda: {c['name']: c['id'] for c in categories(db)})
+
+
+def supplier_ids(db):
+    """Supplier name -> id."""
+    return _load(db, versions.SUPPLIERS, 'supplier_ids',
+                 lambda: {s['name']: s['id'] for s in suppliers(db)})
+
+
+def category_names(db):
+    """Category id -> name."""
+    return _load(db, versions.CATEGORIES, 'category_names',
+                 lambda: {c['id']: c['name'] for c in categories(db)})
+
+
+def supplier_names(db):
+    """Supplier id -> name."""
+    return _load(db, versions.SUPPLIERS, 'supplier_names',
+                 lambda: {s['id']: s['name'] for s in suppliers(db)})
+
+
+def invalidate_categories():
+    cache.invalidate(*CATEGORY_KEYS)
+
+
+def invalidate_suppliers():
+    cache.invalidate(*SUPPLIER_KEYS)
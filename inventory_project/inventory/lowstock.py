@@ -0,0 +1,41 @@
+"""
+Derived low-stock fields stored on every product.
+
+``stock_deficit`` (reorder_level - stock_quantity) and ``is_low_stock``
+(stock_quantity <= reorder_level) are written alongside stock and reorder
+level on every write path, so low-stock lookups are an index scan on a
+small partial index instead of an ``$expr`` comparison over every product.
+"""
+
+# Aggregation expressions for pipeline-style updates, evaluated against the
+# document after its stock/reorder level has been changed.
+LOW_STOCK_EXPRESSIONS = {
+    'stock_deficit': {'$subtract': [{'$ifNull': ['$reorder_level', 0]},
+                                    {'$ifNull': ['$stock_quantity', 0]}]},
+    'is_low_stock': {'$lte': [{'$ifNull': ['$stock_quantity', 0]},
+                              {'$ifNull': ['$reorder_level', 0]}]},
+}
+
+# Projection served entirely from the low_stock index.
+LOW_STOCK_PROJECTION = {'_id': 0, 'id': 1, 'name': 1, 'stock_quantity': 1,
+                        'reorder_level': 1, 'stock_deficit': 1}
+
+
+def low_stock_fields(product):
+    """The derived fields for a product dict about to be written."""
+    stock = product.get('stock_quantity') or 0
+    reorder_level = product.get('reorder_level') or 0
+    return {
+        'stock_deficit': reorder_level - stock,
+        'is_low_stock': stock <= reorder_level,
+    }
+
+
+def low_stock_products(db, limit=None):
+    """Active low-stock products, most severe first."""
+    cursor = db.inventory_product.find(
+        {'active': True, 'is_low_stock': True}, LOW_STOCK_PROJECTION
+    ).sort([('stock_deficit', -1), ('id', 1)])
+    if limit:
+        cursor = cursor.limit(limit)
+    return list(cursor)
@@ -0,0 +1,50 @@
+import csv
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.mongo import get_db
+from inventory.stock import apply_movements
+
+
+def read_lines(path):
+    # CSV with a header row (sku,transaction_type,quantity,notes), a JSON
+    # array, or one JSON object per line.
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            return list(csv.DictReader(f))
+        text = f.read()
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+class Command(BaseCommand):
+    help = 'Apply a batch of stock movements from a CSV, JSON or NDJSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--unordered', action='store_true',
+                            help='Apply every valid line instead of stopping at the first rejection.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        try:
+            lines = read_lines(options['path'])
+        except (OSError, ValueError) as exc:
+            raise CommandError(f'Could not read {options["path"]}: {exc}')
+
+        result = apply_movements(
+            get_db(), lines,
+            ordered=not options['unordered'],
+            batch_size=options['batch_size'],
+        )
+
+        for line in result['results']:
+            if line['status'] != 'applied':
+                detail = f' {line["errors"]}' if 'errors' in line else ''
+                self.stdout.write(self.style.WARNING(
+                    f'line {line["line"]} ({line["sku"]}): {line["status"]}{detail}'))
+        self.stdout.write(self.style.SUCCESS(
+            f'{result["applied"]} applied, {result["rejected"]} rejected in '
+            f'{result["elapsed_seconds"]}s ({result["movements_per_second"]} movements/s)'))
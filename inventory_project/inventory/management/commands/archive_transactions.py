@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory import archive
+from inventory.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = ('Move stock transactions of months older than the archive horizon out of '
+            'inventory_stocktransaction into monthly archive collections or compressed '
+            'NDJSON files. Rollups are kept; history pages read the archive when they '
+            'reach back that far. See inventory/archive.py.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horizon-days', type=int,
+                            help='Archive months that ended more than this many days ago '
+                                 '(default: INVENTORY_ARCHIVE["HORIZON_DAYS"]).')
+        parser.add_argument('--tier', choices=archive.TIERS,
+                            help='Where to put newly archived months '
+                                 '(default: INVENTORY_ARCHIVE["TIER"]).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the transactions that would be moved.')
+
+    def handle(self, *args, **options):
+        if options['horizon_days'] is not None and options['horizon_days'] < 0:
+            raise CommandError('--horizon-days must not be negative')
+        moved = archive.archive_transactions(
+            get_db(), options['horizon_days'], options['tier'], dry_run=options['dry_run'],
+            progress=lambda month, count: self.stdout.write(f'  {month}: {count}'))
+        verb = 'would be archived' if options['dry_run'] else 'archived'
+        self.stdout.write(self.style.SUCCESS(
+            f'{sum(moved.values())} transaction(s) in {len(moved)} month(s) {verb}.'))
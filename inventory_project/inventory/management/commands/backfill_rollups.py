@@ -0,0 +1,28 @@
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory import rollups
+from inventory.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the per-product day/hour stock movement rollups from '
+            'inventory_stocktransaction. Run it while stock movements are paused: '
+            'live increments landing in a bucket being rebuilt are overwritten.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only rebuild buckets from this date (YYYY-MM-DD).')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d').replace(
+                    tzinfo=timezone.utc)
+            except ValueError:
+                raise CommandError('--since must be YYYY-MM-DD')
+
+        counts = rollups.backfill(get_db(), since)
+        for granularity, count in counts.items():
+            self.stdout.write(self.style.SUCCESS(f'{granularity}: {count} buckets'))
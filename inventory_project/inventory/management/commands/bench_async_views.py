@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.bench import http_load, login_cookie, percentiles
+
+
+class Command(BaseCommand):
+    help = ('Compare throughput and latency of the sync views under WSGI with the async '
+            'views under ASGI. Start both servers against the same mongod first, e.g.\n'
+            '  gunicorn inventory_project.wsgi -w 4 -b 127.0.0.1:8000\n'
+            '  INVENTORY_ASYNC_VIEWS=1 uvicorn inventory_project.asgi:application '
+            '--workers 4 --port 8001')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wsgi', default='http://127.0.0.1:8000')
+        parser.add_argument('--asgi', default='http://127.0.0.1:8001')
+        parser.add_argument('--paths', default='/,/products/,/reports/stock/',
+                            help='Comma-separated paths, requested round-robin.')
+        parser.add_argument('--requests', type=int, default=1000)
+        parser.add_argument('--concurrency', default='8,32,128',
+                            help='Comma-separated client concurrency levels.')
+        parser.add_argument('--username', required=True,
+                            help='User to log in as (the views require login).')
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(c) for c in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--concurrency must be comma-separated integers')
+        paths = [p.strip() for p in options['paths'].split(',') if p.strip()]
+        headers = {'Cookie': login_cookie(options['username'])}
+
+        self.stdout.write(f'{"server":>6} {"conc":>5} {"req/s":>8} {"p50 ms":>8} '
+                          f'{"p95 ms":>8} {"p99 ms":>8} {"errors":>7}')
+        for concurrency in levels:
+            for label in ('wsgi', 'asgi'):
+                urls = [options[label].rstrip('/') + path for path in paths]
+                # Warm up connections, caches and the Mongo pools first.
+                http_load(urls, min(len(urls) * concurrency, 200), concurrency, headers)
+                timings, errors, elapsed = http_load(
+                    urls, options['requests'], concurrency, headers)
+                p = percentiles(timings)
+                line = (f'{label:>6} {concurrency:>5} {len(timings) / elapsed:>8.1f} '
+                        f'{p[50]:>8.1f} {p[95]:>8.1f} {p[99]:>8.1f} {errors:>7}')
+                self.stdout.write(self.style.WARNING(line) if errors else line)
@@ -0,0 +1,70 @@
+import random
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from inventory.bench import bench_database, measure
+from inventory.indexes import ensure_indexes
+from inventory.queries import attach_product_counts
+
+
+def per_row_counts(db, documents, field):
+    # The old per-row approach, kept here as the baseline.
+    for document in documents:
+        document['product_count'] = db.inventory_product.count_documents({
+            field: document['id'],
+            'active': True,
+        })
+
+
+class Command(BaseCommand):
+    help = ('Compare per-row count_documents with the grouped aggregation used by '
+            'category_list/supplier_list as the number of parents grows.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000',
+                            help='Comma-separated numbers of suppliers to seed.')
+        parser.add_argument('--products-per-parent', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the scratch database afterwards.')
+
+    def handle(self, *args, **options):
+        client, db, counter = bench_database('bench_counts')
+        try:
+            self.stdout.write(f'{"parents":>8} {"strategy":>10} {"round trips":>12} {"ms":>10}')
+            for size in [int(s) for s in options['sizes'].split(',')]:
+                self._seed(db, size, options['products_per_parent'])
+                suppliers = list(db.inventory_supplier.find({'active': True}))
+
+                for label, fn in (
+                    ('per-row', lambda: per_row_counts(db, suppliers, 'supplier_id')),
+                    ('grouped', lambda: attach_product_counts(db, suppliers, 'supplier_id')),
+                ):
+                    ms, trips = measure(fn, counter, options['repeat'])
+                    self.stdout.write(f'{size:>8} {label:>10} {trips:>12} {ms:>10.1f}')
+        finally:
+            if not options['keep']:
+                client.drop_database(db.name)
+            client.close()
+
+    def _seed(self, db, suppliers, per_supplier):
+        db.inventory_supplier.drop()
+        db.inventory_product.drop()
+        ensure_indexes(db, ['inventory_supplier', 'inventory_product'])
+        supplier_ids = [str(uuid.uuid4()) for _ in range(suppliers)]
+        db.inventory_supplier.insert_many(
+            [{'id': sid, 'name': f'Supplier {n}', 'active': True}
+             for n, sid in enumerate(supplier_ids)])
+        products = []
+        for sid in supplier_ids:
+            for _ in range(random.randint(0, per_supplier * 2)):
+                products.append({
+                    'id': str(uuid.uuid4()),
+                    'sku': uuid.uuid4().hex,
+                    'name': uuid.uuid4().hex[:12],
+                    'supplier_id': sid,
+                    'active': random.random() > 0.1,
+                })
+        if products:
+            db.inventory_product.insert_many(products)
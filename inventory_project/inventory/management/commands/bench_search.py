@@ -0,0 +1,104 @@
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from inventory.bench import bench_database, percentiles
+from inventory.indexes import ensure_indexes
+from inventory.search import product_search_fields, search_products
+
+ADJECTIVES = ['steel', 'brass', 'cordless', 'heavy', 'compact', 'industrial', 'red', 'blue',
+              'galvanised', 'precision', 'mini', 'outdoor', 'digital', 'hydraulic', 'flat']
+NOUNS = ['hammer', 'drill', 'wrench', 'bolt', 'washer', 'valve', 'hinge', 'cable', 'sander',
+         'clamp', 'bracket', 'gasket', 'ladder', 'pump', 'socket', 'screwdriver', 'saw']
+SUPPLIERS = ['Acme Tools', 'Northwind', 'Globex', 'Initech', 'Umbrella Supply', 'Stark Parts']
+
+
+def regex_search(db, text, limit):
+    # The old unanchored, case-insensitive search, kept here as the baseline.
+    return list(db.inventory_product.find({'active': True, '$or': [
+        {'name': {'$regex': text, '$options': 'i'}},
+        {'sku': {'$regex': text, '$options': 'i'}},
+    ]}).limit(limit))
+
+
+class Command(BaseCommand):
+    help = ('Seed a scratch catalogue and report p50/p99 search latency per query kind '
+            'for the tiered search against the old $regex search.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000000)
+        parser.add_argument('--queries', type=int, default=200,
+                            help='Queries per kind.')
+        parser.add_argument('--limit', type=int, default=50)
+        parser.add_argument('--skip-regex', action='store_true',
+                            help='Only time the new search (the baseline is slow at 1M).')
+        parser.add_argument('--reuse', action='store_true',
+                            help='Reuse an already seeded scratch database.')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the scratch database afterwards.')
+
+    def handle(self, *args, **options):
+        client, db, _ = bench_database('bench_search')
+        try:
+            if not (options['reuse'] and db.inventory_product.estimated_document_count()):
+                self._seed(db, options['products'])
+            queries = self._queries(db, options['queries'])
+
+            strategies = [('search', lambda q: search_products(db, q, limit=options['limit']))]
+            if not options['skip_regex']:
+                strategies.append(('regex', lambda q: regex_search(db, q, options['limit'])))
+
+            self.stdout.write(f'{"kind":>12} {"strategy":>8} {"p50 ms":>9} {"p99 ms":>9} '
+                              f'{"avg hits":>9}')
+            for kind, texts in queries.items():
+                for label, fn in strategies:
+                    timings, hits = [], 0
+                    for text in texts:
+                        start = time.perf_counter()
+                        hits += len(fn(text))
+                        timings.append((time.perf_counter() - start) * 1000)
+                    p = percentiles(timings, (50, 99))
+                    self.stdout.write(f'{kind:>12} {label:>8} {p[50]:>9.2f} {p[99]:>9.2f} '
+                                      f'{hits / len(texts):>9.1f}')
+        finally:
+            if not options['keep']:
+                client.drop_database(db.name)
+            client.close()
+
+    def _seed(self, db, count):
+        db.inventory_product.drop()
+        batch = []
+        for n in range(count):
+            product = {
+                'id': str(uuid.uuid4()),
+                'sku': f'{random.choice(NOUNS)[:3].upper()}-{n:07d}',
+                'name': f'{random.choice(ADJECTIVES).title()} {random.choice(NOUNS)} {n % 500}',
+                'supplier': random.choice(SUPPLIERS),
+                'description': ' '.join(random.choices(ADJECTIVES + NOUNS, k=8)),
+                'active': random.random() > 0.05,
+            }
+            product.update(product_search_fields(product))
+            batch.append(product)
+            if len(batch) >= 10000:
+                db.inventory_product.insert_many(batch, ordered=False)
+                batch = []
+                self.stdout.write(f'seeded {n + 1}', ending='\r')
+        if batch:
+            db.inventory_product.insert_many(batch, ordered=False)
+        self.stdout.write(f'seeded {count} products; building indexes')
+        ensure_indexes(db, ['inventory_product'])
+
+    def _queries(self, db, n):
+        sample = list(db.inventory_product.aggregate([
+            {'$match': {'active': True}}, {'$sample': {'size': n}},
+            {'$project': {'sku': 1, 'name': 1}},
+        ]))
+        return {
+            'exact_sku': [p['sku'] for p in sample],
+            'sku_prefix': [p['sku'][:6] for p in sample],
+            'name_prefix': [p['name'][:5] for p in sample],
+            'word': [random.choice(NOUNS) for _ in sample],
+            'two_words': [f'{random.choice(ADJECTIVES)} {random.choice(NOUNS)}' for _ in sample],
+        }
@@ -0,0 +1,96 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from inventory import archive, rollups, timeseries
+from inventory.bench import bench_database, measure, storage_stats
+from inventory.indexes import ensure_indexes
+from inventory.synthetic import iter_transactions
+
+MB = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = ('Load the same synthetic stock transactions into a regular and a time-series '
+            'inventory_stocktransaction and compare storage size, insert throughput, '
+            'the 30-day top sellers aggregation stock_report used to run over raw '
+            'transactions and the first product history page.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transactions', type=int, default=500000)
+        parser.add_argument('--products', type=int, default=5000)
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Transactions per insert_many.')
+        parser.add_argument('--single-inserts', type=int, default=2000,
+                            help='Transactions then inserted one at a time, as stock '
+                                 'movements write them.')
+        parser.add_argument('--granularity', choices=timeseries.GRANULARITIES,
+                            help='Time-series bucket granularity '
+                                 '(default: INVENTORY_TIMESERIES["GRANULARITY"]).')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the scratch databases afterwards.')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        self.stdout.write(f'{"layout":>10} {"bulk/s":>9} {"single/s":>9} {"data MB":>9} '
+                          f'{"disk MB":>9} {"index MB":>9} {"top 30d ms":>11} '
+                          f'{"history ms":>11}')
+        for layout in timeseries.LAYOUTS:
+            client, db, counter = bench_database(f'bench_layout_{layout}')
+            try:
+                row = self._run(db, counter, layout, now, options)
+            finally:
+                if not options['keep']:
+                    client.drop_database(db.name)
+                client.close()
+            self.stdout.write(
+                f'{layout:>10} {row["bulk"]:>9.0f} {row["single"]:>9.0f} '
+                f'{row["size"] / MB:>9.1f} {row["storageSize"] / MB:>9.1f} '
+                f'{row["totalIndexSize"] / MB:>9.1f} {row["top_ms"]:>11.1f} '
+                f'{row["history_ms"]:>11.1f}')
+
+    def _run(self, db, counter, layout, now, options):
+        # The same seed gives both layouts the same catalogue and movements.
+        rng = random.Random(options['seed'])
+        products = [{'id': str(uuid.UUID(int=rng.getrandbits(128))), 'name': f'Product {n}',
+                     'price': round(rng.uniform(1, 500), 2)}
+                    for n in range(options['products'])]
+        movements = [t for t, _ in iter_transactions(
+            rng, products, options['transactions'] + options['single_inserts'], now)]
+        bulk, single = (movements[:options['transactions']],
+                        movements[options['transactions']:])
+
+        db.inventory_product.drop()
+        db.inventory_product.insert_many([dict(p, active=True) for p in products])
+        db.inventory_stocktransaction.drop()
+        timeseries.create_transactions(db, layout, options['granularity'])
+        ensure_indexes(db, ['inventory_product', 'inventory_stocktransaction'])
+
+        start = time.perf_counter()
+        for offset in range(0, len(bulk), options['batch_size']):
+            db.inventory_stocktransaction.insert_many(
+                bulk[offset:offset + options['batch_size']], ordered=False)
+        bulk_rate = len(bulk) / max(time.perf_counter() - start, 1e-9)
+
+        start = time.perf_counter()
+        for transaction in single:
+            db.inventory_stocktransaction.insert_one(transaction)
+        single_rate = len(single) / max(time.perf_counter() - start, 1e-9) if single else 0
+
+        pipeline = rollups.raw_top_products_pipeline(now - timedelta(days=30))
+        top_ms, _ = measure(lambda: list(db.inventory_stocktransaction.aggregate(pipeline)),
+                            counter, options['repeat'])
+        busiest = next(iter(db.inventory_stocktransaction.aggregate(pipeline)), None)
+        history_ms = 0.0
+        if busiest:
+            history_ms, _ = measure(lambda: archive.history(db, busiest['_id']),
+                                    counter, options['repeat'])
+
+        return dict(storage_stats(db.inventory_stocktransaction), bulk=bulk_rate,
+                    single=single_rate, top_ms=top_ms, history_ms=history_ms)
@@ -0,0 +1,234 @@
+import json
+import logging
+import statistics
+import time
+from contextlib import ExitStack
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from inventory import lookups
+from inventory.bench import (bench_database, bench_session_cookie, bench_settings, client_load,
+                             compare_runs, http_load, login_cookie, mongomock_client,
+                             percentiles)
+from inventory.indexes import ensure_indexes
+from inventory.mongo import get_db, override_database
+from inventory.synthetic import default_sizes, seed_inventory
+
+ENDPOINTS = ('dashboard', 'product_list', 'product_detail_post', 'stock_report',
+             'supplier_detail', 'category_list')
+
+# Distinct targets per endpoint, requested round-robin.
+TARGETS = 20
+
+
+class Command(BaseCommand):
+    help = ('Seed synthetic catalogues of increasing size and report throughput, p50/p95/p99 '
+            'latency and Mongo commands per request for the main views, driven through the '
+            'Django test client against a scratch database (or mongomock), or over HTTP '
+            'against a running server with --url. Results can be saved with --output and '
+            'compared with an earlier run with --baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='1000,10000,100000',
+                            help='Comma-separated product counts to seed and measure.')
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS),
+                            help=f'Comma-separated subset of: {", ".join(ENDPOINTS)}.')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Timed requests per endpoint, scale and concurrency.')
+        parser.add_argument('--concurrency', default='1,8',
+                            help='Comma-separated client concurrency levels.')
+        parser.add_argument('--transactions-per-product', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--mongomock', action='store_true',
+                            help='Seed and query an in-memory mongomock database instead of '
+                                 'mongod. Command counts are not available.')
+        parser.add_argument('--url',
+                            help='Load a running server over HTTP instead. Its own database '
+                                 'is used as it is (nothing is seeded); requires --username.')
+        parser.add_argument('--username', help='User to log in as with --url.')
+        parser.add_argument('--no-response-cache', action='store_true',
+                            help='Disable the rendered page cache (ETags are still sent).')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--baseline', help='Compare against results from an earlier run.')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Relative change in p95 or throughput counted as a '
+                                 'regression (default 0.2).')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the scratch database afterwards.')
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(s) for s in options['scales'].split(',')]
+            levels = [int(c) for c in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--scales and --concurrency must be comma-separated integers')
+        endpoints = [e.strip() for e in options['endpoints'].split(',') if e.strip()]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f'Unknown endpoints: {", ".join(sorted(unknown))}')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+
+        overrides = {}
+        if options['no_response_cache']:
+            overrides['INVENTORY_RESPONSE_CACHE'] = {'ENABLED': False}
+
+        self.stdout.write(f'{"mode":>6} {"scale":>8} {"endpoint":>20} {"conc":>5} {"req/s":>8} '
+                          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"cmds":>5} {"errors":>7}')
+        # Keep slow query and collection scan warnings, not a line per request.
+        request_log = logging.getLogger('inventory.profiling')
+        level = request_log.level
+        request_log.setLevel(logging.WARNING)
+        try:
+            with override_settings(**overrides):
+                if options['url']:
+                    results = self._run_http(endpoints, levels, options)
+                else:
+                    results = self._run_client(scales, endpoints, levels, options)
+        finally:
+            request_log.setLevel(level)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'created_at': time.time(), 'options': {
+                    k: options[k] for k in ('scales', 'requests', 'concurrency', 'seed',
+                                            'mongomock', 'url', 'no_response_cache')
+                }, 'results': results}, f, indent=2)
+            self.stdout.write(f'results written to {options["output"]}')
+
+        if baseline is not None:
+            regressions = compare_runs(baseline, results, options['threshold'])
+            for row, metric, old, new in regressions:
+                self.stdout.write(self.style.WARNING(
+                    f'regression: {row["mode"]} {row["scale"]} {row["endpoint"]} '
+                    f'x{row["concurrency"]} {metric} {old} -> {new}'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} regression(s) against '
+                                   f'{options["baseline"]}')
+            self.stdout.write(self.style.SUCCESS(f'no regressions against {options["baseline"]}'))
+
+    def _run_client(self, scales, endpoints, levels, options):
+        results = []
+        with ExitStack() as stack:
+            if options['mongomock']:
+                try:
+                    client = mongomock_client()
+                except ImportError:
+                    raise CommandError('--mongomock needs the mongomock package')
+                db = client['inventory_bench_views']
+                # mongomock has no replica set, so no multi-document transactions.
+                stack.enter_context(override_settings(INVENTORY_USE_TRANSACTIONS=False))
+            else:
+                bench_client, db, _ = bench_database('bench_views')
+                stack.callback(self._drop, bench_client, db.name, options['keep'])
+                # Views keep using the process client, with its profiler.
+                client = None
+            stack.enter_context(override_database(db.name, client))
+            stack.enter_context(override_settings(**bench_settings()))
+            session_cookie = bench_session_cookie()
+
+            for scale in scales:
+                sizes = default_sizes(scale)
+                counts = seed_inventory(
+                    get_db(), scale, sizes['categories'], sizes['suppliers'],
+                    scale * options['transactions_per_product'], seed=options['seed'],
+                    progress=lambda what, n: self.stdout.write(f'seeded {n} {what}',
+                                                               ending='\r'))
+                if not options['mongomock']:
+                    ensure_indexes(get_db())
+                lookups.cache.clear()
+                self.stdout.write(f'seeded {counts}'.ljust(40))
+
+                requests = self._requests(get_db())
+                for endpoint in endpoints:
+                    for concurrency in levels:
+                        # Warm up caches and connections first.
+                        client_load(requests[endpoint], min(TARGETS, options['requests']),
+                                    concurrency, session_cookie)
+                        timings, errors, elapsed, commands = client_load(
+                            requests[endpoint], options['requests'], concurrency,
+                            session_cookie)
+                        if options['mongomock']:
+                            # mongomock sends no command events to count.
+                            commands = []
+                        results.append(self._report('client', scale, endpoint, concurrency,
+                                                    timings, errors, elapsed, commands))
+        return results
+
+    def _run_http(self, endpoints, levels, options):
+        if not options['username']:
+            raise CommandError('--url needs --username')
+        headers = {'Cookie': login_cookie(options['username'])}
+        base = options['url'].rstrip('/')
+        requests = {
+            endpoint: [(base + entry[0], entry[1]) if isinstance(entry, tuple) else base + entry
+                       for entry in entries]
+            for endpoint, entries in self._requests(get_db()).items()
+        }
+        results = []
+        for endpoint in endpoints:
+            for concurrency in levels:
+                http_load(requests[endpoint], min(TARGETS, options['requests']), concurrency,
+                          headers)
+                timings, errors, elapsed = http_load(requests[endpoint], options['requests'],
+                                                     concurrency, headers)
+                results.append(self._report('http', 'live', endpoint, concurrency, timings,
+                                            errors, elapsed, []))
+        return results
+
+    def _requests(self, db):
+        """Per endpoint, the paths (or POST path/data pairs) to request."""
+        # Popular products and suppliers, as real traffic would favour them.
+        products = list(db.inventory_product.find(
+            {'active': True}, {'_id': 0, 'id': 1, 'sku': 1}).sort('stock_quantity', -1)
+            .limit(TARGETS))
+        suppliers = list(db.inventory_supplier.find(
+            {'active': True}, {'_id': 0, 'id': 1}).limit(TARGETS))
+        if not products or not suppliers:
+            raise CommandError('The database has no active products or suppliers')
+        movements = []
+        for product in products:
+            # IN then OUT of the same quantity keeps stock levels steady.
+            for transaction_type in ('IN', 'OUT'):
+                movements.append((reverse('product_detail', args=[product['id']]), {
+                    'product': product['sku'], 'transaction_type': transaction_type,
+                    'quantity': 1, 'notes': 'bench'}))
+        return {
+            'dashboard': [reverse('dashboard')],
+            'product_list': [reverse('product_list')],
+            'product_detail_post': movements,
+            'stock_report': [f'{reverse("stock_report")}?days={days}' for days in (7, 30, 90)],
+            'supplier_detail': [reverse('supplier_detail', args=[s['id']]) for s in suppliers],
+            'category_list': [reverse('category_list')],
+        }
+
+    def _report(self, mode, scale, endpoint, concurrency, timings, errors, elapsed, commands):
+        p = percentiles(timings)
+        row = {
+            'mode': mode,
+            'scale': scale,
+            'endpoint': endpoint,
+            'concurrency': concurrency,
+            'requests': len(timings),
+            'errors': errors,
+            'rps': round(len(timings) / elapsed, 1) if elapsed else None,
+            'p50': round(p[50], 2),
+            'p95': round(p[95], 2),
+            'p99': round(p[99], 2),
+            'commands': statistics.median(commands) if commands else None,
+        }
+        commands_column = '-' if row['commands'] is None else f'{row["commands"]:g}'
+        line = (f'{mode:>6} {scale:>8} {endpoint:>20} {concurrency:>5} {row["rps"]:>8.1f} '
+                f'{row["p50"]:>8.1f} {row["p95"]:>8.1f} {row["p99"]:>8.1f} '
+                f'{commands_column:>5} {errors:>7}')
+        self.stdout.write(self.style.WARNING(line) if errors else line)
+        return row
+
+    def _drop(self, client, name, keep):
+        if not keep:
+            client.drop_database(name)
+        client.close()
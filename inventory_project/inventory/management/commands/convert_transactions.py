@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory import timeseries
+from inventory.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = ('Convert inventory_stocktransaction between a regular and a MongoDB '
+            'time-series collection, copying every transaction and rebuilding its '
+            'indexes. Stop the app first and restart it afterwards; see '
+            'inventory/timeseries.py.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=timeseries.LAYOUTS, required=True)
+        parser.add_argument('--granularity', choices=timeseries.GRANULARITIES,
+                            help='Bucket granularity of a new time-series collection '
+                                 '(default: INVENTORY_TIMESERIES["GRANULARITY"]).')
+        parser.add_argument('--drop-backup', action='store_true',
+                            help='Drop the regular collection kept by converting to '
+                                 'time-series.')
+
+    def handle(self, *args, **options):
+        db = get_db()
+        before = timeseries.layout(db)
+        try:
+            copied = timeseries.convert(
+                db, options['to'], drop_backup=options['drop_backup'],
+                granularity=options['granularity'],
+                progress=lambda count: self.stdout.write(f'  {count} copied'))
+        except timeseries.ConversionError as exc:
+            raise CommandError(str(exc))
+        if before == options['to'] and not copied:
+            self.stdout.write(self.style.WARNING(
+                f'inventory_stocktransaction already is {options["to"]}.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'{copied} transaction(s) copied; inventory_stocktransaction is now '
+                f'{options["to"]}.'))
+        if options['to'] == 'timeseries' and not options['drop_backup']:
+            self.stdout.write(f'The regular collection is kept as {timeseries.BACKUP}.')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from inventory.mongo import get_db
+from inventory.stock import drain_outbox
+
+
+class Command(BaseCommand):
+    help = ('Copy stock transactions left in product outboxes by interrupted '
+            'movements into inventory_stocktransaction.')
+
+    def handle(self, *args, **options):
+        drained = drain_outbox(get_db())
+        self.stdout.write(self.style.SUCCESS(f'Delivered {drained} pending transaction(s).'))
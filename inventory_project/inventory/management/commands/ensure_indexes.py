@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.indexes import INDEXES, collection_scans, ensure_indexes
+from inventory.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = 'Create the indexes declared in inventory.indexes and report any drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('collections', nargs='*',
+                            help='Limit to these collections (default: all).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only show what would change.')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Drop and recreate indexes whose definition changed.')
+        parser.add_argument('--drop-extra', action='store_true',
+                            help='Drop indexes that are not declared.')
+        parser.add_argument('--explain', action='store_true',
+                            help='Afterwards, explain the hot queries and flag collection scans.')
+
+    def handle(self, *args, **options):
+        unknown = set(options['collections']) - set(INDEXES)
+        if unknown:
+            raise CommandError(f'No indexes declared for: {", ".join(sorted(unknown))}')
+
+        db = get_db()
+        report = ensure_indexes(
+            db,
+            collections=options['collections'] or None,
+            rebuild=options['rebuild'],
+            drop_extra=options['drop_extra'],
+            dry_run=options['dry_run'],
+        )
+
+        failed = []
+        for collection, name, status, action, error in report:
+            line = f'{collection}.{name}: {status}'
+            if error:
+                failed.append(f'{collection}.{name}')
+                self.stdout.write(self.style.ERROR(f'{line} -> {action} failed: {error}'))
+            elif action:
+                line += f' -> {"would " if options["dry_run"] else ""}{action}'
+                self.stdout.write(self.style.SUCCESS(line))
+            elif status == 'ok':
+                self.stdout.write(line)
+            else:
+                self.stdout.write(self.style.WARNING(line))
+
+        if options['explain']:
+            scans = collection_scans(db)
+            for collection, query, sort in scans:
+                self.stdout.write(self.style.WARNING(
+                    f'COLLSCAN: {collection} {query} sort={sort}'))
+            if not scans:
+                self.stdout.write(self.style.SUCCESS('All hot queries use an index.'))
+
+        if failed:
+            raise CommandError(
+                f'Could not build {", ".join(failed)}. Fix the documents the server '
+                f'reported (e.g. duplicate values of a unique index) and run this again.')
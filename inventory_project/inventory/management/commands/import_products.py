@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.importer import FORMATS, detect_format, import_products, iter_rows
+from inventory.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = 'Stream products from a CSV or NDJSON file and upsert them by SKU.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='Defaults to the file extension (.ndjson/.jsonl, else CSV).')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--rejects',
+                            help='Write every rejected or skipped row to this NDJSON file.')
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or detect_format(options['path'])
+        rejects_file = open(options['rejects'], 'w', encoding='utf-8') if options['rejects'] else None
+
+        def on_reject(row_number, sku, errors):
+            if rejects_file:
+                rejects_file.write(json.dumps({'row': row_number, 'sku': sku, 'errors': errors}) + '\n')
+
+        def progress(report):
+            self.stdout.write(
+                f'{report.processed} rows, {report.inserted} inserted, {report.updated} updated, '
+                f'{report.rejected} rejected, {report.skipped} skipped '
+                f'({report.rows_per_second} rows/s)')
+
+        try:
+            with open(options['path'], newline='', encoding='utf-8') as stream:
+                report = import_products(
+                    get_db(), iter_rows(stream, fmt),
+                    chunk_size=options['chunk_size'],
+                    progress=progress,
+                    on_reject=on_reject,
+                )
+        except OSError as exc:
+            raise CommandError(str(exc))
+        finally:
+            if rejects_file:
+                rejects_file.close()
+
+        for reject in report.rejects:
+            self.stdout.write(self.style.WARNING(
+                f'row {reject["row"]} ({reject["sku"]}): {reject["errors"]}'))
+        if report.rejected + report.skipped > len(report.rejects):
+            self.stdout.write(self.style.WARNING(
+                f'... {report.rejected + report.skipped - len(report.rejects)} more '
+                f'rejected or skipped rows'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {report.imported} of {report.processed} rows in '
+            f'{report.elapsed:.1f}s ({report.rows_per_second} rows/s).'))
@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from inventory import images
+from inventory.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = ('Move product images uploaded before content addressing into the image store, '
+            'generate the thumbnails of images whose variants are pending or failed, and '
+            'optionally delete image files no product uses.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Images resized in parallel.')
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate every variant, e.g. after changing SIZES.')
+        parser.add_argument('--prune', action='store_true',
+                            help='Delete unreferenced originals, variants and old uploads.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='With --prune, list the files instead of deleting them.')
+
+    def handle(self, *args, **options):
+        db = get_db()
+        adopted, missing = images.adopt_legacy(db)
+        if adopted or missing:
+            self.stdout.write(f'{adopted} legacy image(s) stored, {missing} missing')
+
+        todo = images.pending(db, options['force'])
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+            results = list(executor.map(
+                lambda item: images.process(db, *item, force=options['force']), todo.items()))
+        failed = results.count(None)
+        line = f'{len(results) - failed} image(s) processed, {failed} failed'
+        self.stdout.write(self.style.WARNING(line) if failed else self.style.SUCCESS(line))
+
+        if options['prune']:
+            removed = images.prune(db, dry_run=options['dry_run'])
+            for path in removed:
+                self.stdout.write(f'  {path}')
+            verb = 'would be removed' if options['dry_run'] else 'removed'
+            self.stdout.write(self.style.SUCCESS(f'{len(removed)} file(s) {verb}'))
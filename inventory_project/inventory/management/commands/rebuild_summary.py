@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.mongo import get_db
+from inventory.summary import check_summary, rebuild_summary
+
+
+class Command(BaseCommand):
+    help = 'Recompute the materialised dashboard summary, or check it for drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only compare the stored summary with the data; exit 1 on drift.')
+
+    def handle(self, *args, **options):
+        db = get_db()
+        if options['check']:
+            problems = check_summary(db)
+            for problem in problems:
+                self.stdout.write(self.style.WARNING(problem))
+            if problems:
+                raise CommandError('Summary is out of date; run "manage.py rebuild_summary".')
+            self.stdout.write(self.style.SUCCESS('Summary is consistent.'))
+            return
+
+        stats = rebuild_summary(db)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt summary: {stats["products_count"]} products, '
+            f'{stats["suppliers_count"]} suppliers, {stats["low_stock_count"]} low on stock.'))
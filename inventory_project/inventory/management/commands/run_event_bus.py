@@ -0,0 +1,52 @@
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory import events
+from inventory.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = ('Tail MongoDB change streams on the inventory collections and dispatch the '
+            'changes to the event subscribers (cache invalidation, rollups, derived fields, '
+            'reference names), resuming from the consumer\'s saved token. Needs a replica '
+            'set; see inventory/events.py.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', default='default',
+                            help='Name the resume token is saved under. Run subscribers in '
+                                 'separate processes by giving each its own consumer.')
+        parser.add_argument('--subscribers',
+                            help='Comma-separated subscriber names (default: '
+                                 'INVENTORY_EVENTS["SUBSCRIBERS"], or all).')
+        parser.add_argument('--from-now', action='store_true',
+                            help='Discard the saved resume token and start from the present.')
+        parser.add_argument('--resync', action='store_true',
+                            help='Run every subscriber\'s full resync before tailing.')
+        parser.add_argument('--until-idle', type=float,
+                            help='Exit once no change has arrived for this many seconds.')
+
+    def handle(self, *args, **options):
+        names = options['subscribers']
+        names = names.split(',') if names else events.event_options()['SUBSCRIBERS']
+        try:
+            subscribers = events.registered(names)
+        except KeyError as exc:
+            raise CommandError(exc.args[0])
+        if not subscribers:
+            raise CommandError('No subscribers to run')
+
+        db = get_db()
+        if options['from_now']:
+            db[events.OFFSETS].delete_one({'_id': options['consumer']})
+        bus = events.EventBus(db, subscribers, consumer=options['consumer'])
+        if options['resync']:
+            bus.resync()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: bus.stop())
+        self.stdout.write(f'{options["consumer"]}: {", ".join(s.name for s in subscribers)}')
+        stats = bus.run(until_idle=options['until_idle'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{stats["events"]} change(s) in {stats["batches"]} batch(es), '
+            f'{stats["retries"]} retries, {stats["resyncs"]} resync(s)'))
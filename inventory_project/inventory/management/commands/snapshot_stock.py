@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from inventory import ledger
+from inventory.mongo import get_db
+
+
+class Command(BaseCommand):
+    help = ('Snapshot the stock of every product whose ledger moved since its last '
+            'snapshot, bounding the replay behind point-in-time stock queries. Run it '
+            'periodically, e.g. hourly from cron; see inventory/ledger.py.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            help='Products per batch (default: INVENTORY_LEDGER["BATCH_SIZE"]).')
+
+    def handle(self, *args, **options):
+        taken = ledger.take_snapshots(get_db(), options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{taken} snapshot(s) taken.'))
@@ -0,0 +1,103 @@
+import random
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.bench import bench_database
+from inventory.indexes import ensure_indexes
+from inventory.stock import (InsufficientStock, apply_movement, drain_outbox,
+                             stock_delta)
+from inventory.timeseries import create_transactions
+
+
+class Command(BaseCommand):
+    help = ('Hammer a few products with concurrent IN/OUT movements and verify '
+            'that no update was lost and stock never went negative.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--movements', type=int, default=200,
+                            help='Movements per thread.')
+        parser.add_argument('--products', type=int, default=3)
+        parser.add_argument('--initial-stock', type=int, default=100)
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the scratch database afterwards.')
+
+    def handle(self, *args, **options):
+        client, db, _ = bench_database('bench_stress')
+        try:
+            self._run(db, options)
+        finally:
+            if not options['keep']:
+                client.drop_database(db.name)
+            client.close()
+
+    def _run(self, db, options):
+        db.inventory_product.drop()
+        db.inventory_stocktransaction.drop()
+        create_transactions(db)
+        ensure_indexes(db, ['inventory_product', 'inventory_stocktransaction'])
+
+        product_ids = [str(uuid.uuid4()) for _ in range(options['products'])]
+        db.inventory_product.insert_many([
+            {'id': pid, 'sku': pid, 'name': pid, 'active': True,
+             'stock_quantity': options['initial_stock']}
+            for pid in product_ids
+        ])
+
+        applied = {pid: 0 for pid in product_ids}
+        rejected = [0]
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            rng = random.Random()
+            for _ in range(options['movements']):
+                pid = rng.choice(product_ids)
+                transaction_type = 'OUT' if rng.random() < 0.6 else 'IN'
+                quantity = rng.randint(1, 10)
+                try:
+                    apply_movement(db, pid, transaction_type, quantity)
+                except InsufficientStock:
+                    with lock:
+                        rejected[0] += 1
+                    continue
+                except Exception as exc:
+                    with lock:
+                        errors.append(exc)
+                    return
+                with lock:
+                    applied[pid] += stock_delta(transaction_type, quantity)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if errors:
+            raise CommandError(f'{len(errors)} worker(s) failed: {errors[0]!r}')
+        drain_outbox(db)
+
+        total = options['threads'] * options['movements']
+        self.stdout.write(
+            f'{total} movements in {elapsed:.2f}s ({total / elapsed:.0f}/s), '
+            f'{rejected[0]} rejected for insufficient stock')
+
+        failures = []
+        for pid in product_ids:
+            stock = db.inventory_product.find_one({'id': pid})['stock_quantity']
+            expected = options['initial_stock'] + applied[pid]
+            ledger = sum(
+                stock_delta(t['transaction_type'], t['quantity'])
+                for t in db.inventory_stocktransaction.find({'product_id': pid})
+            )
+            if stock != expected or stock < 0 or ledger != applied[pid]:
+                failures.append(f'{pid}: stock={stock} expected={expected} ledger={ledger}')
+
+        if failures:
+            raise CommandError('Lost updates detected:\n' + '\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('No lost updates; stock never negative.'))
@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def backfill_low_stock(apps, schema_editor):
+    from inventory.mongo import get_db
+
+    # Frozen copy of lowstock.LOW_STOCK_EXPRESSIONS as of this migration.
+    get_db().inventory_product.update_many({}, [
+        {'$set': {
+            'stock_deficit': {'$subtract': [{'$ifNull': ['$reorder_level', 0]},
+                                            {'$ifNull': ['$stock_quantity', 0]}]},
+            'is_low_stock': {'$lte': [{'$ifNull': ['$stock_quantity', 0]},
+                                      {'$ifNull': ['$reorder_level', 0]}]},
+        }},
+    ])
+
+
+def remove_low_stock(apps, schema_editor):
+    from inventory.mongo import get_db
+
+    get_db().inventory_product.update_many(
+        {}, {'$unset': {'stock_deficit': '', 'is_low_stock': ''}})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_low_stock, remove_low_stock),
+    ]
@@ -0,0 +1,50 @@
+from django.db import migrations
+from pymongo import UpdateOne
+
+BATCH_SIZE = 1000
+
+
+def _normalise(value):
+    # Frozen copy of search.normalise as of this migration.
+    return ' '.join(str(value or '').split()).lower()[:100]
+
+
+def _backfill(collection, fields):
+    ops = []
+    for document in collection.find({}, {name: 1 for name in fields.values()}):
+        ops.append(UpdateOne({'_id': document['_id']}, {'$set': {
+            target: _normalise(document.get(source)) for target, source in fields.items()}}))
+        if len(ops) >= BATCH_SIZE:
+            collection.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+
+
+def backfill_search_fields(apps, schema_editor):
+    from inventory.mongo import get_db
+
+    db = get_db()
+    _backfill(db.inventory_product, {'search_name': 'name', 'search_sku': 'sku'})
+    _backfill(db.inventory_supplier, {'search_name': 'name', 'search_contact': 'contact_person',
+                                      'search_email': 'email'})
+
+
+def remove_search_fields(apps, schema_editor):
+    from inventory.mongo import get_db
+
+    db = get_db()
+    db.inventory_product.update_many({}, {'$unset': {'search_name': '', 'search_sku': ''}})
+    db.inventory_supplier.update_many(
+        {}, {'$unset': {'search_name': '', 'search_contact': '', 'search_email': ''}})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0002_backfill_low_stock'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_search_fields, remove_search_fields),
+    ]
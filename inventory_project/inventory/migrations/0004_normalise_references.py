@@ -0,0 +1,122 @@
+from bson.decimal128 import Decimal128
+from django.db import migrations
+from django.utils import timezone
+from pymongo import UpdateOne
+
+BATCH_SIZE = 1000
+
+COLLECTIONS = ('inventory_category', 'inventory_supplier', 'inventory_product',
+               'inventory_stocktransaction')
+# Reference field -> (collection, denormalised name field) as of this migration.
+PRODUCT_REFERENCES = {
+    'category_id': ('inventory_category', 'category'),
+    'supplier_id': ('inventory_supplier', 'supplier'),
+}
+
+
+def _canonical_id(value):
+    # Documents written through the djongo models have integer ids.
+    if value is None or value == '':
+        return None
+    return str(value)
+
+
+def _bulk(collection, documents, changes_for):
+    ops = []
+    changed = 0
+    for document in documents:
+        changes = changes_for(document)
+        if changes:
+            ops.append(UpdateOne({'_id': document['_id']}, {'$set': changes}))
+        if len(ops) >= BATCH_SIZE:
+            changed += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        changed += collection.bulk_write(ops, ordered=False).modified_count
+    return changed
+
+
+def _id_changes(document):
+    canonical = _canonical_id(document.get('id')) or str(document['_id'])
+    return {'id': canonical} if document.get('id') != canonical else {}
+
+
+def _names(db, collection):
+    # name -> id and id -> name, preferring active documents for duplicate names.
+    by_name, by_id = {}, {}
+    for document in db[collection].find({}, {'id': 1, 'name': 1, 'active': 1}).sort('active', 1):
+        if document.get('name'):
+            by_name[document['name']] = document['id']
+            by_id[document['id']] = document['name']
+    return by_name, by_id
+
+
+def normalise_references(apps, schema_editor):
+    from inventory.mongo import get_db
+
+    db = get_db()
+    # 1. Every document gets a string id; Mongo's _id is never a reference.
+    for collection in COLLECTIONS:
+        _bulk(db[collection], db[collection].find(
+            {'$or': [{'id': {'$exists': False}}, {'id': None}, {'id': ''},
+                     {'id': {'$not': {'$type': 'string'}}}]}, {'id': 1}), _id_changes)
+
+    # 2. Products reference categories and suppliers by id, with the name
+    #    alongside, and store prices as doubles.
+    lookups = {field: _names(db, collection)
+               for field, (collection, _) in PRODUCT_REFERENCES.items()}
+
+    def product_changes(product):
+        changes = {}
+        for field, (_, name_field) in PRODUCT_REFERENCES.items():
+            by_name, by_id = lookups[field]
+            reference = _canonical_id(product.get(field))
+            name = product.get(name_field)
+            if isinstance(name, dict):
+                # An embedded document left by an old $lookup.
+                reference = reference or _canonical_id(name.get('id'))
+                name = name.get('name')
+            if reference not in by_id and isinstance(name, str):
+                reference = by_name.get(name, reference)
+            if reference in by_id:
+                name = by_id[reference]
+            if reference != product.get(field):
+                changes[field] = reference
+            if name != product.get(name_field):
+                changes[name_field] = name
+        if isinstance(product.get('price'), Decimal128):
+            changes['price'] = float(product['price'].to_decimal())
+        return changes
+
+    fields = {'price': 1}
+    for field, (_, name_field) in PRODUCT_REFERENCES.items():
+        fields.update({field: 1, name_field: 1})
+    changed = _bulk(db.inventory_product, db.inventory_product.find({}, fields), product_changes)
+
+    # 3. Transactions reference products by their string id.
+    changed += _bulk(
+        db.inventory_stocktransaction,
+        db.inventory_stocktransaction.find(
+            {'product_id': {'$exists': True, '$not': {'$type': 'string'}}}, {'product_id': 1}),
+        lambda t: {'product_id': _canonical_id(t['product_id'])})
+
+    # Cached pages are keyed by collection versions (frozen copy of
+    # versions.bump as of this migration).
+    if changed:
+        now = timezone.now()
+        for collection in COLLECTIONS:
+            db.inventory_versions.update_one(
+                {'_id': collection}, {'$inc': {'version': 1}, '$set': {'updated_at': now}},
+                upsert=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0003_backfill_search_fields'),
+    ]
+
+    operations = [
+        # Only fills in and canonicalises references; nothing to undo.
+        migrations.RunPython(normalise_references, migrations.RunPython.noop),
+    ]
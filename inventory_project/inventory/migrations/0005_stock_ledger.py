@@ -0,0 +1,144 @@
+import uuid
+from itertools import groupby
+
+from bson import ObjectId
+from django.db import migrations
+from django.utils import timezone
+from pymongo import DESCENDING, InsertOne, UpdateOne
+
+BATCH_SIZE = 1000
+
+OUTBOX = 'pending_transactions'
+SNAPSHOTS = 'inventory_stock_snapshots'
+
+
+def _delta(transaction):
+    # Frozen copy of stock.stock_delta as of this migration.
+    quantity = transaction.get('quantity') or 0
+    return quantity if transaction.get('transaction_type') in ('IN', 'ADJ') else -quantity
+
+
+class _Writer:
+    """Batched bulk writes per collection."""
+
+    def __init__(self, db):
+        self.db = db
+        self.ops = {}
+
+    def add(self, collection, op):
+        ops = self.ops.setdefault(collection, [])
+        ops.append(op)
+        if len(ops) >= BATCH_SIZE:
+            self.flush(collection)
+
+    def flush(self, collection=None):
+        for name in [collection] if collection else list(self.ops):
+            if self.ops.get(name):
+                self.db[name].bulk_write(self.ops[name], ordered=False)
+            self.ops[name] = []
+
+
+def _deliver_outboxes(db):
+    # Movements still in product outboxes become transactions first
+    # (frozen copy of stock.drain_outbox as of this migration).
+    for product in db.inventory_product.find({f'{OUTBOX}.id': {'$exists': True}},
+                                             {'id': 1, OUTBOX: 1}):
+        entries = product[OUTBOX]
+        delivered = set(db.inventory_stocktransaction.distinct(
+            'id', {'id': {'$in': [e['id'] for e in entries]}}))
+        missing = [e for e in entries if e['id'] not in delivered]
+        if missing:
+            db.inventory_stocktransaction.insert_many(missing, ordered=False)
+        db.inventory_product.update_one({'_id': product['_id']}, {'$unset': {OUTBOX: ''}})
+
+
+def number_ledger(apps, schema_editor):
+    """
+    Give every product's existing transactions ledger sequence numbers and
+    balances, counting back from the current stock. Stock the transactions
+    do not account for (set on the product form or by an import) becomes an
+    opening adjustment at sequence 1. Each product then gets its first
+    snapshot.
+    """
+    from inventory.mongo import get_db
+
+    db = get_db()
+    _deliver_outboxes(db)
+    now = timezone.now()
+    writer = _Writer(db)
+
+    # Both sides in product id order, so each product's history is read
+    # once, newest first, along the product_history index.
+    histories = groupby(
+        db.inventory_stocktransaction.find(
+            {'product_id': {'$type': 'string'}, 'sequence': {'$exists': False}},
+            {'product_id': 1, 'transaction_type': 1, 'quantity': 1, 'transaction_date': 1},
+        ).sort([('product_id', 1), ('transaction_date', DESCENDING), ('_id', DESCENDING)]),
+        key=lambda t: t['product_id'])
+    current = next(histories, None)
+    products = db.inventory_product.find(
+        {'ledger_sequence': {'$exists': False}, 'id': {'$type': 'string'}},
+        {'id': 1, 'name': 1, 'stock_quantity': 1, 'created_at': 1}).sort('id', 1)
+
+    migrated = 0
+    for product in products:
+        while current is not None and current[0] < product['id']:
+            current = next(histories, None)
+        history = []
+        if current is not None and current[0] == product['id']:
+            history = list(current[1])
+            current = next(histories, None)
+
+        stock = product.get('stock_quantity') or 0
+        balances = []
+        balance = stock
+        for transaction in history:
+            balances.append(balance)
+            balance -= _delta(transaction)
+        opening = balance
+        sequence = len(history) + (1 if opening else 0)
+
+        for position, (transaction, balance) in enumerate(zip(history, balances)):
+            writer.add('inventory_stocktransaction', UpdateOne(
+                {'_id': transaction['_id']},
+                {'$set': {'sequence': sequence - position, 'balance': balance}}))
+        if opening:
+            # Dated when the product was created, or its ObjectId was made
+            created = product.get('created_at')
+            if created is None and isinstance(product['_id'], ObjectId):
+                created = product['_id'].generation_time.replace(tzinfo=None)
+            dates = [d for d in (created, history[-1].get('transaction_date') if history else None)
+                     if d]
+            writer.add('inventory_stocktransaction', InsertOne({
+                'id': str(uuid.uuid4()), 'product_id': product['id'],
+                'product': product.get('name'), 'transaction_type': 'ADJ',
+                'quantity': opening, 'notes': 'Opening stock', 'created_by_id': None,
+                'transaction_date': min(dates) if dates else now,
+                'sequence': 1, 'balance': opening,
+            }))
+        writer.add('inventory_product', UpdateOne(
+            {'_id': product['_id']},
+            {'$set': {'ledger_sequence': sequence, 'ledger_snapshot_sequence': sequence}}))
+        writer.add(SNAPSHOTS, InsertOne({'product_id': product['id'], 'taken_at': now,
+                                         'sequence': sequence, 'stock': stock}))
+        migrated += 1
+    writer.flush()
+
+    # Frozen copy of versions.bump as of this migration.
+    if migrated:
+        for collection in ('inventory_product', 'inventory_stocktransaction'):
+            db.inventory_versions.update_one(
+                {'_id': collection}, {'$inc': {'version': 1}, '$set': {'updated_at': now}},
+                upsert=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0004_normalise_references'),
+    ]
+
+    operations = [
+        # Only adds ledger fields and snapshots; nothing to undo.
+        migrations.RunPython(number_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,106 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.db import migrations
+from django.utils import timezone
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+BATCH_SIZE = 5000
+
+TRANSACTIONS = 'inventory_stocktransaction'
+BACKUP = 'inventory_stocktransaction_regular'
+
+# Frozen copy of timeseries.DEFAULTS as of this migration.
+DEFAULTS = {
+    'ENABLED': False,
+    'GRANULARITY': 'hours',
+    'META_FIELD': 'product_id',
+}
+
+# Frozen copy of indexes.TIMESERIES_INDEXES as of this migration.
+TIMESERIES_INDEXES = [
+    IndexModel([('product_id', ASCENDING), ('transaction_date', ASCENDING)],
+               name='product_id_1_transaction_date_1'),
+    IndexModel([('id', ASCENDING)], name='id'),
+    IndexModel([('product_id', ASCENDING), ('transaction_date', DESCENDING),
+                ('_id', DESCENDING)],
+               name='product_history'),
+    IndexModel([('transaction_type', ASCENDING), ('transaction_date', DESCENDING)],
+               name='type_by_date'),
+    IndexModel([('transaction_date', DESCENDING)], name='recent'),
+    IndexModel([('product_id', ASCENDING), ('sequence', ASCENDING)], name='ledger_sequence'),
+]
+
+
+def _copy(source, target):
+    batch = []
+    for document in source.find().batch_size(BATCH_SIZE):
+        if not isinstance(document.get('transaction_date'), datetime):
+            document['transaction_date'] = document['_id'].generation_time.replace(tzinfo=None)
+        batch.append(document)
+        if len(batch) >= BATCH_SIZE:
+            target.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        target.insert_many(batch, ordered=False)
+
+
+def to_timeseries(apps, schema_editor):
+    """
+    With INVENTORY_TIMESERIES['ENABLED'], move the stock transactions into
+    a time-series collection (frozen copy of timeseries.convert as of this
+    migration). The regular collection is kept as BACKUP; drop it with
+    "manage.py convert_transactions --to timeseries --drop-backup" once the
+    app runs on the new layout.
+    """
+    from inventory.mongo import get_db
+    from inventory.timeseries import forget
+
+    options = dict(DEFAULTS, **getattr(settings, 'INVENTORY_TIMESERIES', {}))
+    if not options['ENABLED']:
+        return
+    db = get_db()
+    info = next(db.list_collections(filter={'name': TRANSACTIONS}), None)
+    if info and info.get('type') == 'timeseries':
+        return
+    if db.list_collection_names(filter={'name': BACKUP}):
+        raise RuntimeError(f'{BACKUP} already exists; run "manage.py convert_transactions" '
+                           f'to finish an interrupted conversion')
+
+    if info:
+        db[TRANSACTIONS].rename(BACKUP)
+    db.create_collection(TRANSACTIONS, timeseries={
+        'timeField': 'transaction_date',
+        'metaField': options['META_FIELD'],
+        'granularity': options['GRANULARITY'],
+    })
+    # Not frozen: the system checks run by migrate cached the old layout
+    # in this process.
+    forget(db)
+    if info:
+        _copy(db[BACKUP], db[TRANSACTIONS])
+    # Indexes the server already made (metaField_timeField from 6.3 on)
+    # are left as they are.
+    existing = set(db[TRANSACTIONS].index_information())
+    missing = [index for index in TIMESERIES_INDEXES if index.document['name'] not in existing]
+    if missing:
+        db[TRANSACTIONS].create_indexes(missing)
+
+    # Frozen copy of versions.bump as of this migration.
+    db.inventory_versions.update_one(
+        {'_id': TRANSACTIONS},
+        {'$inc': {'version': 1}, '$set': {'updated_at': timezone.now()}},
+        upsert=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0005_stock_ledger'),
+    ]
+
+    operations = [
+        # The regular collection is kept as a backup; converting back is
+        # "manage.py convert_transactions --to regular".
+        migrations.RunPython(to_timeseries, migrations.RunPython.noop),
+    ]
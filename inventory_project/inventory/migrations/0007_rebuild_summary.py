@@ -0,0 +1,63 @@
+from django.db import migrations
+from django.utils import timezone
+
+SUMMARY_ID = 'inventory'
+
+
+def rebuild_summary(apps, schema_editor):
+    """
+    Build the dashboard summary from the data (frozen copy of
+    summary.compute_summary as of this migration). Deployments that ran
+    before it have no summary, or one with ``low_stock_ids`` instead of
+    ``low_stock_count``; the write paths only apply deltas to it.
+    """
+    from inventory.mongo import get_db
+
+    db = get_db()
+    categories = {
+        c['id']: {'name': c.get('name'), 'active': True, 'count': 0, 'value': 0.0}
+        for c in db.inventory_category.find({'active': True}, {'id': 1, 'name': 1})
+        if c.get('id')
+    }
+    pipeline = [
+        {'$match': {'active': True}},
+        {
+            '$group': {
+                '_id': '$category_id',
+                'count': {'$sum': 1},
+                'value': {'$sum': {'$multiply': [
+                    {'$ifNull': ['$stock_quantity', 0]}, {'$ifNull': ['$price', 0]}]}},
+            }
+        },
+    ]
+    products_count, total_value = 0, 0.0
+    for row in db.inventory_product.aggregate(pipeline):
+        products_count += row['count']
+        total_value += row['value']
+        if row['_id']:
+            entry = categories.setdefault(row['_id'], {'name': None, 'active': False})
+            entry['count'] = row['count']
+            entry['value'] = row['value']
+
+    db.inventory_summary.replace_one({'_id': SUMMARY_ID}, {
+        '_id': SUMMARY_ID,
+        'products_count': products_count,
+        'suppliers_count': db.inventory_supplier.count_documents({'active': True}),
+        'total_value': total_value,
+        'categories': categories,
+        'low_stock_count': db.inventory_product.count_documents(
+            {'active': True, 'is_low_stock': True}),
+        'updated_at': timezone.now(),
+    }, upsert=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0006_timeseries_transactions'),
+    ]
+
+    operations = [
+        # Rebuilding again with "manage.py rebuild_summary" is always safe.
+        migrations.RunPython(rebuild_summary, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,17 @@
+"""
+Table definitions for Django's migrations.
+
+The application reads and writes these collections with pymongo, in the
+document shapes defined in repository.py, not through these models.
+Saving a StockTransaction applies the movement with stock.apply_movement.
+"""
 from djongo import models
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 
+from . import repository
+from .mongo import get_db
+
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -73,16 +83,26 @@ class StockTransaction(models.Model):
         if self.quantity <= 0:
             raise ValidationError('Quantity must be greater than zero.')
 
-        if self.transaction_type == 'OUT' and self.product.stock_quantity < self.quantity:
+        # Advisory; apply_movement's guarded update is what enforces it.
+        product = repository.get(get_db(), 'product', str(self.product_id),
+                                 {'stock_quantity': 1})
+        if product is None:
+            raise ValidationError('Product not found.')
+        if self.transaction_type == 'OUT' and product.get('stock_quantity', 0) < self.quantity:
             raise ValidationError('Insufficient stock available.')
 
     def save(self, *args, **kwargs):
-        if self.transaction_type == 'IN':
-            self.product.stock_quantity += self.quantity
-        else:
-            self.product.stock_quantity -= self.quantity
-
-        self.product.save()
-        super().save(*args, **kwargs)
-
-
+        # Saving records a new movement through stock.apply_movement, which
+        # moves the stock and writes the transaction document in one atomic
+        # step. Transactions are never edited, so every save is a movement.
+        from .stock import InsufficientStock, ProductNotFound, apply_movement
+
+        try:
+            _, transaction = apply_movement(
+                get_db(), str(self.product_id), self.transaction_type, self.quantity,
+                user_id=self.created_by_id, notes=self.notes)
+        except ProductNotFound:
+            raise ValidationError('Product not found.')
+        except InsufficientStock as exc:
+            raise ValidationError(str(exc))
+        self.transaction_date = transaction['transaction_date']
@@ -0,0 +1,268 @@
+"""
+Process-local MongoDB access for the inventory views.
+
+The client is created lazily on first use and dropped again in a forked
+child, so gunicorn workers (including with --preload) each build their own
+connection pool instead of inheriting the master's sockets. Connection and
+pool options are read from settings.DATABASES['default'], using the same
+CLIENT dict djongo passes to MongoClient.
+
+``get_async_db`` is the Motor equivalent for the async views; Motor clients
+are bound to an event loop, so there is one per running loop.
+
+``override_database`` temporarily points all of this at another database
+(and optionally another client), e.g. a scratch database for benchmarks.
+"""
+import asyncio
+import os
+import threading
+import weakref
+from contextlib import contextmanager
+
+from django.conf import settings
+from pymongo import MongoClient, monitoring
+
+from .profiling import query_profiler
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_transaction_support = weakref.WeakKeyDictionary()
+_async_clients = {}
+_override = {}
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Counts pool events for this process so utilisation can be inspected."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.open = 0
+            self.in_use = 0
+            self.max_in_use = 0
+            self.waiting = 0
+            self.max_waiting = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.created = 0
+            self.closed = 0
+            self.clears = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'open': self.open,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'created': self.created,
+                'closed': self.closed,
+                'clears': self.clears,
+            }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.clears += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+            self.open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+            self.open = max(self.open - 1, 0)
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.waiting = max(self.waiting - 1, 0)
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.waiting = max(self.waiting - 1, 0)
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+
+pool_metrics = PoolMetrics()
+
+
+def client_options():
+    """MongoClient keyword arguments built from the default database settings."""
+    conf = settings.DATABASES['default']
+    options = dict(conf.get('CLIENT', {}))
+    options.setdefault('host', conf.get('HOST') or 'localhost')
+    options.setdefault('port', int(conf.get('PORT') or 27017))
+    return options
+
+
+def database_name():
+    if 'name' in _override:
+        return _override['name']
+    return settings.DATABASES['default'].get('NAME', 'inventory')
+
+
+@contextmanager
+def override_database(name, client=None):
+    """
+    Make ``db``/get_db() (and the async equivalents, for the name) use
+    database ``name``, and ``client`` instead of the process client if
+    given, until the block exits. Not thread-local: meant for benchmark
+    and maintenance commands, not for serving requests.
+    """
+    previous = dict(_override)
+    _override['name'] = name
+    if client is not None:
+        _override['client'] = client
+    try:
+        yield
+    finally:
+        _override.clear()
+        _override.update(previous)
+
+
+def get_client():
+    """Return this process's MongoClient, creating it on first use."""
+    global _client, _client_pid
+    if 'client' in _override:
+        return _override['client']
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            # A client inherited across fork is unusable; drop it without
+            # closing so the parent's sockets are left alone.
+            if _client_pid != pid:
+                pool_metrics.reset()
+            _client = MongoClient(
+                event_listeners=[pool_metrics, query_profiler], **client_options())
+            _client_pid = pid
+    return _client
+
+
+def get_db():
+    return get_client()[database_name()]
+
+
+def transactions_supported(client):
+    """
+    Whether multi-document transactions can be used with ``client``: the
+    server must be a replica set member or mongos, and
+    INVENTORY_USE_TRANSACTIONS must not be disabled. Cached per client.
+    """
+    if not getattr(settings, 'INVENTORY_USE_TRANSACTIONS', True):
+        return False
+    if client not in _transaction_support:
+        hello = client.admin.command('hello')
+        _transaction_support[client] = bool(
+            hello.get('setName') or hello.get('msg') == 'isdbgrid')
+    return _transaction_support[client]
+
+
+def get_async_client():
+    """Return the Motor client for the running event loop."""
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    loop = asyncio.get_running_loop()
+    key = (os.getpid(), id(loop))
+    entry = _async_clients.get(key)
+    if entry is None or entry[1] is not loop:
+        with _lock:
+            # Loops that have gone away (e.g. async views run under WSGI get
+            # a fresh loop per request) take their clients with them.
+            for stale in [k for k, (_, l) in _async_clients.items() if l.is_closed()]:
+                _async_clients.pop(stale)[0].close()
+            entry = (AsyncIOMotorClient(event_listeners=[query_profiler], **client_options()),
+                     loop)
+            _async_clients[key] = entry
+    return entry[0]
+
+
+def get_async_db():
+    return get_async_client()[database_name()]
+
+
+def close_client():
+    global _client, _client_pid
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def pool_stats():
+    """Pool utilisation for this process alongside the configured limits."""
+    options = client_options()
+    stats = pool_metrics.snapshot()
+    stats.update({
+        'pid': os.getpid(),
+        'connected': _client is not None and _client_pid == os.getpid(),
+        'max_pool_size': options.get('maxPoolSize', 100),
+        'min_pool_size': options.get('minPoolSize', 0),
+    })
+    return stats
+
+
+def _after_fork_in_child():
+    # Locks may have been held by another thread at fork time.
+    global _client, _client_pid, _lock
+    _lock = threading.Lock()
+    _client = None
+    _client_pid = None
+    _async_clients.clear()
+    pool_metrics.__init__()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class LazyDatabase:
+    """
+    Stand-in for a pymongo Database that resolves the process-local client
+    on every attribute access, so ``db.inventory_product`` keeps working at
+    module level without opening a connection at import time.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+    def __getitem__(self, name):
+        return get_db()[name]
+
+
+db = LazyDatabase()
@@ -0,0 +1,116 @@
+"""
+Keyset (range-based) pagination for raw pymongo queries.
+
+Instead of skip/limit, each page carries an opaque cursor holding the sort
+key of its last document, and the next page is fetched with a range
+condition on that key. Every page costs the same index walk no matter how
+deep into the collection it is.
+"""
+import base64
+import binascii
+from collections import namedtuple
+
+from bson import json_util
+from bson.errors import InvalidBSON
+from django.conf import settings
+from pymongo import ASCENDING
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    raw = json_util.dumps(values).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json_util.loads(raw.decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidBSON):
+        raise InvalidCursor(token)
+    if not isinstance(values, list):
+        raise InvalidCursor(token)
+    return values
+
+
+def page_size_from(request, param='page_size'):
+    default = getattr(settings, 'INVENTORY_PAGE_SIZE', 50)
+    maximum = getattr(settings, 'INVENTORY_MAX_PAGE_SIZE', 200)
+    try:
+        size = int(request.GET.get(param, default))
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, maximum))
+
+
+def _after(sort, values):
+    # Lexicographic "greater than" over the sort key, honouring direction:
+    # (a > va) or (a == va and b > vb) or ...
+    clauses = []
+    for i, (field, direction) in enumerate(sort):
+        clause = {prev: values[j] for j, (prev, _) in enumerate(sort[:i])}
+        clause[field] = {'$gt' if direction == ASCENDING else '$lt': values[i]}
+        clauses.append(clause)
+    return {'$or': clauses}
+
+
+def _keyset_query(query, sort, cursor):
+    if sort[-1][0] != '_id':
+        raise ValueError('keyset sort must end with _id')
+    if not cursor:
+        return query
+    values = decode_cursor(cursor)
+    if len(values) != len(sort):
+        raise InvalidCursor(cursor)
+    return {'$and': [query, _after(sort, values)]} if query else _after(sort, values)
+
+
+def _page(items, sort, page_size):
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor([items[-1].get(field) for field, _ in sort])
+    return Page(items, next_cursor)
+
+
+def keyset_page(collection, query, sort, page_size, cursor=None, projection=None):
+    """
+    Fetch one page of ``collection.find(query)`` ordered by ``sort``.
+
+    ``sort`` is a list of ``(field, direction)`` pairs and must end with
+    ``_id`` so the key is unique. Raises InvalidCursor for a tampered or
+    stale cursor.
+    """
+    query = _keyset_query(query, sort, cursor)
+    items = list(collection.find(query, projection).sort(sort).limit(page_size + 1))
+    return _page(items, sort, page_size)
+
+
+async def keyset_page_async(collection, query, sort, page_size, cursor=None, projection=None):
+    """keyset_page for a Motor collection."""
+    query = _keyset_query(query, sort, cursor)
+    items = await collection.find(query, projection).sort(sort).limit(
+        page_size + 1).to_list(page_size + 1)
+    return _page(items, sort, page_size)
+
+
+def next_page_url(request, cursor, param='cursor'):
+    """The current URL with ``param`` replaced by ``cursor``."""
+    if not cursor:
+        return None
+    params = request.GET.copy()
+    params[param] = cursor
+    return f'{request.path}?{params.urlencode()}'
+
+
+def jsonable(document):
+    """Make a Mongo document safe for JsonResponse (ObjectId -> str)."""
+    document = dict(document)
+    if '_id' in document:
+        document['_id'] = str(document['_id'])
+    return document
@@ -0,0 +1,335 @@
+"""
+Per-request MongoDB profiling.
+
+QueryProfilerMiddleware opens a RequestProfile for every request in a
+context variable, and the QueryProfiler command listener, registered on the
+sync and Motor clients in mongo.py, adds each command sent while it is
+open: count, duration, documents returned and the collections involved.
+When the request finishes the middleware
+
+* adds a ``Server-Timing`` header with the Mongo time and command count;
+* logs one JSON line per request to ``inventory.profiling``;
+* logs every command slower than SLOW_MS, with its query shape, to
+  ``inventory.profiling.slow``.
+
+Commands sent outside a request cost a single context variable lookup.
+The costlier measurements only run for a SAMPLE_RATE fraction of
+requests: reply sizes in bytes (re-encoding the reply costs about as much
+as decoding it), and ``explain`` of their find/aggregate/count/distinct
+commands on a background thread, once per query shape per EXPLAIN_TTL.
+Plans that scan a whole collection are logged as ``collscan``.
+
+Settings live in INVENTORY_PROFILER; see DEFAULTS.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+import bson
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from pymongo import monitoring
+
+from .caching import LRUCache
+
+logger = logging.getLogger('inventory.profiling')
+slow_logger = logging.getLogger('inventory.profiling.slow')
+
+DEFAULTS = {
+    'ENABLED': True,
+    'SLOW_MS': 100,
+    'SAMPLE_RATE': 0.01,
+    'EXPLAIN_TTL': 3600,
+    'SERVER_TIMING': True,
+    'LOG_REQUESTS': True,
+}
+
+EXPLAINABLE = ('find', 'aggregate', 'count', 'distinct')
+
+# Session and cluster bookkeeping that explain does not accept.
+_UNEXPLAINABLE_KEYS = ('lsid', 'txnNumber', 'autocommit', 'startTransaction', 'readConcern',
+                       'writeConcern')
+
+_current = ContextVar('inventory_request_profile', default=None)
+
+
+def profiler_options():
+    """DEFAULTS overridden by settings.INVENTORY_PROFILER."""
+    return dict(DEFAULTS, **getattr(settings, 'INVENTORY_PROFILER', {}))
+
+
+def current_profile():
+    """The RequestProfile of the request being handled, or None."""
+    return _current.get()
+
+
+def query_shape(value):
+    """``value`` with every scalar replaced by ``'?'``, keeping keys and operators."""
+    if isinstance(value, dict):
+        return {k: query_shape(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [query_shape(v) for v in value]
+    return '?'
+
+
+def _command_shape(command_name, command):
+    shape = {'command': command_name}
+    for key in ('filter', 'query', 'pipeline', 'sort', 'key', 'q', 'updates', 'deletes'):
+        if key in command:
+            shape[key] = query_shape(command[key])
+    return shape
+
+
+def _collection(command_name, command):
+    target = command.get('collection') if command_name == 'getMore' else command.get(command_name)
+    return target if isinstance(target, str) else None
+
+
+def _documents(reply):
+    cursor = reply.get('cursor')
+    if cursor:
+        return len(cursor.get('firstBatch') or cursor.get('nextBatch') or ())
+    if 'value' in reply:
+        return 1 if reply['value'] is not None else 0
+    return len(reply.get('values') or ())
+
+
+class RequestProfile:
+    """The Mongo commands sent on behalf of one request."""
+
+    def __init__(self, method, path, sampled=False, slow_ms=None):
+        self.method = method
+        self.path = path
+        self.sampled = sampled
+        self.slow_ms = slow_ms
+        self.started = time.perf_counter()
+        self.commands = 0
+        self.failures = 0
+        self.duration_ms = 0.0
+        self.documents = 0
+        self.bytes = 0 if sampled else None
+        self.collections = {}
+        self.to_explain = []
+        self._pending = {}
+        # Motor and sync_to_async(thread_sensitive=False) run commands for
+        # the same request on several threads.
+        self._lock = threading.Lock()
+
+    def command_started(self, event):
+        collection = _collection(event.command_name, event.command)
+        with self._lock:
+            self._pending[(event.connection_id, event.request_id)] = (collection, event.command)
+
+    def command_succeeded(self, event):
+        with self._lock:
+            collection, command = self._pending.pop((event.connection_id, event.request_id),
+                                                    (None, None))
+        duration_ms = event.duration_micros / 1000
+        documents = _documents(event.reply)
+        size = len(bson.encode(event.reply)) if self.sampled else 0
+        with self._lock:
+            self.commands += 1
+            self.duration_ms += duration_ms
+            self.documents += documents
+            if self.sampled:
+                self.bytes += size
+            if collection:
+                self.collections[collection] = self.collections.get(collection, 0) + 1
+            if (self.sampled and command is not None and collection
+                    and event.command_name in EXPLAINABLE):
+                self.to_explain.append((event.database_name, collection, event.command_name,
+                                        command))
+        if command is not None and self.slow_ms is not None and duration_ms >= self.slow_ms:
+            slow_logger.warning(json.dumps({
+                'event': 'slow_query',
+                'method': self.method,
+                'path': self.path,
+                'collection': collection,
+                'duration_ms': round(duration_ms, 2),
+                'documents': documents,
+                'shape': _command_shape(event.command_name, command),
+            }))
+
+    def command_failed(self, event):
+        with self._lock:
+            self._pending.pop((event.connection_id, event.request_id), None)
+            self.commands += 1
+            self.failures += 1
+            self.duration_ms += event.duration_micros / 1000
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def as_dict(self):
+        return {
+            'method': self.method,
+            'path': self.path,
+            'mongo_commands': self.commands,
+            'mongo_failures': self.failures,
+            'mongo_ms': round(self.duration_ms, 2),
+            'mongo_documents': self.documents,
+            'mongo_bytes': self.bytes,
+            'collections': self.collections,
+            'sampled': self.sampled,
+        }
+
+
+class QueryProfiler(monitoring.CommandListener):
+    """Forwards command events to the current request's profile, if any."""
+
+    def started(self, event):
+        profile = _current.get()
+        if profile is not None:
+            profile.command_started(event)
+
+    def succeeded(self, event):
+        profile = _current.get()
+        if profile is not None:
+            profile.command_succeeded(event)
+
+    def failed(self, event):
+        profile = _current.get()
+        if profile is not None:
+            profile.command_failed(event)
+
+
+query_profiler = QueryProfiler()
+
+
+def collection_scans(plan):
+    """Namespaces with a COLLSCAN stage in the winning plan(s) of ``plan``."""
+    found = []
+
+    def walk(node, namespace):
+        if isinstance(node, dict):
+            namespace = node.get('namespace', namespace)
+            if node.get('stage') == 'COLLSCAN':
+                found.append(namespace)
+            for key, value in node.items():
+                if key != 'rejectedPlans':
+                    walk(value, namespace)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value, namespace)
+
+    walk(plan, None)
+    return found
+
+
+def explain_command(db, command):
+    """Run ``explain`` (queryPlanner only, nothing executes) and return the plan."""
+    command = {k: v for k, v in command.items()
+               if not k.startswith('$') and k not in _UNEXPLAINABLE_KEYS}
+    return db.command('explain', command, verbosity='queryPlanner')
+
+
+class _Explainer:
+    """One background thread per process explaining sampled query shapes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._seen = None
+
+    def submit(self, profile, ttl):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Threads do not survive a fork.
+                self._executor = ThreadPoolExecutor(max_workers=1,
+                                                    thread_name_prefix='inventory-explain')
+                self._pid = os.getpid()
+                self._seen = LRUCache(maxsize=1024, ttl=ttl)
+            for database, collection, command_name, command in profile.to_explain:
+                shape = _command_shape(command_name, command)
+                key = json.dumps([database, collection, shape], sort_keys=True)
+                if self._seen.get(key):
+                    continue
+                self._seen.set(key, True)
+                self._executor.submit(self._explain, profile.path, database, collection,
+                                      command_name, command, shape)
+
+    @staticmethod
+    def _explain(path, database, collection, command_name, command, shape):
+        from .mongo import get_client
+
+        try:
+            plan = explain_command(get_client()[database], command)
+        except Exception:
+            logger.debug('explain failed for %s.%s', database, collection, exc_info=True)
+            return
+        if collection_scans(plan):
+            logger.warning(json.dumps({
+                'event': 'collscan',
+                'path': path,
+                'collection': collection,
+                'shape': shape,
+            }))
+
+
+_explainer = _Explainer()
+
+
+class QueryProfilerMiddleware:
+    """Profiles the Mongo commands of each request; see the module docstring."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.options = profiler_options()
+        if not self.options['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self._async = asyncio.iscoroutinefunction(get_response)
+        if self._async:
+            # Tells Django 3.2 this instance is a coroutine function.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self._async:
+            return self.__acall__(request)
+        profile, token = self._start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(profile, response)
+
+    async def __acall__(self, request):
+        profile, token = self._start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(profile, response)
+
+    def _start(self, request):
+        sampled = random.random() < self.options['SAMPLE_RATE']
+        profile = RequestProfile(request.method, request.path, sampled, self.options['SLOW_MS'])
+        request.mongo_profile = profile
+        return profile, _current.set(profile)
+
+    def _finish(self, profile, response):
+        elapsed_ms = profile.elapsed_ms()
+        if self.options['SERVER_TIMING']:
+            timing = (f'mongo;dur={profile.duration_ms:.1f};desc="{profile.commands} commands", '
+                      f'app;dur={elapsed_ms:.1f}')
+            existing = response.get('Server-Timing')
+            response['Server-Timing'] = f'{existing}, {timing}' if existing else timing
+        if self.options['LOG_REQUESTS']:
+            logger.info(json.dumps({
+                'event': 'request',
+                'status': response.status_code,
+                'duration_ms': round(elapsed_ms, 2),
+                **profile.as_dict(),
+            }))
+        if profile.to_explain:
+            _explainer.submit(profile, self.options['EXPLAIN_TTL'])
+        return response
@@ -0,0 +1,30 @@
+"""
+Shared query helpers for the inventory views.
+
+Helpers take the database as their first argument so the management
+commands and benchmarks can run them against a scratch database.
+"""
+
+
+def product_counts(db, field, ids=None):
+    """
+    Count active products per value of ``field`` (``category_id`` or
+    ``supplier_id``) in a single grouped aggregation.
+    """
+    match = {'active': True}
+    if ids is not None:
+        match[field] = {'$in': list(ids)}
+    pipeline = [
+        {'$match': match},
+        {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}},
+    ]
+    return {row['_id']: row['count'] for row in db.inventory_product.aggregate(pipeline)}
+
+
+def attach_product_counts(db, documents, field):
+    """Set ``product_count`` on each category/supplier document in place."""
+    ids = [document['id'] for document in documents if document.get('id')]
+    counts = product_counts(db, field, ids) if ids else {}
+    for document in documents:
+        document['product_count'] = counts.get(document.get('id'), 0)
+    return documents
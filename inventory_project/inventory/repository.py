@@ -0,0 +1,208 @@
+"""
+Canonical document schema and batched reference loaders.
+
+The djongo models in models.py only describe the tables for Django's
+migrations; every read and write goes through pymongo with documents shaped
+as below.
+
+Ids: every document has a string UUID ``id`` from ``new_id`` (unique index
+``id_unique``). Mongo's ``_id`` is never used as a reference. References are
+``<kind>_id`` fields holding the referenced ``id``: ``category_id`` and
+``supplier_id`` on products, ``product_id`` on transactions. Products also
+carry the referenced names in ``category`` and ``supplier`` for search,
+forms and exports; ``rename_references`` keeps them current.
+
+``get_many`` loads any number of documents by id with one ``$in`` query, and
+``attach`` uses it to resolve the references of a batch of documents with
+one query per referenced collection, replacing the ``$lookup`` stages that
+used to run once per document. Migration 0004 normalises older documents
+(integer or missing ids, name-only references, Decimal128 prices) to this
+shape.
+"""
+import asyncio
+import uuid
+from datetime import datetime
+from typing import List, Optional, TypedDict
+
+COLLECTIONS = {
+    'category': 'inventory_category',
+    'supplier': 'inventory_supplier',
+    'product': 'inventory_product',
+    'transaction': 'inventory_stocktransaction',
+}
+
+# Reference field -> kind of document it points at.
+REFERENCES = {
+    'category_id': 'category',
+    'supplier_id': 'supplier',
+    'product_id': 'product',
+}
+
+
+class Category(TypedDict, total=False):
+    id: str
+    name: str
+    description: str
+    active: bool
+    created_at: datetime
+    updated_at: datetime
+
+
+class Supplier(TypedDict, total=False):
+    id: str
+    name: str
+    contact_person: str
+    email: str
+    phone: str
+    address: str
+    active: bool
+    created_at: datetime
+    updated_at: datetime
+    # Derived, see search.supplier_search_fields
+    search_name: str
+    search_contact: str
+    search_email: str
+
+
+class PendingTransaction(TypedDict, total=False):
+    id: str
+    product_id: str
+    transaction_type: str
+    quantity: int
+    sequence: int
+    balance: int
+
+
+class Product(TypedDict, total=False):
+    id: str
+    sku: str
+    name: str
+    description: str
+    category_id: Optional[str]
+    category: Optional[str]
+    supplier_id: Optional[str]
+    supplier: Optional[str]
+    price: float
+    stock_quantity: int
+    reorder_level: int
+    # Content-addressed original and its variants, see images.py
+    image: Optional[str]
+    image_hash: str
+    image_width: int
+    image_height: int
+    image_variants: dict
+    image_status: str
+    active: bool
+    created_at: datetime
+    updated_at: datetime
+    # Derived, see lowstock.low_stock_fields and search.product_search_fields
+    stock_deficit: int
+    is_low_stock: bool
+    search_name: str
+    search_sku: str
+    # Written by forecasting.write_recommendations
+    recommended_reorder_level: int
+    forecast: dict
+    # Outbox of movements not yet copied to transactions, see stock.py
+    pending_transactions: List[PendingTransaction]
+    # Ledger position of the last movement and of the last snapshot, see ledger.py
+    ledger_sequence: int
+    ledger_snapshot_sequence: int
+
+
+class Transaction(TypedDict, total=False):
+    id: str
+    product_id: str
+    product: Optional[str]
+    transaction_type: str
+    quantity: int
+    notes: str
+    created_by_id: Optional[int]
+    transaction_date: datetime
+    # Position in the product's ledger and the stock after it, see stock.py
+    sequence: int
+    balance: int
+
+
+def new_id():
+    return str(uuid.uuid4())
+
+
+def get(db, kind, id, projection=None):
+    """The active document of ``kind`` with ``id``, or None."""
+    query = {'id': id}
+    if kind != 'transaction':
+        query['active'] = True
+    return db[COLLECTIONS[kind]].find_one(query, projection)
+
+
+def _many_query(ids):
+    return {'id': {'$in': list({i for i in ids if i is not None})}}
+
+
+def _with_id(projection):
+    # The results are keyed by id, so it must be in the projection.
+    if projection is None:
+        return None
+    if isinstance(projection, (list, tuple)):
+        return list({*projection, 'id'})
+    return {**projection, 'id': 1} if any(projection.values()) else projection
+
+
+def get_many(db, kind, ids, projection=None):
+    """
+    ``{id: document}`` for the documents of ``kind`` with these ids, active
+    or not, in one query. Unknown ids are left out.
+    """
+    query = _many_query(ids)
+    if not query['id']['$in']:
+        return {}
+    return {d['id']: d for d in db[COLLECTIONS[kind]].find(query, _with_id(projection))}
+
+
+async def get_many_async(adb, kind, ids, projection=None):
+    """get_many through a Motor database."""
+    query = _many_query(ids)
+    if not query['id']['$in']:
+        return {}
+    documents = await adb[COLLECTIONS[kind]].find(query, _with_id(projection)).to_list(None)
+    return {d['id']: d for d in documents}
+
+
+def _resolve(documents, fields, loaded):
+    for field in fields:
+        target = field[:-len('_id')]
+        for document in documents:
+            document[target] = loaded[field].get(document.get(field))
+    return documents
+
+
+def attach(db, documents, *fields, projection=None):
+    """
+    Replace each reference named in ``fields`` (e.g. ``'category_id'``)
+    with the referenced document under the field name without ``_id``
+    (``document['category']``), or None when it does not resolve. One query
+    per field for the whole batch. Returns ``documents``.
+    """
+    loaded = {field: get_many(db, REFERENCES[field], [d.get(field) for d in documents],
+                              projection)
+              for field in fields}
+    return _resolve(documents, fields, loaded)
+
+
+async def attach_async(adb, documents, *fields, projection=None):
+    """attach through a Motor database, querying the collections concurrently."""
+    results = await asyncio.gather(*[
+        get_many_async(adb, REFERENCES[field], [d.get(field) for d in documents], projection)
+        for field in fields
+    ])
+    return _resolve(documents, fields, dict(zip(fields, results)))
+
+
+def rename_references(db, kind, id, name):
+    """
+    Update the denormalised ``category``/``supplier`` name on the products
+    referencing a renamed category or supplier. Returns the number changed.
+    """
+    return db.inventory_product.update_many(
+        {f'{kind}_id': id, kind: {'$ne': name}}, {'$set': {kind: name}}).modified_count
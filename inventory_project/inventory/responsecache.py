@@ -0,0 +1,134 @@
+"""
+Conditional GET and rendered-response caching for read-only pages.
+
+``versioned_page`` wraps a view that depends on a few collections. Each
+GET looks up their version counters (one query) and derives an ETag from
+them, the view, the query string and the user. A matching If-None-Match or
+If-Modified-Since gets a 304; otherwise a response rendered for the same
+key is served from the cache; only then does the view run.
+
+Keys include the user and the CSRF cookie because the pages render the
+username and CSRF tokens. Requests with pending flash messages bypass the
+cache so the messages are not lost.
+"""
+import asyncio
+import functools
+import hashlib
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from . import versions
+from .mongo import db
+
+# Copied from the cached response onto hits.
+_KEPT_HEADERS = ('Content-Type', 'Content-Disposition')
+
+
+def _cache():
+    alias = getattr(settings, 'INVENTORY_RESPONSE_CACHE', {}).get('ALIAS', 'default')
+    return caches[alias]
+
+
+def _enabled():
+    return getattr(settings, 'INVENTORY_RESPONSE_CACHE', {}).get('ENABLED', True)
+
+
+def _timeout():
+    return getattr(settings, 'INVENTORY_RESPONSE_CACHE', {}).get('TIMEOUT', 300)
+
+
+def _cacheable(request):
+    return (_enabled() and request.method in ('GET', 'HEAD')
+            and not len(get_messages(request)))
+
+
+def _etag(view_name, request, version_numbers, period):
+    parts = [
+        view_name,
+        request.get_full_path(),
+        str(request.user.pk),
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+        ','.join(map(str, version_numbers)),
+        str(int(time.time() // period)) if period else '',
+    ]
+    return '"%s"' % hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+
+def _lookup(view_name, request, collections, period):
+    """``(etag, last_modified, early_response)`` for a request."""
+    version_numbers, last_modified = versions.current(db, collections)
+    etag = _etag(view_name, request, version_numbers, period)
+    # HTTP dates have whole-second precision.
+    not_modified = get_conditional_response(
+        request, etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified and not period else None)
+    if not_modified is not None:
+        return etag, last_modified, not_modified
+    cached = _cache().get(f'page:{etag}')
+    if cached is not None:
+        content, headers = cached
+        response = HttpResponse(content)
+        for header, value in headers.items():
+            response[header] = value
+        return etag, last_modified, response
+    return etag, last_modified, None
+
+
+def _finish(request, response, etag, last_modified, period, store):
+    if response.status_code not in (200, 304):
+        return response
+    # A response that creates the CSRF cookie was keyed without it.
+    if (store and response.status_code == 200 and not response.streaming
+            and settings.CSRF_COOKIE_NAME in request.COOKIES):
+        headers = {h: response[h] for h in _KEPT_HEADERS if response.has_header(h)}
+        _cache().set(f'page:{etag}', (response.content, headers), _timeout())
+    response['ETag'] = etag
+    if last_modified and not period:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+
+def versioned_page(*collections, period=None):
+    """
+    Cache a page keyed by the versions of ``collections``. ``period``
+    (seconds) also expires it on a clock, for pages that depend on the
+    time as well as the data (e.g. "last 30 days"); such pages get no
+    Last-Modified. Works for sync and async views.
+    """
+    def decorator(view):
+        view_name = f'{view.__module__}.{view.__name__}'
+
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if not await sync_to_async(_cacheable)(request):
+                    return await view(request, *args, **kwargs)
+                etag, last_modified, early = await sync_to_async(_lookup)(
+                    view_name, request, collections, period)
+                if early is not None:
+                    return _finish(request, early, etag, last_modified, period, store=False)
+                response = await view(request, *args, **kwargs)
+                return await sync_to_async(_finish)(
+                    request, response, etag, last_modified, period, store=True)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not _cacheable(request):
+                return view(request, *args, **kwargs)
+            etag, last_modified, early = _lookup(view_name, request, collections, period)
+            if early is not None:
+                return _finish(request, early, etag, last_modified, period, store=False)
+            return _finish(request, view(request, *args, **kwargs), etag, last_modified,
+                           period, store=True)
+        return wrapper
+    return decorator
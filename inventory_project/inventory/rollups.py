@@ -0,0 +1,287 @@
+"""
+Time-bucketed stock movement rollups.
+
+``inventory_stock_rollup`` holds one document per product per UTC day and
+per UTC hour with the IN/OUT quantity, value and movement count in that
+bucket. Stock movements ``$inc`` them with upserts as they happen, so
+top-seller reports read a handful of buckets per product instead of
+scanning raw transactions. Hour buckets expire after
+INVENTORY_ROLLUP_HOUR_RETENTION_DAYS; day buckets are kept.
+
+Values are quantity times the product's price at the time of the movement
+(the current price when backfilling).
+"""
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from pymongo import UpdateOne
+
+from . import versions
+
+COLLECTION = 'inventory_stock_rollup'
+GRANULARITIES = ('day', 'hour')
+
+# Windows up to this long are answered from hour buckets, while those
+# buckets are still kept.
+HOUR_WINDOW_LIMIT = timedelta(hours=48)
+
+
+def hour_retention():
+    return timedelta(days=getattr(settings, 'INVENTORY_ROLLUP_HOUR_RETENTION_DAYS', 14))
+
+
+def bucket_start(moment, granularity):
+    moment = moment.astimezone(dt_timezone.utc) if moment.tzinfo else moment.replace(
+        tzinfo=dt_timezone.utc)
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'day':
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def window_granularity(since, until, now=None):
+    """
+    ``'hour'`` for windows short enough and recent enough for the hour
+    buckets, which expire after hour_retention(); ``'day'`` otherwise.
+    """
+    horizon = bucket_start((now or timezone.now()) - hour_retention(), 'hour')
+    if until - since <= HOUR_WINDOW_LIMIT and bucket_start(since, 'hour') >= horizon:
+        return 'hour'
+    return 'day'
+
+
+def _counters(transaction_type, quantity, price):
+    prefix = 'in' if transaction_type == 'IN' else 'out'
+    return {f'{prefix}_qty': quantity, f'{prefix}_value': quantity * price, f'{prefix}_count': 1}
+
+
+def record_movements(db, movements):
+    """
+    Add movements to their day and hour buckets.
+
+    ``movements`` is a list of ``(transaction, price)`` pairs; all the
+    increments for one bucket are folded into a single upsert.
+    """
+    buckets = {}
+    for transaction, price in movements:
+        counters = _counters(transaction['transaction_type'], transaction['quantity'],
+                             float(price or 0))
+        for granularity in GRANULARITIES:
+            key = (transaction['product_id'], granularity,
+                   bucket_start(transaction['transaction_date'], granularity))
+            inc = buckets.setdefault(key, {})
+            for field, amount in counters.items():
+                inc[field] = inc.get(field, 0) + amount
+    if not buckets:
+        return
+
+    ops = []
+    for (product_id, granularity, bucket), inc in buckets.items():
+        update = {'$inc': inc}
+        if granularity == 'hour':
+            update['$setOnInsert'] = {'expire_at': bucket + hour_retention()}
+        ops.append(UpdateOne(
+            {'product_id': product_id, 'granularity': granularity, 'bucket': bucket},
+            update, upsert=True))
+    db[COLLECTION].bulk_write(ops, ordered=False)
+
+
+def top_products_pipeline(since, until=None, transaction_type='OUT', limit=5):
+    """
+    Aggregation over the rollups returning ``{'_id': product_id,
+    'total_quantity', 'total_value'}`` for the products with the most
+    movements of ``transaction_type`` from ``since`` up to, not including,
+    ``until`` (default now), largest quantity first.
+
+    Short recent windows use hour buckets, others day buckets (see
+    window_granularity), so the bounds are rounded down to the hour or day.
+    """
+    until = until or timezone.now()
+    granularity = window_granularity(since, until)
+    prefix = 'in' if transaction_type == 'IN' else 'out'
+    return [
+        {'$match': {
+            'granularity': granularity,
+            'bucket': {'$gte': bucket_start(since, granularity), '$lt': until},
+            f'{prefix}_qty': {'$gt': 0},
+        }},
+        {'$group': {
+            '_id': '$product_id',
+            'total_quantity': {'$sum': f'${prefix}_qty'},
+            'total_value': {'$sum': f'${prefix}_value'},
+        }},
+        {'$sort': {'total_quantity': -1, '_id': 1}},
+        {'$limit': limit},
+    ]
+
+
+def top_products(db, since, until=None, transaction_type='OUT', limit=5):
+    """Run top_products_pipeline."""
+    return list(db[COLLECTION].aggregate(
+        top_products_pipeline(since, until, transaction_type, limit)))
+
+
+def raw_top_products_pipeline(since, until=None, transaction_type='OUT', limit=5):
+    """
+    top_products_pipeline answered from ``inventory_stocktransaction``
+    instead, as stock_report did before the rollups; values at the current
+    price. The transaction layout benchmark times it.
+    """
+    match = {'transaction_type': transaction_type, 'transaction_date': {'$gte': since}}
+    if until:
+        match['transaction_date']['$lt'] = until
+    return [
+        {'$match': match},
+        {'$group': {'_id': '$product_id', 'total_quantity': {'$sum': '$quantity'}}},
+        {'$sort': {'total_quantity': -1, '_id': 1}},
+        {'$limit': limit},
+        {'$lookup': {
+            'from': 'inventory_product',
+            'localField': '_id',
+            'foreignField': 'id',
+            'as': 'product',
+        }},
+        {'$addFields': {'total_value': {'$multiply': [
+            '$total_quantity', {'$ifNull': [{'$arrayElemAt': ['$product.price', 0]}, 0]}]}}},
+        {'$project': {'product': 0}},
+    ]
+
+
+def _bucket_expression(granularity):
+    parts = {
+        'year': {'$year': '$transaction_date'},
+        'month': {'$month': '$transaction_date'},
+        'day': {'$dayOfMonth': '$transaction_date'},
+    }
+    if granularity == 'hour':
+        parts['hour'] = {'$hour': '$transaction_date'}
+    return {'$dateFromParts': parts}
+
+
+def _sum_if(transaction_type, value):
+    return {'$sum': {'$cond': [{'$eq': ['$transaction_type', transaction_type]}, value, 0]}}
+
+
+def backfill_pipeline(granularity, since=None, match=None):
+    """
+    Aggregation rebuilding ``granularity`` buckets from raw transactions,
+    optionally only those matching ``match``.
+    """
+    # Ledger adjustments are neither stock in nor stock out.
+    match = dict(match or {}, transaction_type={'$in': ['IN', 'OUT']})
+    if since:
+        match['transaction_date'] = {'$gte': since}
+    project = {
+        '_id': 0,
+        'product_id': '$_id.product_id',
+        'granularity': {'$literal': granularity},
+        'bucket': '$_id.bucket',
+    }
+    for prefix, transaction_type in (('in', 'IN'), ('out', 'OUT')):
+        project[f'{prefix}_qty'] = f'${prefix}_qty'
+        project[f'{prefix}_count'] = f'${prefix}_count'
+        project[f'{prefix}_value'] = {'$multiply': [
+            f'${prefix}_qty', {'$ifNull': [{'$arrayElemAt': ['$product.price', 0]}, 0]}]}
+    if granularity == 'hour':
+        project['expire_at'] = {'$add': ['$_id.bucket',
+                                         int(hour_retention().total_seconds() * 1000)]}
+    return [
+        {'$match': match},
+        {'$group': {
+            '_id': {'product_id': '$product_id', 'bucket': _bucket_expression(granularity)},
+            'in_qty': _sum_if('IN', '$quantity'),
+            'out_qty': _sum_if('OUT', '$quantity'),
+            'in_count': _sum_if('IN', 1),
+            'out_count': _sum_if('OUT', 1),
+        }},
+        {'$lookup': {
+            'from': 'inventory_product',
+            'localField': '_id.product_id',
+            'foreignField': 'id',
+            'as': 'product',
+        }},
+        {'$project': project},
+        {'$merge': {
+            'into': COLLECTION,
+            'on': ['product_id', 'granularity', 'bucket'],
+            'whenMatched': 'replace',
+            'whenNotMatched': 'insert',
+        }},
+    ]
+
+
+def backfill(db, since=None):
+    """
+    Rebuild buckets from ``inventory_stocktransaction``, replacing any that
+    already exist from ``since`` on; buckets no transaction falls in any
+    more are removed. Hour buckets are only rebuilt within the retention
+    window. Returns the number of buckets per granularity.
+    """
+    from .archive import archived_until
+
+    # Archived months are no longer in the collection; keep their buckets.
+    floor = archived_until(db)
+    if floor is not None:
+        floor = bucket_start(floor, 'day')
+        since = max(bucket_start(since, 'hour'), floor) if since else floor
+    counts = {}
+    for granularity in GRANULARITIES:
+        start = since
+        if granularity == 'hour':
+            horizon = bucket_start(timezone.now() - hour_retention(), 'hour')
+            start = max(start, horizon) if start else horizon
+        start = bucket_start(start, granularity) if start else None
+        query = {'granularity': granularity}
+        if start:
+            query['bucket'] = {'$gte': start}
+        # $merge only writes buckets that still have transactions.
+        db[COLLECTION].delete_many(query)
+        db.inventory_stocktransaction.aggregate(backfill_pipeline(granularity, start))
+        counts[granularity] = db[COLLECTION].count_documents(query)
+    versions.bump(db, versions.ROLLUPS)
+    return counts
+
+
+def rebuild_buckets(db, transactions):
+    """
+    Recompute the day and hour buckets the given transactions fall in from
+    ``inventory_stocktransaction``, replacing what is stored and removing
+    buckets left without transactions (archived or deleted). Unlike
+    ``record_movements`` this is idempotent, so it is safe to run for
+    transactions that were already recorded. Returns the buckets rebuilt.
+    """
+    from .archive import archived_until
+
+    rebuilt = 0
+    horizon = bucket_start(timezone.now() - hour_retention(), 'hour')
+    # Buckets of archived months cannot be rebuilt from the collection.
+    floor = archived_until(db)
+    floor = bucket_start(floor, 'day') if floor is not None else None
+    for granularity in GRANULARITIES:
+        buckets = {}
+        for transaction in transactions:
+            if not transaction.get('product_id') or not transaction.get('transaction_date'):
+                continue
+            bucket = bucket_start(transaction['transaction_date'], granularity)
+            if (granularity == 'hour' and bucket < horizon) or (floor and bucket < floor):
+                continue
+            buckets.setdefault(bucket, set()).add(transaction['product_id'])
+        if not buckets:
+            continue
+        span = timedelta(days=1) if granularity == 'day' else timedelta(hours=1)
+        match = {'$or': [
+            {'product_id': {'$in': sorted(product_ids)},
+             'transaction_date': {'$gte': bucket, '$lt': bucket + span}}
+            for bucket, product_ids in buckets.items()
+        ]}
+        # $merge only writes buckets that still have transactions.
+        db[COLLECTION].delete_many({'granularity': granularity, '$or': [
+            {'product_id': {'$in': sorted(product_ids)}, 'bucket': bucket}
+            for bucket, product_ids in buckets.items()
+        ]})
+        db.inventory_stocktransaction.aggregate(backfill_pipeline(granularity, match=match))
+        rebuilt += sum(len(product_ids) for product_ids in buckets.values())
+    if rebuilt:
+        versions.bump(db, versions.ROLLUPS)
+    return rebuilt
@@ -0,0 +1,160 @@
+"""
+Product and supplier search.
+
+Search runs in tiers, cheapest first, and stops early when it can:
+
+1. exact SKU - an equality match on the normalised ``search_sku`` field;
+2. prefix - anchored, escaped ``^prefix`` ranges on the normalised
+   ``search_sku``/``search_name`` fields, which are plain index scans;
+3. full text - the ``search_text`` text index over name, SKU, supplier and
+   description, ranked by textScore.
+
+The normalised fields are written alongside the document on every write
+path (see ``product_search_fields``), and MongoDB keeps the text index up
+to date itself, so there is nothing to rebuild after a write. User input is
+always escaped, never interpreted as a regular expression.
+
+``autocomplete_products``/``autocomplete_suppliers`` serve the typeahead
+pickers with prefix queries answered from the index alone.
+"""
+import re
+
+from pymongo.errors import OperationFailure
+
+# Relevance of the fast-path tiers; textScore values stay well below these.
+EXACT_SKU_SCORE = 1000.0
+SKU_PREFIX_SCORE = 500.0
+NAME_PREFIX_SCORE = 200.0
+
+# Longer queries are truncated rather than rejected.
+MAX_QUERY_LENGTH = 100
+
+# Covered by the search_sku/search_name indexes, so typeahead never
+# fetches documents.
+PRODUCT_AUTOCOMPLETE_FIELDS = {'_id': 0, 'id': 1, 'sku': 1, 'name': 1}
+SUPPLIER_AUTOCOMPLETE_FIELDS = {'_id': 0, 'id': 1, 'name': 1}
+
+
+def normalise(value):
+    """Lower-cased with runs of whitespace collapsed."""
+    return ' '.join(str(value or '').split()).lower()[:MAX_QUERY_LENGTH]
+
+
+def product_search_fields(product):
+    """The derived search fields for a product dict about to be written."""
+    return {
+        'search_name': normalise(product.get('name')),
+        'search_sku': normalise(product.get('sku')),
+    }
+
+
+def supplier_search_fields(supplier):
+    """The derived search fields for a supplier dict about to be written."""
+    return {
+        'search_name': normalise(supplier.get('name')),
+        'search_contact': normalise(supplier.get('contact_person')),
+        'search_email': normalise(supplier.get('email')),
+    }
+
+
+def _prefix(text):
+    return {'$regex': '^' + re.escape(text)}
+
+
+def _ranked_search(collection, text, query, limit, projection, exact, prefixes):
+    ranked = {}
+
+    def add(cursor, score):
+        for document in cursor:
+            if score is None:
+                document_score = document.pop('score', 0.0)
+            else:
+                document_score = score
+            key = document['_id']
+            if key not in ranked or ranked[key][0] < document_score:
+                ranked[key] = (document_score, document)
+
+    projection = dict.fromkeys(projection, 1) if isinstance(projection, list) else projection
+    if projection is not None:
+        projection = {**projection, '_id': 1}
+
+    if exact:
+        field = exact
+        match = collection.find_one({**query, field: text}, projection)
+        if match is not None:
+            return [match]
+
+    for field, score in prefixes:
+        add(collection.find({**query, field: _prefix(text)}, projection)
+            .sort(field, 1).limit(limit), score)
+
+    if len(ranked) < limit:
+        text_projection = {**(projection or {}), 'score': {'$meta': 'textScore'}}
+        try:
+            add(collection.find({**query, '$text': {'$search': text}}, text_projection)
+                .sort([('score', {'$meta': 'textScore'})]).limit(limit), None)
+        except OperationFailure:
+            # No text index yet (run ensure_indexes); prefix results only.
+            pass
+
+    results = sorted(ranked.values(), key=lambda r: (-r[0], r[1].get('search_name') or
+                                                     r[1].get('name') or ''))
+    return [document for _, document in results[:limit]]
+
+
+def search_products(db, text, query=None, limit=50, projection=None):
+    """
+    Active products matching ``text``, most relevant first. ``query`` adds
+    further conditions (category, low stock, ...).
+    """
+    text = normalise(text)
+    if not text:
+        return []
+    query = {'active': True, **(query or {})}
+    return _ranked_search(
+        db.inventory_product, text, query, limit, projection,
+        exact='search_sku',
+        prefixes=[('search_sku', SKU_PREFIX_SCORE), ('search_name', NAME_PREFIX_SCORE)],
+    )
+
+
+def search_suppliers(db, text, query=None, limit=50, projection=None):
+    """Active suppliers matching ``text`` on name, contact or email."""
+    text = normalise(text)
+    if not text:
+        return []
+    query = {'active': True, **(query or {})}
+    return _ranked_search(
+        db.inventory_supplier, text, query, limit, projection,
+        exact='search_email',
+        prefixes=[('search_name', NAME_PREFIX_SCORE), ('search_contact', NAME_PREFIX_SCORE),
+                  ('search_email', NAME_PREFIX_SCORE)],
+    )
+
+
+def _autocomplete(collection, text, fields, projection, limit):
+    text = normalise(text)
+    if not text:
+        return []
+    results, seen = [], set()
+    for field in fields:
+        cursor = collection.find({field: _prefix(text), 'active': True}, projection)
+        for document in cursor.sort(field, 1).limit(limit):
+            if document['id'] not in seen:
+                seen.add(document['id'])
+                results.append(document)
+        if len(results) >= limit:
+            break
+    return results[:limit]
+
+
+def autocomplete_products(db, text, limit=10):
+    """Products whose SKU, then name, starts with ``text``."""
+    return _autocomplete(db.inventory_product, text, ['search_sku', 'search_name'],
+                         PRODUCT_AUTOCOMPLETE_FIELDS, limit)
+
+
+def autocomplete_suppliers(db, text, limit=10):
+    """Suppliers whose name starts with ``text``."""
+    return _autocomplete(db.inventory_supplier, text, ['search_name'],
+                         SUPPLIER_AUTOCOMPLETE_FIELDS, limit)
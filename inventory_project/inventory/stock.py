@@ -0,0 +1,521 @@
+"""
+Stock movements.
+
+Every movement is a single ``find_one_and_update`` that increments
+``stock_quantity`` with ``stock_quantity >= quantity`` in the filter for
+OUT movements, so concurrent requests can neither lose updates nor drive
+stock below zero. The update is a pipeline so the derived low-stock fields
+are recomputed from the new stock in the same write.
+
+The transaction document is written in the same multi-document transaction
+when the server supports one and the transactions are not a time-series
+collection (see timeseries.py), which takes no writes inside
+transactions. Otherwise it is pushed onto the product's
+``pending_transactions`` outbox in the same atomic update, copied into
+``inventory_stocktransaction`` and then pulled from the outbox; anything
+left behind by a crash is picked up by ``drain_outbox``.
+
+The transactions form the product's stock ledger (see ledger.py): the same
+atomic update increments the product's ``ledger_sequence``, and the
+transaction records that ``sequence`` and the resulting ``balance``.
+Stock set by hand (``adjust_stock``) and opening stock are recorded as
+ADJUSTMENT entries with a signed quantity, so the ledger accounts for
+every change to ``stock_quantity``.
+"""
+import time
+from datetime import timedelta
+
+from django.utils import timezone
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from . import repository, rollups, summary, versions
+from .forms import StockMovementLineForm
+from .lowstock import LOW_STOCK_EXPRESSIONS
+from .mongo import transactions_supported
+from .timeseries import uses_timeseries
+
+OUTBOX = 'pending_transactions'
+DUPLICATE_KEY = 11000
+
+# Outbox entries being delivered to the time-series layout carry these
+# (see _deliver_claimed); a claim older than CLAIM_TIMEOUT was left by a
+# process that died and may be taken over.
+CLAIM_FIELDS = ('claimed_by', 'claimed_at')
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+# Ledger-only transaction type: a signed correction, never a sale or receipt.
+ADJUSTMENT = 'ADJ'
+
+
+class StockError(Exception):
+    pass
+
+
+class ProductNotFound(StockError):
+    pass
+
+
+class InsufficientStock(StockError):
+    def __init__(self, available, requested):
+        super().__init__(f'Insufficient stock available ({available} < {requested}).')
+        self.available = available
+        self.requested = requested
+
+
+class StockChanged(StockError):
+    def __init__(self, current, expected):
+        super().__init__(f'Stock changed to {current} (expected {expected}).')
+        self.current = current
+        self.expected = expected
+
+
+def stock_delta(transaction_type, quantity):
+    return quantity if transaction_type in ('IN', ADJUSTMENT) else -quantity
+
+
+def guarded_filter(product_id, transaction_type, quantity):
+    """Match the product only if the movement would leave stock >= 0."""
+    query = {'id': product_id, 'active': True}
+    if transaction_type != 'IN':
+        query['stock_quantity'] = {'$gte': quantity}
+    return query
+
+
+def _ledger_entry(transaction, stock_after, quantity=None):
+    # The outbox copy of ``transaction`` with its ledger position, computed
+    # from the product as it was before this update.
+    entry = {field: {'$literal': value} for field, value in transaction.items()}
+    entry.update(sequence={'$add': [{'$ifNull': ['$ledger_sequence', 0]}, 1]},
+                 balance=stock_after)
+    if quantity is not None:
+        entry['quantity'] = quantity
+    return entry
+
+
+def movement_update(transaction_type, quantity, transaction=None):
+    """
+    Pipeline update applying the movement and advancing the ledger
+    sequence, optionally appending ``transaction`` to the outbox, and
+    refreshing the low-stock fields.
+    """
+    stock_after = {'$add': [{'$ifNull': ['$stock_quantity', 0]},
+                            stock_delta(transaction_type, quantity)]}
+    changes = {'stock_quantity': stock_after,
+               'ledger_sequence': {'$add': [{'$ifNull': ['$ledger_sequence', 0]}, 1]}}
+    if transaction is not None:
+        changes[OUTBOX] = {'$concatArrays': [{'$ifNull': [f'${OUTBOX}', []]},
+                                             [_ledger_entry(transaction, stock_after)]]}
+    return [{'$set': changes}, {'$set': LOW_STOCK_EXPRESSIONS}]
+
+
+def _positioned(transaction, product):
+    """``transaction`` with the ledger position the update gave it."""
+    transaction['sequence'] = product['ledger_sequence']
+    transaction['balance'] = product['stock_quantity']
+    return transaction
+
+
+def build_transaction(product_id, transaction_type, quantity, user_id=None,
+                      notes='', product_name=None):
+    return {
+        'id': repository.new_id(),
+        'product_id': product_id,
+        'product': product_name,
+        'transaction_type': transaction_type,
+        'quantity': quantity,
+        'notes': notes or '',
+        'created_by_id': user_id,
+        'transaction_date': timezone.now(),
+    }
+
+
+def _failure(db, transaction, session=None):
+    product = db.inventory_product.find_one(
+        {'id': transaction['product_id'], 'active': True},
+        {'stock_quantity': 1},
+        session=session,
+    )
+    if product is None:
+        return ProductNotFound(transaction['product_id'])
+    return InsufficientStock(product.get('stock_quantity', 0), transaction['quantity'])
+
+
+def _apply_in_transaction(db, transaction, session):
+    product = db.inventory_product.find_one_and_update(
+        guarded_filter(transaction['product_id'], transaction['transaction_type'],
+                       transaction['quantity']),
+        movement_update(transaction['transaction_type'], transaction['quantity']),
+        projection={OUTBOX: 0},
+        return_document=ReturnDocument.AFTER,
+        session=session,
+    )
+    if product is None:
+        raise _failure(db, transaction, session)
+    db.inventory_stocktransaction.insert_one(_positioned(transaction, product), session=session)
+    return product
+
+
+def _apply_with_outbox(db, transaction):
+    product = db.inventory_product.find_one_and_update(
+        guarded_filter(transaction['product_id'], transaction['transaction_type'],
+                       transaction['quantity']),
+        movement_update(transaction['transaction_type'], transaction['quantity'], transaction),
+        projection={OUTBOX: 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    if product is None:
+        raise _failure(db, transaction)
+    flush_outbox(db, [_positioned(transaction, product)])
+    return product
+
+
+def _by_product(transactions):
+    grouped = {}
+    for transaction in transactions:
+        grouped.setdefault(transaction['product_id'], []).append(transaction)
+    return grouped
+
+
+def _document(entry):
+    return {k: v for k, v in entry.items() if k != '_id' and k not in CLAIM_FIELDS}
+
+
+def _mark(db, transactions, condition, changes):
+    # One positional update per entry, all in one round trip.
+    db.inventory_product.bulk_write([
+        UpdateOne({'id': t['product_id'], OUTBOX: {'$elemMatch': {'id': t['id'], **condition}}},
+                  {'$set': {f'{OUTBOX}.$.{field}': value for field, value in changes.items()}})
+        for t in transactions], ordered=False)
+
+
+def _claim(db, transactions, owner):
+    # Each update only marks an entry nobody holds, so of several flushes
+    # of one entry only the first gets it.
+    now = timezone.now()
+    _mark(db, transactions, {'claimed_at': {'$not': {'$gte': now - CLAIM_TIMEOUT}}},
+          {'claimed_by': owner, 'claimed_at': now})
+    claimed = {e['id'] for p in db.inventory_product.find(
+                   {'id': {'$in': list(_by_product(transactions))},
+                    f'{OUTBOX}.claimed_by': owner}, {OUTBOX: 1})
+               for e in p.get(OUTBOX, ()) if e.get('claimed_by') == owner}
+    return [t for t in transactions if t['id'] in claimed]
+
+
+def _release(db, transactions, owner):
+    # claimed_at stays, as None, so whoever claims the entry next checks
+    # whether it was inserted after all.
+    _mark(db, transactions, {'claimed_by': owner}, {'claimed_by': None, 'claimed_at': None})
+
+
+def _deliver_claimed(db, transactions):
+    # The time-series layout has no unique index on ``id``, so an entry is
+    # claimed on its product, inserted, and only then pulled. An insert
+    # that fails releases its claims for drain_outbox; a process that dies
+    # in between leaves a claim that drain_outbox takes over once stale.
+    owner = repository.new_id()
+    claimed = _claim(db, transactions, owner)
+    if not claimed:
+        return 0
+    # Entries claimed before may have been inserted by a flush that died
+    # before pulling them.
+    retried = [t['id'] for t in claimed if 'claimed_at' in t]
+    delivered = set(db.inventory_stocktransaction.distinct(
+        'id', {'id': {'$in': retried}})) if retried else set()
+    documents = [_document(t) for t in claimed if t['id'] not in delivered]
+    try:
+        if documents:
+            db.inventory_stocktransaction.insert_many(documents, ordered=False)
+    except PyMongoError:
+        _release(db, claimed, owner)
+        raise
+    db.inventory_product.update_many(
+        {'id': {'$in': list(_by_product(claimed))}},
+        {'$pull': {OUTBOX: {'id': {'$in': [t['id'] for t in claimed]}, 'claimed_by': owner}}},
+    )
+    return len(claimed)
+
+
+def flush_outbox(db, transactions):
+    """
+    Copy outbox entries into inventory_stocktransaction and remove them
+    from their products. Returns the number of entries delivered.
+    Idempotent: entries already copied are skipped via the unique index on
+    ``id``. The time-series layout has none, so there each entry is first
+    claimed on its product, and is pulled only after the flush that
+    claimed it has inserted it.
+    """
+    if not transactions:
+        return 0
+    if uses_timeseries(db):
+        return _deliver_claimed(db, transactions)
+    documents = [_document(t) for t in transactions]
+    try:
+        db.inventory_stocktransaction.insert_many(documents, ordered=False)
+    except BulkWriteError as exc:
+        if any(e['code'] != DUPLICATE_KEY for e in exc.details['writeErrors']):
+            raise
+    db.inventory_product.update_many(
+        {'id': {'$in': list({t['product_id'] for t in transactions})}},
+        {'$pull': {OUTBOX: {'id': {'$in': [t['id'] for t in transactions]}}}},
+    )
+    return len(transactions)
+
+
+def drain_outbox(db, batch_size=500):
+    """
+    Flush outbox entries left behind by interrupted movements, including
+    entries whose time-series delivery claim has gone stale. Returns the
+    number delivered.
+    """
+    drained = 0
+    while True:
+        pending = []
+        unclaimed = {'$not': {'$gte': timezone.now() - CLAIM_TIMEOUT}}
+        for product in db.inventory_product.find(
+                {OUTBOX: {'$elemMatch': {'id': {'$exists': True}, 'claimed_at': unclaimed}}},
+                {OUTBOX: 1}).limit(batch_size):
+            pending.extend(product.get(OUTBOX, []))
+        # Nothing is delivered when a live flush claimed the entries meanwhile.
+        delivered = flush_outbox(db, pending)
+        if not delivered:
+            if drained:
+                versions.bump(db, versions.TRANSACTIONS)
+            return drained
+        drained += delivered
+
+
+def apply_movement(db, product_id, transaction_type, quantity, user_id=None,
+                   notes='', product_name=None):
+    """
+    Apply one stock movement atomically.
+
+    Returns ``(product, transaction)`` with the product as it is after the
+    movement. Raises ProductNotFound or InsufficientStock without changing
+    anything.
+    """
+    transaction = build_transaction(product_id, transaction_type, quantity,
+                                    user_id, notes, product_name)
+    if transactions_supported(db.client) and not uses_timeseries(db):
+        with db.client.start_session() as session:
+            product = session.with_transaction(
+                lambda s: _apply_in_transaction(db, transaction, s))
+    else:
+        product = _apply_with_outbox(db, transaction)
+    summary.stock_moved(db, [(product, stock_delta(transaction_type, quantity))])
+    rollups.record_movements(db, [(transaction, product.get('price'))])
+    versions.bump(db, *versions.STOCK_MOVEMENT)
+    return product, transaction
+
+
+def opening_entry(product_id, quantity, product_name=None, user_id=None):
+    """
+    The first ledger entry of a new product created with ``quantity`` in
+    stock, for its outbox (see ``flush_outbox``), or None for no stock.
+    """
+    if not quantity:
+        return None
+    entry = build_transaction(product_id, ADJUSTMENT, quantity, user_id, 'Opening stock',
+                              product_name)
+    entry.update(sequence=1, balance=quantity)
+    return entry
+
+
+def adjust_stock(db, product_id, quantity, user_id=None, notes='', product_name=None,
+                 expected=None):
+    """
+    Set a product's stock to ``quantity``, recording the difference as an
+    ADJUSTMENT ledger entry. Returns ``(product, transaction)``, or
+    ``(None, None)`` when the stock already is ``quantity``.
+
+    With ``expected`` this is a compare-and-set: the stock is only set if
+    it still is ``expected``, so a figure read before concurrent movements
+    cannot write over them. Raises StockChanged otherwise.
+    """
+    if expected == quantity:
+        return None, None
+    transaction = build_transaction(product_id, ADJUSTMENT, 0, user_id,
+                                    notes or 'Stock count', product_name)
+    stock = {'$ifNull': ['$stock_quantity', 0]}
+    query = {'id': product_id, 'active': True, 'stock_quantity': {'$ne': quantity}}
+    if expected is not None:
+        query['stock_quantity'] = expected
+    product = db.inventory_product.find_one_and_update(
+        query,
+        [{'$set': {
+            'stock_quantity': {'$literal': quantity},
+            'ledger_sequence': {'$add': [{'$ifNull': ['$ledger_sequence', 0]}, 1]},
+            OUTBOX: {'$concatArrays': [
+                {'$ifNull': [f'${OUTBOX}', []]},
+                [_ledger_entry(transaction, {'$literal': quantity},
+                               {'$subtract': [quantity, stock]})]]},
+        }}, {'$set': LOW_STOCK_EXPRESSIONS}],
+        projection={OUTBOX: 1, **summary.PRODUCT_FIELDS, 'ledger_sequence': 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if product is None:
+        if expected is not None:
+            current = db.inventory_product.find_one({'id': product_id, 'active': True},
+                                                    {'stock_quantity': 1})
+            if current is None:
+                raise ProductNotFound(product_id)
+            if current.get('stock_quantity', 0) != quantity:
+                raise StockChanged(current.get('stock_quantity', 0), expected)
+        return None, None
+    transaction = next(e for e in product.pop(OUTBOX) if e['id'] == transaction['id'])
+    flush_outbox(db, [transaction])
+    summary.stock_moved(db, [(product, transaction['quantity'])])
+    versions.bump(db, versions.PRODUCTS, versions.TRANSACTIONS)
+    return product, transaction
+
+
+def _line_sku(line):
+    return line.get('sku') if isinstance(line, dict) else None
+
+
+def _validate_lines(lines):
+    validated = []
+    for number, line in enumerate(lines, start=1):
+        form = StockMovementLineForm(line if isinstance(line, dict) else {})
+        if form.is_valid():
+            validated.append((number, form.cleaned_data, None))
+        else:
+            validated.append((number, None, {k: list(v) for k, v in form.errors.items()}))
+    return validated
+
+
+def _apply_ordered(db, transaction):
+    # One guarded update per line: a guard that matches nothing is not an
+    # error to bulk_write, so only this can stop at the first rejected line.
+    product = db.inventory_product.find_one_and_update(
+        guarded_filter(transaction['product_id'], transaction['transaction_type'],
+                       transaction['quantity']),
+        movement_update(transaction['transaction_type'], transaction['quantity'], transaction),
+        projection={OUTBOX: 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    return None if product is None else _positioned(transaction, product)
+
+
+def _apply_batch(db, lines, ordered, user_id):
+    validated = _validate_lines(lines)
+    skus = {data['sku'] for _, data, _ in validated if data}
+    products = {
+        p['sku']: p for p in db.inventory_product.find(
+            {'sku': {'$in': list(skus)}, 'active': True},
+            {'id': 1, 'sku': 1, 'name': 1},
+        )
+    }
+
+    results, pending, applied = [], [], []
+    stopped = False
+    for number, data, errors in validated:
+        result = {'line': number, 'sku': _line_sku(lines[number - 1])}
+        results.append(result)
+        if stopped:
+            result['status'] = 'skipped'
+            continue
+        if errors:
+            result.update(status='invalid', errors=errors)
+        elif data['sku'] not in products:
+            result['status'] = 'unknown_sku'
+        else:
+            product = products[data['sku']]
+            transaction = build_transaction(
+                product['id'], data['transaction_type'], data['quantity'],
+                user_id, data['notes'], product.get('name'))
+            if not ordered:
+                pending.append((result, transaction))
+                continue
+            entry = _apply_ordered(db, transaction)
+            if entry is not None:
+                result.update(status='applied', transaction_id=transaction['id'])
+                applied.append(entry)
+                continue
+            result['status'] = 'insufficient_stock'
+        stopped = ordered
+
+    if pending:
+        db.inventory_product.bulk_write([
+            UpdateOne(
+                guarded_filter(t['product_id'], t['transaction_type'], t['quantity']),
+                movement_update(t['transaction_type'], t['quantity'], t),
+            )
+            for _, t in pending
+        ], ordered=False)
+
+        # A guard that did not match leaves no outbox entry, which tells us
+        # exactly which lines were applied. The entries carry their ledger
+        # positions.
+        ids = [t['id'] for _, t in pending]
+        entries = {}
+        for product in db.inventory_product.find({f'{OUTBOX}.id': {'$in': ids}}, {OUTBOX: 1}):
+            entries.update((entry['id'], entry) for entry in product.get(OUTBOX, []))
+        # ...unless a concurrent drain_outbox already delivered them.
+        delivered = set(db.inventory_stocktransaction.distinct('id', {'id': {'$in': ids}}))
+
+        for result, transaction in pending:
+            if transaction['id'] in entries or transaction['id'] in delivered:
+                result.update(status='applied', transaction_id=transaction['id'])
+                applied.append(entries.get(transaction['id'], transaction))
+            else:
+                result['status'] = 'insufficient_stock'
+    flush_outbox(db, applied)
+    _record_applied(db, applied)
+
+    return results, stopped
+
+
+def _record_applied(db, transactions):
+    # Summary and rollups for a batch, with one product fetch between them.
+    deltas = {}
+    for t in transactions:
+        deltas[t['product_id']] = deltas.get(t['product_id'], 0) + stock_delta(
+            t['transaction_type'], t['quantity'])
+    if not deltas:
+        return
+    products = list(db.inventory_product.find({'id': {'$in': list(deltas)}},
+                                              summary.PRODUCT_FIELDS))
+    summary.stock_moved(db, [(p, deltas[p['id']]) for p in products])
+    prices = {p['id']: p.get('price') for p in products}
+    rollups.record_movements(db, [(t, prices.get(t['product_id'])) for t in transactions])
+    versions.bump(db, *versions.STOCK_MOVEMENT)
+
+
+def apply_movements(db, lines, ordered=True, user_id=None, batch_size=1000):
+    """
+    Apply a batch of ``{sku, transaction_type, quantity, notes}`` lines.
+
+    Lines are validated with StockMovementLineForm and SKUs are resolved in
+    one query per chunk. Unordered, stock is moved with a single bulk_write
+    of guarded increments. With ``ordered`` each line is its own guarded
+    update, one round trip per line, and the batch stops at the first line
+    rejected by the server's stock, not a stale read of it; later lines are
+    reported as ``skipped``. Either way the transaction documents are
+    written with one insert_many.
+
+    Returns a dict with per-line ``results`` and throughput figures.
+    """
+    start = time.perf_counter()
+    results = []
+    stopped = False
+    for offset in range(0, len(lines), batch_size):
+        chunk = lines[offset:offset + batch_size]
+        if stopped:
+            chunk_results = [{'line': n, 'sku': _line_sku(line), 'status': 'skipped'}
+                             for n, line in enumerate(chunk, start=1)]
+        else:
+            chunk_results, stopped = _apply_batch(db, chunk, ordered, user_id)
+        for result in chunk_results:
+            result['line'] += offset
+        results.extend(chunk_results)
+
+    elapsed = time.perf_counter() - start
+    applied = sum(1 for r in results if r['status'] == 'applied')
+    return {
+        'results': results,
+        'applied': applied,
+        'rejected': len(results) - applied,
+        'elapsed_seconds': round(elapsed, 4),
+        'movements_per_second': round(applied / elapsed, 1) if elapsed else None,
+    }
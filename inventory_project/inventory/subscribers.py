@@ -0,0 +1,101 @@
+"""
+Built-in event bus subscribers (see events.py).
+
+The write paths in views.py, stock.py and the importer already maintain
+derived data as they write. These subscribers make the same data follow
+changes made any other way (the mongo shell, another service, a restore)
+and repair what an interrupted write left behind. All of them are
+idempotent and only write what is stale.
+"""
+from pymongo import UpdateOne
+
+from . import lookups, repository, rollups, summary, versions
+from .events import WATCHED, subscribe
+from .lowstock import low_stock_fields
+from .search import product_search_fields, supplier_search_fields
+
+# Source fields of the derived fields kept on products and suppliers
+PRODUCT_SOURCES = ('name', 'sku', 'stock_quantity', 'reorder_level')
+SUPPLIER_SOURCES = ('name', 'contact_person', 'email')
+
+
+def _touches(change, fields):
+    if change['operationType'] != 'update':
+        return True
+    description = change.get('updateDescription') or {}
+    changed = set(description.get('updatedFields') or ()) | set(
+        description.get('removedFields') or ())
+    return any(field.split('.')[0] in fields for field in changed)
+
+
+def _latest(changes, fields):
+    """The looked-up documents of ``changes`` touching ``fields``, one per _id."""
+    documents = {}
+    for change in changes:
+        document = change.get('fullDocument')
+        if document is not None and _touches(change, fields):
+            documents[document['_id']] = document
+    return list(documents.values())
+
+
+def _resync_caches(db):
+    versions.bump(db, *WATCHED)
+    lookups.invalidate_categories()
+    lookups.invalidate_suppliers()
+
+
+@subscribe(*WATCHED, resync=_resync_caches)
+def invalidate_caches(db, changes):
+    """Bump the versions cached pages are keyed by and drop stale lookup tables."""
+    changed = {change['ns']['coll'] for change in changes}
+    versions.bump(db, *changed)
+    # Other processes' local tiers still expire after LOCAL_TTL.
+    if versions.CATEGORIES in changed:
+        lookups.invalidate_categories()
+    if versions.SUPPLIERS in changed:
+        lookups.invalidate_suppliers()
+
+
+@subscribe(versions.TRANSACTIONS, operations=('insert', 'update', 'replace'),
+           resync=rollups.backfill)
+def update_rollups(db, changes):
+    """
+    Rebuild the rollup buckets of new or edited transactions from the
+    transactions themselves (valued at the current price, as a backfill
+    is). Deletes carry no transaction to locate the bucket by; run
+    backfill_rollups after deleting transactions.
+    """
+    rollups.rebuild_buckets(db, [c['fullDocument'] for c in changes if c.get('fullDocument')])
+
+
+@subscribe(versions.PRODUCTS, versions.SUPPLIERS, operations=('insert', 'update', 'replace'))
+def refresh_derived_fields(db, changes):
+    """Recompute the search and low-stock fields of products and suppliers."""
+    for collection, sources, derive in (
+            (versions.PRODUCTS, PRODUCT_SOURCES,
+             lambda d: {**product_search_fields(d), **low_stock_fields(d)}),
+            (versions.SUPPLIERS, SUPPLIER_SOURCES, supplier_search_fields)):
+        ops = []
+        for document in _latest([c for c in changes if c['ns']['coll'] == collection], sources):
+            stale = {k: v for k, v in derive(document).items() if document.get(k) != v}
+            if stale:
+                # Only if the sources are still what the fields were derived
+                # from; a newer change has its own event.
+                guard = {'_id': document['_id'],
+                         **{field: document.get(field) for field in sources}}
+                ops.append(UpdateOne(guard, {'$set': stale}))
+        if ops:
+            db[collection].bulk_write(ops, ordered=False)
+
+
+@subscribe(versions.CATEGORIES, versions.SUPPLIERS, operations=('insert', 'update', 'replace'))
+def sync_reference_names(db, changes):
+    """Copy category and supplier names to their products and to the summary."""
+    for collection, kind in ((versions.CATEGORIES, 'category'), (versions.SUPPLIERS, 'supplier')):
+        for document in _latest([c for c in changes if c['ns']['coll'] == collection],
+                                ('name', 'active')):
+            if not document.get('id') or not document.get('name'):
+                continue
+            repository.rename_references(db, kind, document['id'], document['name'])
+            if kind == 'category':
+                summary.category_saved(db, document)
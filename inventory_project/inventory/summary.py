@@ -0,0 +1,213 @@
+"""
+Materialised inventory summary for the dashboard.
+
+A single ``inventory_summary`` document holds the active product and
+supplier counts, total stock value, per-category product counts and value
+and the number of low-stock products (a count, not their ids, so the
+document stays small however many products run low). The write paths in
+views.py, stock.py and the importer keep it up to date with ``$inc`` so
+the dashboard can read it instead of aggregating over every product; a
+write's low-stock change is worked out from the product before and after.
+
+Deltas only ever update an existing document. When it is missing the
+write rebuilds it from the data, which already includes that write, so a
+delta can never become a summary of its own. Migration 0007 builds it on
+existing deployments. ``rebuild_summary`` recomputes it from scratch and
+``check_summary`` reports where the stored document has drifted from the
+real data.
+"""
+from django.utils import timezone
+
+from .lowstock import low_stock_fields
+
+SUMMARY_ID = 'inventory'
+
+PRODUCT_FIELDS = {'id': 1, 'category_id': 1, 'price': 1, 'stock_quantity': 1,
+                  'reorder_level': 1, 'active': 1}
+
+# total_value is maintained with floating point $inc, so allow for rounding.
+VALUE_TOLERANCE = 0.01
+
+
+def _value(product):
+    return float(product.get('price') or 0) * (product.get('stock_quantity') or 0)
+
+
+def is_low_stock(product):
+    return low_stock_fields(product)['is_low_stock']
+
+
+def _contribution(product, sign, inc):
+    """Add ``sign`` times this product's share of the totals to ``inc``."""
+    value = _value(product) * sign
+    inc['products_count'] = inc.get('products_count', 0) + sign
+    if is_low_stock(product):
+        inc['low_stock_count'] = inc.get('low_stock_count', 0) + sign
+    inc['total_value'] = inc.get('total_value', 0) + value
+    category_id = product.get('category_id')
+    if category_id:
+        count_key, value_key = f'categories.{category_id}.count', f'categories.{category_id}.value'
+        inc[count_key] = inc.get(count_key, 0) + sign
+        inc[value_key] = inc.get(value_key, 0) + value
+
+
+def _update(db, update):
+    # Never upsert: a document made from one delta would read as a summary.
+    if not db.inventory_summary.update_one({'_id': SUMMARY_ID}, update).matched_count:
+        rebuild_summary(db)
+
+
+def _write(db, inc=None):
+    update = {'$set': {'updated_at': timezone.now()}}
+    inc = {k: v for k, v in (inc or {}).items() if v}
+    if inc:
+        update['$inc'] = inc
+    _update(db, update)
+
+
+def product_created(db, product):
+    inc = {}
+    _contribution(product, 1, inc)
+    _write(db, inc)
+
+
+def product_updated(db, before, after):
+    inc = {}
+    _contribution(before, -1, inc)
+    _contribution(after, 1, inc)
+    _write(db, inc)
+
+
+def products_changed(db, changes):
+    """
+    Apply many product writes in one update, e.g. an import chunk.
+
+    ``changes`` is a list of ``(before, after)`` pairs; ``before`` is None
+    for a product that did not exist.
+    """
+    inc = {}
+    for before, after in changes:
+        if before is not None:
+            _contribution(before, -1, inc)
+        _contribution(after, 1, inc)
+    if changes:
+        _write(db, inc)
+
+
+def product_deleted(db, product):
+    inc = {}
+    _contribution(product, -1, inc)
+    _write(db, inc)
+
+
+def stock_moved(db, movements):
+    """
+    Apply stock movements to the summary.
+
+    ``movements`` is a list of ``(product_after, delta)`` pairs where
+    ``product_after`` is the product document after its stock changed.
+    """
+    inc = {}
+    for product, delta in movements:
+        value = float(product.get('price') or 0) * delta
+        inc['total_value'] = inc.get('total_value', 0) + value
+        category_id = product.get('category_id')
+        if category_id:
+            key = f'categories.{category_id}.value'
+            inc[key] = inc.get(key, 0) + value
+        before = dict(product, stock_quantity=(product.get('stock_quantity') or 0) - delta)
+        low = is_low_stock(product) - is_low_stock(before)
+        inc['low_stock_count'] = inc.get('low_stock_count', 0) + low
+    _write(db, inc)
+
+
+def supplier_created(db, supplier):
+    _write(db, {'suppliers_count': 1})
+
+
+def supplier_deleted(db, supplier):
+    _write(db, {'suppliers_count': -1})
+
+
+def category_saved(db, category):
+    _update(db, {'$set': {f'categories.{category["id"]}.name': category['name'],
+                          f'categories.{category["id"]}.active': category.get('active', True)}})
+
+
+def compute_summary(db):
+    """Build the summary document from the collections."""
+    categories = {
+        c['id']: {'name': c.get('name'), 'active': True, 'count': 0, 'value': 0.0}
+        for c in db.inventory_category.find({'active': True}, {'id': 1, 'name': 1})
+        if c.get('id')
+    }
+    pipeline = [
+        {'$match': {'active': True}},
+        {
+            '$group': {
+                '_id': '$category_id',
+                'count': {'$sum': 1},
+                'value': {'$sum': {'$multiply': [
+                    {'$ifNull': ['$stock_quantity', 0]}, {'$ifNull': ['$price', 0]}]}},
+            }
+        },
+    ]
+    products_count, total_value = 0, 0.0
+    for row in db.inventory_product.aggregate(pipeline):
+        products_count += row['count']
+        total_value += row['value']
+        if row['_id']:
+            entry = categories.setdefault(row['_id'], {'name': None, 'active': False})
+            entry['count'] = row['count']
+            entry['value'] = row['value']
+
+    return {
+        '_id': SUMMARY_ID,
+        'products_count': products_count,
+        'suppliers_count': db.inventory_supplier.count_documents({'active': True}),
+        'total_value': total_value,
+        'categories': categories,
+        # Counted on the low_stock partial index.
+        'low_stock_count': db.inventory_product.count_documents(
+            {'active': True, 'is_low_stock': True}),
+        'updated_at': timezone.now(),
+    }
+
+
+def rebuild_summary(db):
+    summary = compute_summary(db)
+    db.inventory_summary.replace_one({'_id': SUMMARY_ID}, summary, upsert=True)
+    return summary
+
+
+def get_summary(db):
+    """The stored summary, built on first use."""
+    return db.inventory_summary.find_one({'_id': SUMMARY_ID}) or rebuild_summary(db)
+
+
+def check_summary(db):
+    """Return a list of human-readable differences between stored and actual."""
+    stored = db.inventory_summary.find_one({'_id': SUMMARY_ID})
+    if stored is None:
+        return ['summary document is missing']
+    actual = compute_summary(db)
+    problems = []
+
+    for field in ('products_count', 'suppliers_count', 'low_stock_count'):
+        if stored.get(field, 0) != actual[field]:
+            problems.append(f'{field}: stored {stored.get(field, 0)}, actual {actual[field]}')
+    if abs(stored.get('total_value', 0) - actual['total_value']) > VALUE_TOLERANCE:
+        problems.append(f'total_value: stored {stored.get("total_value", 0):.2f}, '
+                        f'actual {actual["total_value"]:.2f}')
+
+    stored_categories = stored.get('categories', {})
+    for category_id in set(stored_categories) | set(actual['categories']):
+        have = stored_categories.get(category_id, {})
+        want = actual['categories'].get(category_id, {})
+        if have.get('count', 0) != want.get('count', 0):
+            problems.append(f'category {category_id} count: stored {have.get("count", 0)}, '
+                            f'actual {want.get("count", 0)}')
+        if abs(have.get('value', 0) - want.get('value', 0)) > VALUE_TOLERANCE:
+            problems.append(f'category {category_id} value: stored {have.get("value", 0):.2f}, '
+                            f'actual {want.get("value", 0):.2f}')
+    return problems
@@ -0,0 +1,197 @@
+"""
+Synthetic inventory data for benchmarks.
+
+``seed_inventory`` fills a database with categories, suppliers, products
+and stock transactions shaped like a real catalogue rather than uniform
+noise:
+
+* category and supplier sizes follow a Zipf-like law, so a few of each own
+  most of the products;
+* prices are log-normal and stock levels negative-binomial, with about one
+  product in ten at or below its reorder level;
+* transaction volume per product is Pareto-distributed (a few best sellers)
+  and spread over the last HISTORY_DAYS days with weekday and business-hour
+  peaks; roughly two in three movements are OUT.
+
+Documents carry the same derived fields as the write paths (low stock,
+search, rollups, summary), so every view works against a seeded database
+without a backfill. Seeding is deterministic for a given ``seed``.
+"""
+import itertools
+import random
+import uuid
+from datetime import timedelta
+
+from django.utils import timezone
+
+from . import rollups, timeseries, versions
+from .lowstock import low_stock_fields
+from .search import product_search_fields, supplier_search_fields
+from .summary import rebuild_summary
+
+HISTORY_DAYS = 90
+BATCH_SIZE = 5000
+
+ADJECTIVES = ['steel', 'brass', 'cordless', 'heavy', 'compact', 'industrial', 'red', 'blue',
+              'galvanised', 'precision', 'mini', 'outdoor', 'digital', 'hydraulic', 'flat']
+NOUNS = ['hammer', 'drill', 'wrench', 'bolt', 'washer', 'valve', 'hinge', 'cable', 'sander',
+         'clamp', 'bracket', 'gasket', 'ladder', 'pump', 'socket', 'screwdriver', 'saw']
+DEPARTMENTS = ['Tools', 'Fasteners', 'Plumbing', 'Electrical', 'Garden', 'Safety', 'Paint',
+               'Storage', 'Lighting', 'Hardware']
+COMPANIES = ['Acme', 'Northwind', 'Globex', 'Initech', 'Umbrella', 'Stark', 'Wayne', 'Hooli',
+             'Vandelay', 'Soylent', 'Tyrell', 'Cyberdyne']
+
+COLLECTIONS = ('inventory_category', 'inventory_supplier', 'inventory_product',
+               'inventory_stocktransaction', rollups.COLLECTION, 'inventory_summary')
+
+
+def default_sizes(products):
+    """Category, supplier and transaction counts that scale with ``products``."""
+    return {
+        'categories': max(10, products // 200),
+        'suppliers': max(5, products // 100),
+        'transactions': products * 10,
+    }
+
+
+def _zipf_weights(n, exponent=1.1):
+    return [1 / (rank ** exponent) for rank in range(1, n + 1)]
+
+
+def _insert(collection, documents):
+    for offset in range(0, len(documents), BATCH_SIZE):
+        collection.insert_many(documents[offset:offset + BATCH_SIZE], ordered=False)
+
+
+def _moment(rng, now):
+    # Weekdays and 08:00-18:00 are busier than nights and weekends.
+    while True:
+        moment = now - timedelta(days=rng.random() * HISTORY_DAYS)
+        weight = (1.0 if moment.weekday() < 5 else 0.4) * (1.0 if 8 <= moment.hour < 18 else 0.2)
+        if rng.random() < weight:
+            return moment
+
+
+def iter_transactions(rng, products, count, now):
+    """
+    ``count`` stock movements of ``products`` (documents with id, name and
+    price) as ``(transaction, price)`` pairs.
+    """
+    # Pareto popularity: the top fifth of products get most of the movements.
+    popularity = list(itertools.accumulate(rng.paretovariate(1.16) for _ in products))
+    for _ in range(count if products else 0):
+        picked = rng.choices(products, cum_weights=popularity)[0]
+        transaction_type = 'OUT' if rng.random() < 0.65 else 'IN'
+        quantity = max(1, int(rng.expovariate(1 / (3 if transaction_type == 'OUT' else 20))))
+        yield {
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'product_id': picked['id'],
+            'product': picked['name'],
+            'transaction_type': transaction_type,
+            'quantity': quantity,
+            'notes': '',
+            'created_by_id': None,
+            'transaction_date': _moment(rng, now),
+        }, picked['price']
+
+
+def seed_inventory(db, products, categories=None, suppliers=None, transactions=None, seed=0,
+                   progress=None):
+    """
+    Replace the inventory collections of ``db`` with a synthetic catalogue.
+    Sizes not given come from ``default_sizes``. Returns the counts written.
+    """
+    sizes = default_sizes(products)
+    categories = sizes['categories'] if categories is None else categories
+    suppliers = sizes['suppliers'] if suppliers is None else suppliers
+    transactions = sizes['transactions'] if transactions is None else transactions
+    rng = random.Random(seed)
+    now = timezone.now()
+    for name in COLLECTIONS:
+        db[name].drop()
+    timeseries.create_transactions(db)
+
+    category_docs = [{
+        'id': str(uuid.UUID(int=rng.getrandbits(128))),
+        'name': f'{DEPARTMENTS[n % len(DEPARTMENTS)]} {n // len(DEPARTMENTS) + 1}',
+        'description': f'{DEPARTMENTS[n % len(DEPARTMENTS)]} range',
+        'active': True,
+        'created_at': now - timedelta(days=365),
+    } for n in range(categories)]
+    _insert(db.inventory_category, category_docs)
+
+    supplier_docs = []
+    for n in range(suppliers):
+        company = f'{COMPANIES[n % len(COMPANIES)]} {n // len(COMPANIES) + 1}'
+        supplier = {
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'name': company,
+            'contact_person': f'Contact {n + 1}',
+            'email': f'orders{n + 1}@{COMPANIES[n % len(COMPANIES)].lower()}.example',
+            'phone': f'555-{n:04d}',
+            'address': f'{n + 1} Industrial Way',
+            'active': True,
+            'created_at': now - timedelta(days=rng.randint(30, 365)),
+        }
+        supplier.update(supplier_search_fields(supplier))
+        supplier_docs.append(supplier)
+    _insert(db.inventory_supplier, supplier_docs)
+    if progress:
+        progress('categories and suppliers', categories + suppliers)
+
+    category_weights = _zipf_weights(categories)
+    supplier_weights = _zipf_weights(suppliers)
+    product_docs = []
+    for n in range(products):
+        category = rng.choices(category_docs, category_weights)[0]
+        supplier = rng.choices(supplier_docs, supplier_weights)[0]
+        reorder_level = rng.choice((5, 10, 10, 20, 25, 50))
+        # Negative binomial via a gamma-Poisson mixture, centred on a few
+        # reorder levels' worth of stock.
+        stock = int(rng.gammavariate(2.0, reorder_level * 1.5))
+        product = {
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'name': f'{rng.choice(ADJECTIVES).title()} {rng.choice(NOUNS)} {n % 500}',
+            'sku': f'{rng.choice(NOUNS)[:3].upper()}-{n:07d}',
+            'description': ' '.join(rng.choices(ADJECTIVES + NOUNS, k=8)),
+            'category': category['name'],
+            'category_id': category['id'],
+            'supplier': supplier['name'],
+            'supplier_id': supplier['id'],
+            'price': round(rng.lognormvariate(3.0, 1.0), 2),
+            'stock_quantity': stock,
+            'reorder_level': reorder_level,
+            'active': rng.random() > 0.02,
+            'created_at': now - timedelta(days=rng.randint(HISTORY_DAYS, 720)),
+        }
+        product.update(low_stock_fields(product))
+        product.update(product_search_fields(product))
+        product_docs.append(product)
+    _insert(db.inventory_product, product_docs)
+    if progress:
+        progress('products', products)
+
+    written = 0
+    batch = []
+    for movement in iter_transactions(rng, product_docs, transactions, now):
+        batch.append(movement)
+        if len(batch) >= BATCH_SIZE:
+            written += _write_transactions(db, batch)
+            batch = []
+            if progress:
+                progress('transactions', written)
+    written += _write_transactions(db, batch)
+
+    rebuild_summary(db)
+    versions.bump(db, versions.PRODUCTS, versions.CATEGORIES, versions.SUPPLIERS,
+                  versions.TRANSACTIONS, versions.ROLLUPS)
+    return {'categories': categories, 'suppliers': suppliers, 'products': products,
+            'transactions': written}
+
+
+def _write_transactions(db, batch):
+    if not batch:
+        return 0
+    db.inventory_stocktransaction.insert_many([t for t, _ in batch], ordered=False)
+    rollups.record_movements(db, batch)
+    return len(batch)
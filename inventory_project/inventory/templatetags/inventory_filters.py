@@ -1,4 +1,7 @@
 from django import template
+from django.utils.html import format_html
+
+from inventory import images
 
 register = template.Library()
 
@@ -9,3 +12,26 @@ def multiply(value, arg):
         return float(value) * float(arg)
     except (ValueError, TypeError):
         return 0
+
+
+@register.simple_tag
+def product_image(product, size='thumb', css_class='', original=False):
+    """
+    A <picture> of the product's ``size`` variant, WebP with a JPEG
+    fallback. Until the variants exist it renders nothing, or the uploaded
+    original with ``original=True``.
+    """
+    webp = images.image_url(product, size, 'webp')
+    if webp is None:
+        url = images.original_url(product) if original else None
+        if url is None:
+            return ''
+        return format_html('<img src="{}" alt="{}" class="{}">', url, product.get('name', ''),
+                           css_class)
+    variant = product['image_variants'][size]
+    return format_html(
+        '<picture><source srcset="{}" type="image/webp">'
+        '<img src="{}" width="{}" height="{}" alt="{}" class="{}" loading="lazy" '
+        'decoding="async"></picture>',
+        webp, images.image_url(product, size, 'jpeg'), variant['width'], variant['height'],
+        product.get('name', ''), css_class)
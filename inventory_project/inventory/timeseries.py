@@ -0,0 +1,237 @@
+"""
+Time-series layout of ``inventory_stocktransaction``.
+
+Stock transactions are append-only measurements over time, which is what
+MongoDB's time-series collections (5.0+) store best: documents are packed
+into compressed buckets per ``metaField`` value and time span, so the
+collection and its indexes are a fraction of the size of one document per
+movement, and range scans over ``transaction_date`` read a few buckets.
+
+The collection is either ``regular`` (the default) or ``timeseries``,
+chosen with INVENTORY_TIMESERIES['ENABLED']; migration 0006 converts it
+when the setting is on and ``manage.py convert_transactions`` converts
+either way afterwards. Stop the app while converting: movements written
+during the copy would be lost or create the collection in the wrong
+layout. Running processes cache the layout, so restart them afterwards.
+
+``transaction_date`` is the ``timeField`` and ``product_id`` the
+``metaField``. The transaction type stays a measurement, so every query
+filtering on ``product_id`` and every document the readers see keeps its
+shape. What the time-series layout gives up:
+
+* no unique indexes: ``flush_outbox`` marks each outbox entry as claimed
+  on its product, inserts it and only then pulls it, so concurrent
+  flushes cannot both deliver it and a crash loses nothing.
+  ``drain_outbox`` takes over claims left by a dead process once stale,
+  skipping entries that were inserted; ``verify_ledger`` reports the
+  duplicates of a flush that outlived its claim;
+* no writes inside multi-document transactions: stock movements use the
+  product outbox instead (see stock.py);
+* no change streams: the event bus sees no transactions, the write paths
+  keep the rollups current themselves;
+* deleting by ``_id`` (``archive_transactions``) needs MongoDB 7.0.
+"""
+from datetime import datetime
+from weakref import WeakKeyDictionary
+
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+
+from . import versions
+
+TRANSACTIONS = versions.TRANSACTIONS
+LAYOUTS = ('regular', 'timeseries')
+GRANULARITIES = ('seconds', 'minutes', 'hours')
+
+# The regular collection is kept under this name after converting, until
+# dropped with --drop-backup.
+BACKUP = f'{TRANSACTIONS}_regular'
+# Converting back copies into this collection, which then takes the name.
+STAGING = f'{TRANSACTIONS}_converting'
+
+DEFAULTS = {
+    'ENABLED': False,
+    # Movements of one product are hours apart or more.
+    'GRANULARITY': 'hours',
+    'META_FIELD': 'product_id',
+    'BATCH_SIZE': 5000,
+}
+
+DUPLICATE_KEY = 11000
+
+# {client: {(database, collection): layout}}
+_layouts = WeakKeyDictionary()
+
+
+class ConversionError(Exception):
+    pass
+
+
+def timeseries_options():
+    """DEFAULTS overridden by settings.INVENTORY_TIMESERIES."""
+    return dict(DEFAULTS, **getattr(settings, 'INVENTORY_TIMESERIES', {}))
+
+
+def configured_layout():
+    return 'timeseries' if timeseries_options()['ENABLED'] else 'regular'
+
+
+def collection_options(granularity=None):
+    """``create_collection`` keyword arguments for the time-series layout."""
+    options = timeseries_options()
+    granularity = granularity or options['GRANULARITY']
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'Unknown time-series granularity "{granularity}"')
+    return {'timeseries': {
+        'timeField': 'transaction_date',
+        'metaField': options['META_FIELD'],
+        'granularity': granularity,
+    }}
+
+
+def layout(db, name=TRANSACTIONS):
+    """``'timeseries'`` or ``'regular'`` (also for a missing collection). Cached per client."""
+    cached = _layouts.setdefault(db.client, {})
+    key = (db.name, name)
+    if key not in cached:
+        try:
+            info = next(db.list_collections(filter={'name': name}), None)
+        except NotImplementedError:
+            # mongomock (bench_views --mongomock) has neither
+            # list_collections nor time-series collections.
+            info = None
+        cached[key] = 'timeseries' if info and info.get('type') == 'timeseries' else 'regular'
+    return cached[key]
+
+
+def uses_timeseries(db):
+    return layout(db) == 'timeseries'
+
+
+def forget(db):
+    """Drop this process's cached layouts of ``db``."""
+    cached = _layouts.get(db.client, {})
+    for key in [k for k in cached if k[0] == db.name]:
+        del cached[key]
+
+
+def create_transactions(db, layout=None, granularity=None):
+    """
+    Create an empty transactions collection in ``layout`` (default: the
+    configured one), e.g. after dropping it to reseed.
+    """
+    layout = layout or configured_layout()
+    if layout == 'timeseries':
+        db.create_collection(TRANSACTIONS, **collection_options(granularity))
+    else:
+        db.create_collection(TRANSACTIONS)
+    forget(db)
+
+
+def _exists(db, name):
+    return bool(db.list_collection_names(filter={'name': name}))
+
+
+def _timed(document):
+    # Every time-series document needs its timeField; transactions written
+    # without a date are placed at their ObjectId's creation time.
+    if not isinstance(document.get('transaction_date'), datetime):
+        document['transaction_date'] = document['_id'].generation_time.replace(tzinfo=None)
+    return document
+
+
+def _copy(source, target, batch_size, progress=None, resume=False):
+    copied = 0
+    batch = []
+    for document in source.find().batch_size(batch_size):
+        batch.append(_timed(document))
+        if len(batch) >= batch_size:
+            copied += _insert(target, batch, resume)
+            batch = []
+            if progress:
+                progress(copied)
+    if batch:
+        copied += _insert(target, batch, resume)
+        if progress:
+            progress(copied)
+    return copied
+
+
+def _insert(target, batch, resume):
+    if resume:
+        # Time-series collections have no unique index to reject what an
+        # interrupted conversion already copied.
+        present = set(target.distinct('_id', {'_id': {'$in': [d['_id'] for d in batch]}}))
+        batch = [d for d in batch if d['_id'] not in present]
+    if not batch:
+        return 0
+    try:
+        target.insert_many(batch, ordered=False)
+    except BulkWriteError as exc:
+        if any(e['code'] != DUPLICATE_KEY for e in exc.details['writeErrors']):
+            raise
+    return len(batch)
+
+
+def _check_counts(source, target):
+    expected, found = source.count_documents({}), target.count_documents({})
+    if found < expected:
+        raise ConversionError(
+            f'{target.name} has {found} transaction(s), {source.name} {expected}; '
+            f'nothing was dropped')
+
+
+def _to_timeseries(db, options, granularity, progress):
+    if _exists(db, TRANSACTIONS) and layout(db) == 'regular':
+        if _exists(db, BACKUP):
+            raise ConversionError(f'{BACKUP} already exists; drop it first')
+        db[TRANSACTIONS].rename(BACKUP)
+        forget(db)
+    # Resuming: the backup was made and the time-series collection may be part filled.
+    resume = _exists(db, TRANSACTIONS)
+    if not resume:
+        create_transactions(db, 'timeseries', granularity)
+    if not _exists(db, BACKUP):
+        return 0
+    copied = _copy(db[BACKUP], db[TRANSACTIONS], options['BATCH_SIZE'], progress, resume)
+    _check_counts(db[BACKUP], db[TRANSACTIONS])
+    return copied
+
+
+def _to_regular(db, options, progress):
+    # Time-series collections cannot be renamed, so the copy takes the name.
+    db[STAGING].drop()
+    copied = _copy(db[TRANSACTIONS], db[STAGING], options['BATCH_SIZE'], progress)
+    _check_counts(db[TRANSACTIONS], db[STAGING])
+    db[TRANSACTIONS].drop()
+    db[STAGING].rename(TRANSACTIONS)
+    return copied
+
+
+def convert(db, to, drop_backup=False, granularity=None, progress=None):
+    """
+    Convert ``inventory_stocktransaction`` to layout ``to``, copying every
+    transaction, and rebuild its indexes. Converting to ``timeseries``
+    keeps the regular collection as BACKUP, dropped with ``drop_backup``.
+    An interrupted conversion to ``timeseries`` resumes where it stopped.
+    Returns the number of transactions copied.
+    """
+    from .indexes import ensure_indexes
+
+    if to not in LAYOUTS:
+        raise ValueError(f'Unknown transaction layout "{to}"')
+    options = timeseries_options()
+    forget(db)
+    copied = 0
+    if to == 'timeseries' and (layout(db) == 'regular' or _exists(db, BACKUP)):
+        copied = _to_timeseries(db, options, granularity, progress)
+    elif to == 'regular' and layout(db) == 'timeseries':
+        copied = _to_regular(db, options, progress)
+    if drop_backup and to == 'timeseries':
+        db[BACKUP].drop()
+    forget(db)
+    ensure_indexes(db, [TRANSACTIONS])
+    if copied:
+        versions.bump(db, TRANSACTIONS)
+    return copied
+
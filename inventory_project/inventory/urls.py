@@ -1,25 +1,33 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Read-heavy views served by their async (Motor) versions under ASGI
+if getattr(settings, 'INVENTORY_ASYNC_VIEWS', False):
+    from . import async_views as read_views
+else:
+    read_views = views
+
 urlpatterns = [
-    path('', views.dashboard, name='dashboard'),
+    path('', read_views.dashboard, name='dashboard'),
 #     path('signup/', views.signup, name='signup'),
-    path('products/', views.product_list, name='product_list'),
+    path('products/', read_views.product_list, name='product_list'),
     # Add more URL patterns as needed
 
     # Product URLs
     path('products/create/', views.product_create, name='product_create'),
+    path('products/import/', views.product_import, name='product_import'),
+    path('products/autocomplete/', views.product_autocomplete, name='product_autocomplete'),
     path('products/<str:pk>/', views.product_detail, name='product_detail'),
     path('products/<str:pk>/edit/', views.product_update, name='product_update'),
     path('products/<str:pk>/delete/', views.product_delete, name='product_delete'),
+    path('images/<str:digest>/<str:name>', views.product_image, name='product_image'),
+    path('stock/bulk/', views.stock_bulk, name='stock_bulk'),
+    path('stock/as-of/', views.stock_as_of, name='stock_as_of'),
 
 
-    # Supplier URLs
-    path('suppliers/', views.supplier_list, name='supplier_list'),
-    path('suppliers/<int:pk>/', views.supplier_detail, name='supplier_detail'),
-
     # Reports
-    path('reports/stock/', views.stock_report, name='stock_report'),
+    path('reports/stock/', read_views.stock_report, name='stock_report'),
     path('categories/', views.category_list, name='category_list'),
     path('categories/create/', views.category_create, name='category_create'),
     path('categories/<str:pk>/update/',
@@ -27,9 +35,11 @@ urlpatterns = [
     path('categories/<str:pk>/delete/',
          views.category_delete, name='category_delete'),
 
+    # Supplier URLs
     path('suppliers/', views.supplier_list, name='supplier_list'),
     path('suppliers/create/', views.supplier_create, name='supplier_create'),
-    path('suppliers/<str:pk>/', views.supplier_detail, name='supplier_detail'),
+    path('suppliers/autocomplete/', views.supplier_autocomplete, name='supplier_autocomplete'),
+    path('suppliers/<str:pk>/', read_views.supplier_detail, name='supplier_detail'),
     path('suppliers/<str:pk>/update/',
          views.supplier_update, name='supplier_update'),
     path('suppliers/<str:pk>/delete/',
@@ -37,4 +47,6 @@ urlpatterns = [
     path('signup/', views.signup_view, name='signup'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
+    path('health/mongo-pool/', views.mongo_pool_stats, name='mongo_pool_stats'),
+    path('health/lookup-cache/', views.lookup_cache_stats, name='lookup_cache_stats'),
 ]
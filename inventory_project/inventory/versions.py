@@ -0,0 +1,48 @@
+"""
+Per-collection version counters.
+
+Every write path bumps the counters of the collections it changed, so a
+page that depends on a few collections can tell whether anything changed
+since it was last rendered with a single small query (see responsecache).
+"""
+from datetime import timezone as dt_timezone
+
+from django.utils import timezone
+from pymongo import UpdateOne
+
+COLLECTION = 'inventory_versions'
+
+PRODUCTS = 'inventory_product'
+CATEGORIES = 'inventory_category'
+SUPPLIERS = 'inventory_supplier'
+TRANSACTIONS = 'inventory_stocktransaction'
+ROLLUPS = 'inventory_stock_rollup'
+
+# Collections touched by a stock movement.
+STOCK_MOVEMENT = (PRODUCTS, TRANSACTIONS, ROLLUPS)
+
+
+def bump(db, *collections):
+    """Increment the version of each collection in one round trip."""
+    if not collections:
+        return
+    now = timezone.now()
+    db[COLLECTION].bulk_write([
+        UpdateOne({'_id': name}, {'$inc': {'version': 1}, '$set': {'updated_at': now}},
+                  upsert=True)
+        for name in dict.fromkeys(collections)
+    ], ordered=False)
+
+
+def current(db, collections):
+    """
+    ``(versions, last_modified)``: a tuple of the collections' versions in
+    the given order (0 if never bumped) and the latest bump time, or None.
+    """
+    found = {d['_id']: d for d in db[COLLECTION].find({'_id': {'$in': list(collections)}})}
+    versions = tuple(found.get(name, {}).get('version', 0) for name in collections)
+    stamps = [d['updated_at'] for d in found.values() if d.get('updated_at')]
+    last_modified = max(stamps) if stamps else None
+    if last_modified is not None and last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=dt_timezone.utc)
+    return versions, last_modified
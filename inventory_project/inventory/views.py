@@ -4,20 +4,45 @@ from django.contrib.auth import login
 from django.contrib import messages
 from .forms import *
 from django.utils import timezone
-from datetime import timedelta
-from django.conf import settings
-from pymongo import MongoClient
-import uuid
-import os
-from django.http import Http404
+from django.utils.dateparse import parse_datetime
+from datetime import datetime, timedelta, timezone as dt_timezone
+import io
+import json
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
 from django.contrib.auth.hashers import make_password, check_password
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth import logout
-
-# MongoDB connection
-client = MongoClient('mongodb://localhost:27017/')
-db = client['inventory']
+from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.http import require_POST, require_safe
+from .mongo import db, pool_stats
+from .queries import attach_product_counts
+from . import archive, exports, images, ledger, lookups, repository, rollups, summary, versions
+from .lowstock import LOW_STOCK_EXPRESSIONS, low_stock_fields, low_stock_products
+from .search import (autocomplete_products, autocomplete_suppliers, product_search_fields,
+                     search_products, search_suppliers, supplier_search_fields)
+from .importer import detect_format, import_products, iter_rows
+from .stock import (OUTBOX, InsufficientStock, ProductNotFound, StockChanged, adjust_stock,
+                    apply_movement, apply_movements, flush_outbox, opening_entry)
+from .pagination import (InvalidCursor, Page, jsonable, keyset_page, next_page_url,
+                         page_size_from)
+from .responsecache import versioned_page
+
+# Fields each list template renders; everything else stays on the server.
+PRODUCT_LIST_FIELDS = ['id', 'name', 'sku', 'category', 'category_id', 'supplier',
+                       'supplier_id', 'stock_quantity', 'price', 'image_hash', 'image_variants']
+SUPPLIER_LIST_FIELDS = ['id', 'name', 'contact_person', 'email', 'phone', 'address']
+# What list and report pages show of a product's category and supplier
+REFERENCE_FIELDS = {'_id': 0, 'id': 1, 'name': 1}
+TRANSACTION_LIST_FIELDS = ['id', 'transaction_date', 'transaction_type', 'quantity',
+                           'created_by_id', 'notes']
+
+DASHBOARD_LOW_STOCK_LIMIT = 10
+PRODUCT_LIST_SORT = [('name', ASCENDING), ('_id', ASCENDING)]
+# Preset top-seller windows on the stock report, in days.
+REPORT_WINDOWS = (7, 30, 90)
 
 
 def signup_view(request):
@@ -62,98 +87,93 @@ def logout_view(request):
     messages.info(request, "You have been logged out successfully.")
     return redirect('dashboard')  # Changed from 'home' to 'dashboard'
 
-@login_required
-def dashboard(request):
+def _dashboard_context(stats, low_stock, recent_transactions, recent_suppliers):
     # Categories with product count
-    categories_pipeline = [
-        {'$match': {'active': True}},
-        {
-            '$lookup': {
-                'from': 'inventory_product',
-                'localField': 'id',
-                'foreignField': 'category_id',
-                'as': 'products'
-            }
-        },
-        {
-            '$project': {
-                'name': 1,
-                'product_count': {'$size': '$products'}
-            }
-        },
-        {'$sort': {'name': 1}}
-    ]
-
-    # Total inventory value
-    value_pipeline = [
-        {'$match': {'active': True}},
-        {
-            '$group': {
-                '_id': None,
-                'total_value': {
-                    '$sum': {'$multiply': ['$stock_quantity', '$price']}
-                }
-            }
-        }
-    ]
-
-    pipeline = [
-        {
-            '$match': {
-                '$expr': {  # Use $expr to compare fields within the same document
-                    '$lte': ['$stock_quantity', '$reorder_level']
-                }
-            }
-        }
-    ]
+    categories = sorted(
+        (
+            {'name': c['name'], 'product_count': c.get('count', 0)}
+            for c in stats.get('categories', {}).values()
+            if c.get('active') and c.get('name')
+        ),
+        key=lambda c: c['name']
+    )
 
-    context = {
-        'products_count': db.inventory_product.count_documents({'active': True}),
-        'low_stock_products': list(db.inventory_product.aggregate(pipeline)),
-        'suppliers_count': db.inventory_supplier.count_documents({'active': True}),
-        'recent_transactions': list(db.inventory_stocktransaction.find().sort('transaction_date', -1).limit(5)),
-        'categories': list(db.inventory_category.aggregate(categories_pipeline)),
-        'recent_suppliers': list(db.inventory_supplier.find().sort('created_at', -1).limit(5)),
-        'total_value': next(db.inventory_product.aggregate(value_pipeline), {}).get('total_value', 0)
+    return {
+        'products_count': stats.get('products_count', 0),
+        'low_stock_products': low_stock,
+        'low_stock_count': stats.get('low_stock_count', 0),
+        'suppliers_count': stats.get('suppliers_count', 0),
+        'recent_transactions': recent_transactions,
+        'categories': categories,
+        'recent_suppliers': recent_suppliers,
+        'total_value': stats.get('total_value', 0)
     }
-    print(context)
+
+
+@login_required
+def dashboard(request):
+    # Counts and value come from the maintained summary
+    context = _dashboard_context(
+        summary.get_summary(db),
+        low_stock_products(db, DASHBOARD_LOW_STOCK_LIMIT),
+        list(db.inventory_stocktransaction.find().sort('transaction_date', -1).limit(5)),
+        list(db.inventory_supplier.find(
+            {}, {'id': 1, 'name': 1, 'email': 1}).sort('created_at', -1).limit(5)),
+    )
     return render(request, 'inventory/dashboard.html', context)
 
 
 
 
+def _duplicate(form, exc, kind):
+    """Put a unique index rejection on the form field it is about."""
+    key = list((exc.details or {}).get('keyPattern') or ())
+    field = key[0] if key and key[0] in form.fields else None
+    form.add_error(field, f'Another {kind} already has this {field or "identifier"}.')
+
+
 @login_required
 def product_create(request):
     if request.method == 'POST':
         form = ProductForm(request.POST, request.FILES)
         if form.is_valid():
             product_data = form.cleaned_data
-            product_data['id'] = str(uuid.uuid4())
+            product_data['id'] = repository.new_id()
             product_data['active'] = True
             product_data['created_at'] = timezone.now()
-            product_data['category'] = form.cleaned_data['category'].name
-            product_data['supplier'] = form.cleaned_data['supplier'].name
-            # Handle image upload
-            if request.FILES.get('image'):
-                image = request.FILES['image']
-                image_name = f"{product_data['id']}_{image.name}"
-                image_path = os.path.join('products', image_name)
-                full_path = os.path.join(settings.MEDIA_ROOT, image_path)
-
-                os.makedirs(os.path.dirname(full_path), exist_ok=True)
-                with open(full_path, 'wb+') as destination:
-                    for chunk in image.chunks():
-                        destination.write(chunk)
-
-                product_data['image'] = image_path
+            product_data['category'] = form.cleaned_data['category'] or None
+            product_data['supplier'] = form.cleaned_data['supplier'] or None
+            product_data['category_id'] = lookups.category_ids(db).get(product_data['category'])
+            product_data['supplier_id'] = lookups.supplier_ids(db).get(product_data['supplier'])
+            # Content-addressed original; thumbnails are made in the background
+            upload = product_data.pop('image', None)
+            if upload:
+                product_data.update(images.store_upload(upload))
 
             # Convert decimal to float for MongoDB
             product_data['price'] = float(product_data['price'])
-
-            # Insert into MongoDB
-            db.inventory_product.insert_one(product_data)
-            messages.success(request, 'Product created successfully.')
-            return redirect('product_detail', pk=product_data['id'])
+            product_data.update(low_stock_fields(product_data))
+            product_data.update(product_search_fields(product_data))
+            # Opening stock is the first ledger entry, delivered like a movement
+            opening = opening_entry(product_data['id'], product_data['stock_quantity'],
+                                    product_data['name'], request.user.id)
+            product_data['ledger_sequence'] = 1 if opening else 0
+            if opening:
+                product_data[OUTBOX] = [opening]
+
+            # Insert into MongoDB; sku_unique rejects an SKU in use
+            try:
+                db.inventory_product.insert_one(product_data)
+            except DuplicateKeyError as exc:
+                _duplicate(form, exc, 'product')
+            else:
+                if opening:
+                    flush_outbox(db, [opening])
+                summary.product_created(db, product_data)
+                versions.bump(db, versions.PRODUCTS, versions.TRANSACTIONS)
+                images.schedule(db, product_data)
+                messages.success(request, 'Product created successfully.')
+                return redirect('product_detail', pk=product_data['id'])
     else:
         form = ProductForm()
 
@@ -161,159 +181,305 @@ def product_create(request):
 
 
 @login_required
-def product_list(request):
-    query = {'active': True}
+def product_import(request):
+    report = None
+    if request.method == 'POST':
+        form = ProductImportUploadForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            # Read the upload as a text stream so rows are parsed lazily
+            stream = io.TextIOWrapper(upload.file, encoding='utf-8', newline='')
+            report = import_products(db, iter_rows(stream, detect_format(upload.name)))
+            if report.imported:
+                messages.success(request, f'Imported {report.imported} products.')
+            if report.rejected:
+                messages.error(request, f'{report.rejected} rows were rejected.')
+            if report.skipped:
+                messages.warning(request, f'{report.skipped} rows matched deleted products '
+                                          f'and were skipped.')
+    else:
+        form = ProductImportUploadForm()
 
-    # Handle search
-    search_query = request.GET.get('search')
-    if search_query:
-        query['$or'] = [
-            {'name': {'$regex': search_query, '$options': 'i'}},
-            {'sku': {'$regex': search_query, '$options': 'i'}}
-        ]
+    return render(request, 'inventory/product_import.html', {
+        'form': form,
+        'report': report.as_dict() if report else None,
+    })
+
+
+def _product_list_query(request):
+    query = {'active': True}
 
     # Handle category filter
     category_id = request.GET.get('category')
     if category_id:
         query['category_id'] = category_id
 
-    # Get all products
-    products = list(db.inventory_product.find(query))
+    # Handle low stock filter
+    if request.GET.get('low_stock'):
+        query['is_low_stock'] = True
+    return query
 
-    # Ensure each product has an ID
-    for product in products:
-        if '_id' in product and not product.get('id'):
-            product['id'] = str(product['_id'])
 
-    # Get categories
-    categories = list(db.inventory_category.find({'active': True}))
+@login_required
+@versioned_page(versions.PRODUCTS, versions.CATEGORIES, versions.SUPPLIERS)
+def product_list(request):
+    query = _product_list_query(request)
+    search_query = request.GET.get('search')
 
-    # Debug print
-    print("Sample product:", products[0] if products else "No products found")
+    # Search results are ranked by relevance and come as a single page;
+    # otherwise get one page of products, ordered by name
+    if search_query:
+        page = Page(search_products(db, search_query, query, limit=page_size_from(request),
+                                    projection=PRODUCT_LIST_FIELDS), None)
+    else:
+        try:
+            page = keyset_page(
+                db.inventory_product, query,
+                sort=PRODUCT_LIST_SORT,
+                page_size=page_size_from(request),
+                cursor=request.GET.get('cursor'),
+                projection=PRODUCT_LIST_FIELDS,
+            )
+        except InvalidCursor:
+            return HttpResponseBadRequest('Invalid cursor')
+    products = page.items
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'results': [jsonable(p) for p in products],
+            'next_cursor': page.next_cursor,
+        })
+
+    # Resolve the page's categories and suppliers, one query each
+    repository.attach(db, products, 'category_id', 'supplier_id', projection=REFERENCE_FIELDS)
+    categories = lookups.categories(db)
 
     return render(request, 'inventory/product_list.html', {
         'products': products,
-        'categories': categories
+        'categories': categories,
+        'next_cursor': page.next_cursor,
+        'next_url': next_page_url(request, page.next_cursor),
     })
 
 
 @login_required
 def product_detail(request, pk):
-    # First try to find by id field
-    product = db.inventory_product.find_one({'id': pk, 'active': True})
-
-    if not product:
-        # Try to find by _id if not found by id
-        product = db.inventory_product.find_one({'_id': pk, 'active': True})
-
+    product = repository.get(db, 'product', pk)
     if not product:
         raise Http404("Product not found")
 
-    if '_id' in product and not product.get('id'):
-        product['id'] = str(product['_id'])
-        db.inventory_product.update_one(
-            {'_id': product['_id']},
-            {'$set': {'id': str(product['_id'])}}
-        )
-
-    transactions = list(db.inventory_stocktransaction.find(
-        {'product_id': pk}).sort('transaction_date', -1))
-
     if request.method == 'POST':
-        form = StockTransactionForm(request.POST)
+        form = StockTransactionForm(request.POST, page_product=product)
         if form.is_valid():
-            transaction_data = form.cleaned_data
-            transaction_data['product_id'] = pk
-            transaction_data['created_by_id'] = request.user.id
-            transaction_data['transaction_date'] = timezone.now()
-            transaction_data['id'] = str(uuid.uuid4())
-
-
-            print("Transaction data:", transaction_data)
-            transaction_data['product'] = form.cleaned_data['product'].name
-
-            # Update stock quantity
-            new_quantity = (
-                int(product['stock_quantity']) + int(transaction_data['quantity'])
-                if transaction_data['transaction_type'] == 'IN'
-                else product['stock_quantity'] - transaction_data['quantity']
-            )
-
-            if new_quantity < 0:
+            # Guarded $inc + transaction record in one atomic step
+            try:
+                apply_movement(
+                    db, product['id'],
+                    form.cleaned_data['transaction_type'],
+                    form.cleaned_data['quantity'],
+                    user_id=request.user.id,
+                    notes=form.cleaned_data['notes'],
+                    product_name=product.get('name'),
+                )
+            except InsufficientStock:
                 messages.error(request, 'Insufficient stock available.')
                 return redirect('product_detail', pk=pk)
+            except ProductNotFound:
+                raise Http404("Product not found")
 
-            # Update product stock
-            db.inventory_product.update_one(
-                {'id': pk},
-                {'$set': {'stock_quantity': new_quantity}}
-            )
-
-            # Insert transaction
-            db.inventory_stocktransaction.insert_one(transaction_data)
             messages.success(request, 'Stock updated successfully.')
             return redirect('product_detail', pk=pk)
     else:
-        form = StockTransactionForm()
+        form = StockTransactionForm(initial={'product': product.get('sku')},
+                                    page_product=product)
+
+    # Transaction history, newest first, one page at a time; older pages
+    # come from the archive once they reach past the hot collection
+    try:
+        page = archive.history(
+            db, product_id=pk,
+            page_size=page_size_from(request),
+            cursor=request.GET.get('cursor'),
+            projection=TRANSACTION_LIST_FIELDS,
+        )
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid cursor')
 
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'results': [jsonable(t) for t in page.items],
+            'next_cursor': page.next_cursor,
+        })
+
+    repository.attach(db, [product], 'category_id', 'supplier_id', projection=REFERENCE_FIELDS)
     context = {
         'product': product,
-        'transactions': transactions,
-        'form': form
+        'transactions': page.items,
+        'form': form,
+        'next_cursor': page.next_cursor,
+        'next_url': next_page_url(request, page.next_cursor),
     }
     return render(request, 'inventory/product_detail.html', context)
 
+def _autocomplete_limit(request):
+    try:
+        return max(1, min(int(request.GET.get('limit', 10)), 50))
+    except ValueError:
+        return 10
+
+
+@login_required
+def product_autocomplete(request):
+    results = autocomplete_products(db, request.GET.get('q', ''), _autocomplete_limit(request))
+    return JsonResponse({'results': results})
+
+
+@login_required
+def supplier_autocomplete(request):
+    results = autocomplete_suppliers(db, request.GET.get('q', ''), _autocomplete_limit(request))
+    return JsonResponse({'results': results})
+
+
+@login_required
+@require_POST
+def stock_bulk(request):
+    # Body: {"lines": [{"sku", "transaction_type", "quantity", "notes"}, ...],
+    #        "ordered": true}
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid JSON')
+    if isinstance(payload, list):
+        payload = {'lines': payload}
+    if not isinstance(payload, dict) or not isinstance(payload.get('lines'), list):
+        return HttpResponseBadRequest('Expected a list of lines')
+
+    result = apply_movements(
+        db, payload['lines'],
+        ordered=bool(payload.get('ordered', True)),
+        user_id=request.user.id,
+    )
+    return JsonResponse(result)
+
+
+@login_required
+@require_safe
+def stock_as_of(request):
+    # ?at=<ISO 8601 datetime, UTC if naive>[&sku=...&sku=...]; all products without sku
+    at = parse_datetime(request.GET.get('at', ''))
+    if at is None:
+        return HttpResponseBadRequest('Expected ?at=<ISO 8601 datetime>')
+    if timezone.is_naive(at):
+        at = timezone.make_aware(at, dt_timezone.utc)
+    query = {}
+    skus = request.GET.getlist('sku')
+    if skus:
+        query['sku'] = {'$in': skus}
+    products = {p['id']: p for p in db.inventory_product.find(query, {'_id': 0, 'id': 1,
+                                                                    'sku': 1})}
+    stock = ledger.as_of(db, at, list(products))
+    return JsonResponse({
+        'at': at.isoformat(),
+        'products': [{'id': pid, 'sku': products[pid].get('sku'), 'stock_quantity': quantity}
+                     for pid, quantity in stock.items()],
+    })
+
+
+def _stock_changed_form(request, current):
+    # The same submission against the current stock, so saving again is a
+    # deliberate choice made with the new figure on screen.
+    data = request.POST.copy()
+    data['stock_quantity_seen'] = current
+    form = ProductEditForm(data, request.FILES)
+    form.is_valid()
+    form.add_error('stock_quantity', f'Stock changed to {current} while this form was open. '
+                                     f'Check the figure and save again.')
+    return form
+
+
 @login_required
 def product_update(request, pk):
     product = db.inventory_product.find_one({'id': pk, 'active': True})
     if not product:
         raise Http404("Product not found")
+    title = f'Edit {product.get("name")}'
 
     if request.method == 'POST':
-        form = ProductForm(request.POST, request.FILES)
+        form = ProductEditForm(request.POST, request.FILES)
         if form.is_valid():
             update_data = form.cleaned_data
-            update_data['updated_at'] = timezone.now()
-
-            # Handle image upload
-            if request.FILES.get('image'):
-                # Delete old image if exists
-                if product.get('image'):
-                    old_image_path = os.path.join(
-                        settings.MEDIA_ROOT, product['image'])
-                    if os.path.exists(old_image_path):
-                        os.remove(old_image_path)
-
-                image = request.FILES['image']
-                image_name = f"{pk}_{image.name}"
-                image_path = os.path.join('products', image_name)
-                full_path = os.path.join(settings.MEDIA_ROOT, image_path)
+            # Stock is only written when it was edited, and only if nothing
+            # moved it since the form was opened; otherwise the figure on the
+            # form would write over those movements.
+            quantity = update_data.pop('stock_quantity')
+            seen = update_data.pop('stock_quantity_seen')
+            current = product.get('stock_quantity', 0)
+            if quantity != seen and current != seen:
+                form = _stock_changed_form(request, current)
+                return render(request, 'inventory/product_form.html',
+                              {'form': form, 'title': title})
 
-                os.makedirs(os.path.dirname(full_path), exist_ok=True)
-                with open(full_path, 'wb+') as destination:
-                    for chunk in image.chunks():
-                        destination.write(chunk)
-
-                update_data['image'] = image_path
+            update_data['updated_at'] = timezone.now()
+            update_data['category'] = update_data['category'] or None
+            update_data['supplier'] = update_data['supplier'] or None
+            update_data['category_id'] = lookups.category_ids(db).get(update_data['category'])
+            update_data['supplier_id'] = lookups.supplier_ids(db).get(update_data['supplier'])
+
+            # Content-addressed original; thumbnails are made in the background.
+            # Files of the previous image may be shared with other products
+            # and are left to process_product_images --prune.
+            upload = update_data.pop('image', None)
+            if upload:
+                update_data.update(images.store_upload(upload))
 
             # Convert decimal to float for MongoDB
             update_data['price'] = float(update_data['price'])
-
-            db.inventory_product.update_one(
-                {'id': pk},
-                {'$set': update_data}
-            )
-            messages.success(request, 'Product updated successfully.')
-            return redirect('product_detail', pk=pk)
+            update_data.update(product_search_fields(update_data))
+
+            try:
+                # Low-stock fields from the stock as stored, not as read above
+                before = db.inventory_product.find_one_and_update(
+                    {'id': pk, 'active': True},
+                    [{'$set': {k: {'$literal': v} for k, v in update_data.items()}},
+                     {'$set': LOW_STOCK_EXPRESSIONS}],
+                    projection={OUTBOX: 0},
+                )
+            except DuplicateKeyError as exc:
+                _duplicate(form, exc, 'product')
+            else:
+                if before is None:
+                    raise Http404("Product not found")
+                after = {**before, **update_data}
+                after.update(low_stock_fields(after))
+                summary.product_updated(db, before, after)
+                versions.bump(db, versions.PRODUCTS)
+                try:
+                    # A changed stock figure is recorded in the ledger as an adjustment
+                    adjust_stock(db, pk, quantity, request.user.id,
+                                 'Stock edited on the product form', update_data['name'],
+                                 expected=seen)
+                except StockChanged as exc:
+                    messages.warning(request, f'Stock changed to {exc.current} while saving, '
+                                              f'so it was not set to {quantity}.')
+                images.schedule(db, update_data)
+                messages.success(request, 'Product updated successfully.')
+                return redirect('product_detail', pk=pk)
     else:
-        form = ProductForm(initial=product)
+        form = ProductEditForm(initial={**product,
+                                        'stock_quantity_seen': product.get('stock_quantity', 0)})
 
     return render(request, 'inventory/product_form.html', {
         'form': form,
-        'title': f'Edit {product.get("name")}'
+        'title': title
     })
 
 
+@require_safe
+def product_image(request, digest, name):
+    # Not behind login, like MEDIA_URL: the URL carries the image's SHA-256.
+    return images.serve(request, digest, name)
+
+
 @login_required
 def product_delete(request, pk):
     product = db.inventory_product.find_one({'id': pk, 'active': True})
@@ -330,6 +496,8 @@ def product_delete(request, pk):
                 }
             }
         )
+        summary.product_deleted(db, product)
+        versions.bump(db, versions.PRODUCTS)
         messages.success(request, 'Product deleted successfully.')
         return redirect('product_list')
 
@@ -366,7 +534,7 @@ def category_create(request):
         form = CategoryForm(request.POST)
         if form.is_valid():
             category_data = form.cleaned_data
-            category_data['id'] = str(uuid.uuid4())
+            category_data['id'] = repository.new_id()
             category_data['active'] = True
             category_data['created_at'] = timezone.now()
 
@@ -380,9 +548,16 @@ def category_create(request):
                 messages.error(
                     request, 'Category with this name already exists.')
             else:
-                db.inventory_category.insert_one(category_data)
-                messages.success(request, 'Category created successfully.')
-                return redirect('category_list')
+                try:
+                    db.inventory_category.insert_one(category_data)
+                except DuplicateKeyError as exc:
+                    _duplicate(form, exc, 'category')
+                else:
+                    summary.category_saved(db, category_data)
+                    lookups.invalidate_categories()
+                    versions.bump(db, versions.CATEGORIES)
+                    messages.success(request, 'Category created successfully.')
+                    return redirect('category_list')
     else:
         form = CategoryForm()
 
@@ -408,6 +583,12 @@ def category_update(request, pk):
                 {'id': pk},
                 {'$set': update_data}
             )
+            summary.category_saved(db, {**category, **update_data})
+            lookups.invalidate_categories()
+            if repository.rename_references(db, 'category', pk, update_data['name']):
+                versions.bump(db, versions.CATEGORIES, versions.PRODUCTS)
+            else:
+                versions.bump(db, versions.CATEGORIES)
             messages.success(request, 'Category updated successfully.')
             return redirect('category_list')
     else:
@@ -435,6 +616,9 @@ def category_delete(request, pk):
                 }
             }
         )
+        summary.category_saved(db, {**category, 'active': False})
+        lookups.invalidate_categories()
+        versions.bump(db, versions.CATEGORIES)
         messages.success(request, 'Category deleted successfully.')
         return redirect('category_list')
 
@@ -485,9 +669,10 @@ def supplier_create(request):
         form = SupplierForm(request.POST)
         if form.is_valid():
             supplier_data = form.cleaned_data
-            supplier_data['id'] = str(uuid.uuid4())
+            supplier_data['id'] = repository.new_id()
             supplier_data['active'] = True
             supplier_data['created_at'] = timezone.now()
+            supplier_data.update(supplier_search_fields(supplier_data))
 
             # Check for existing supplier
             existing = db.inventory_supplier.find_one({
@@ -499,9 +684,16 @@ def supplier_create(request):
                 messages.error(
                     request, 'Supplier with this name already exists.')
             else:
-                db.inventory_supplier.insert_one(supplier_data)
-                messages.success(request, 'Supplier created successfully.')
-                return redirect('supplier_list')
+                try:
+                    db.inventory_supplier.insert_one(supplier_data)
+                except DuplicateKeyError as exc:
+                    _duplicate(form, exc, 'supplier')
+                else:
+                    summary.supplier_created(db, supplier_data)
+                    lookups.invalidate_suppliers()
+                    versions.bump(db, versions.SUPPLIERS)
+                    messages.success(request, 'Supplier created successfully.')
+                    return redirect('supplier_list')
     else:
         form = SupplierForm()
 
@@ -522,6 +714,7 @@ def supplier_update(request, pk):
         if form.is_valid():
             update_data = form.cleaned_data
             update_data['updated_at'] = timezone.now()
+            update_data.update(supplier_search_fields(update_data))
 
             # Check for name uniqueness if name is being changed
             if update_data['name'] != supplier['name']:
@@ -542,6 +735,11 @@ def supplier_update(request, pk):
                 {'id': pk},
                 {'$set': update_data}
             )
+            lookups.invalidate_suppliers()
+            if repository.rename_references(db, 'supplier', pk, update_data['name']):
+                versions.bump(db, versions.SUPPLIERS, versions.PRODUCTS)
+            else:
+                versions.bump(db, versions.SUPPLIERS)
             messages.success(request, 'Supplier updated successfully.')
             return redirect('supplier_list')
     else:
@@ -553,51 +751,6 @@ def supplier_update(request, pk):
     })
 
 
-@login_required
-def supplier_detail(request, pk):
-    pipeline = [
-        {'$match': {'id': pk, 'active': True}},
-        {
-            '$lookup': {
-                'from': 'inventory_product',
-                'localField': 'id',
-                'foreignField': 'supplier_id',
-                'as': 'products'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'inventory_stocktransaction',
-                'localField': 'products.id',
-                'foreignField': 'product_id',
-                'as': 'transactions'
-            }
-        }
-    ]
-
-    supplier_data = list(db.inventory_supplier.aggregate(pipeline))
-    if not supplier_data:
-        raise Http404("Supplier not found")
-
-    supplier = supplier_data[0]
-
-    # Get recent transactions
-    recent_transactions = list(db.inventory_stocktransaction.find({
-        'product_id': {'$in': [p['id'] for p in supplier['products']]}
-    }).sort('transaction_date', -1).limit(5))
-
-    context = {
-        'supplier': supplier,
-        'products': supplier.get('products', []),
-        'recent_transactions': recent_transactions,
-        'total_products': len(supplier.get('products', [])),
-        'total_value': sum(float(p.get('price', 0)) * p.get('stock_quantity', 0)
-                           for p in supplier.get('products', []))
-    }
-
-    return render(request, 'inventory/supplier_detail.html', context)
-
-
 @login_required
 def supplier_delete(request, pk):
     supplier = db.inventory_supplier.find_one({'id': pk, 'active': True})
@@ -626,6 +779,9 @@ def supplier_delete(request, pk):
                 }
             }
         )
+        summary.supplier_deleted(db, supplier)
+        lookups.invalidate_suppliers()
+        versions.bump(db, versions.SUPPLIERS)
         messages.success(request, 'Supplier deleted successfully.')
         return redirect('supplier_list')
 
@@ -638,136 +794,133 @@ def supplier_delete(request, pk):
     })
 
 
-@login_required
-def stock_report(request):
-    # Get all active products with their categories and suppliers
-    pipeline = [
-        {'$match': {'active': True}},
-        {
-            '$lookup': {
-                'from': 'inventory_category',
-                'localField': 'category_id',
-                'foreignField': 'id',
-                'as': 'category'
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'inventory_supplier',
-                'localField': 'supplier_id',
-                'foreignField': 'id',
-                'as': 'supplier'
-            }
-        },
-        {'$unwind': {'path': '$category', 'preserveNullAndEmptyArrays': True}},
-        {'$unwind': {'path': '$supplier', 'preserveNullAndEmptyArrays': True}}
-    ]
+REPORT_LOW_STOCK_QUERY = {'active': True, 'is_low_stock': True}
+REPORT_LOW_STOCK_SORT = [('stock_deficit', DESCENDING), ('id', ASCENDING)]
+TOP_SELLING_FIELDS = {'_id': 0, 'id': 1, 'name': 1, 'category': 1, 'stock_quantity': 1}
 
-    products = list(db.inventory_product.aggregate(pipeline))
 
-    # Calculate total value
-    total_value = sum(
-        float(p['price']) * p['stock_quantity']
-        for p in products
-    )
-
-    # Get low stock items
-    low_stock = [p for p in products if p['stock_quantity']
-                 <= p['reorder_level']]
-
-    # Get top selling products (last 30 days)
-    thirty_days_ago = timezone.now() - timedelta(days=30)
-    top_selling_pipeline = [
-        {
-            '$match': {
-                'transaction_type': 'OUT',
-                'transaction_date': {'$gte': thirty_days_ago}
-            }
-        },
-        {
-            '$group': {
-                '_id': '$product_id',
-                'total_quantity': {'$sum': '$quantity'}
-            }
-        },
-        {'$sort': {'total_quantity': -1}},
-        {'$limit': 5},
-        {
-            '$lookup': {
-                'from': 'inventory_product',
-                'localField': '_id',
-                'foreignField': 'id',
-                'as': 'product'
-            }
-        },
-        {'$unwind': '$product'}
-    ]
-
-    top_selling = list(
-        db.inventory_stocktransaction.aggregate(top_selling_pipeline))
-
-    context = {
+def _stock_report_context(products, low_stock, top_selling, top_products, window_label):
+    top_products = {p['id']: p for p in top_products}
+    top_selling = [dict(row, product=top_products[row['_id']])
+                   for row in top_selling if row['_id'] in top_products]
+    return {
         'products': products,
-        'total_value': total_value,
+        'total_value': sum(float(p['price']) * p['stock_quantity'] for p in products),
         'low_stock': low_stock,
         'low_stock_count': len(low_stock),
         'top_selling': top_selling,
+        'report_windows': REPORT_WINDOWS,
+        'window_label': window_label,
         'total_products': len(products)
     }
 
+
+def _report_window(request):
+    # ?days=7|30|90, or ?start=YYYY-MM-DD&end=YYYY-MM-DD (end inclusive)
+    start, end = request.GET.get('start'), request.GET.get('end')
+    if start:
+        try:
+            since = timezone.make_aware(datetime.strptime(start, '%Y-%m-%d'), dt_timezone.utc)
+            until = (timezone.make_aware(datetime.strptime(end, '%Y-%m-%d'), dt_timezone.utc)
+                     + timedelta(days=1) if end else timezone.now())
+        except ValueError:
+            return None
+        if until <= since:
+            return None
+        return since, until, f'{since:%Y-%m-%d} to {(until - timedelta(days=1)):%Y-%m-%d}'
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        return None
+    if days not in REPORT_WINDOWS:
+        return None
+    return timezone.now() - timedelta(days=days), None, f'Last {days} Days'
+
+
+@login_required
+@versioned_page(versions.PRODUCTS, versions.CATEGORIES, versions.SUPPLIERS,
+                versions.ROLLUPS, period=3600)
+def stock_report(request):
+    # ?export=csv|ndjson|xlsx streams the full inventory instead of rendering
+    export = request.GET.get('export')
+    if export:
+        if export not in exports.FORMATS:
+            return HttpResponseBadRequest('Unknown export format')
+        return exports.export_stock_report(db, export)
+
+    # Window for the top sellers
+    window = _report_window(request)
+    if window is None:
+        return HttpResponseBadRequest('Invalid report window')
+    since, until, window_label = window
+
+    # Get all active products
+    products = list(db.inventory_product.find({'active': True}))
+
+    # Get low stock items from the partial low-stock index, most severe first
+    low_stock = list(db.inventory_product.find(REPORT_LOW_STOCK_QUERY).sort(
+        REPORT_LOW_STOCK_SORT))
+
+    # Resolve categories and suppliers for both lists, one query each
+    repository.attach(db, products + low_stock, 'category_id', 'supplier_id',
+                      projection=REFERENCE_FIELDS)
+
+    # Top selling products over the window, from the rollups
+    top_selling = rollups.top_products(db, since, until, 'OUT', limit=5)
+    top_products = list(db.inventory_product.find(
+        {'id': {'$in': [row['_id'] for row in top_selling]}}, TOP_SELLING_FIELDS))
+
+    context = _stock_report_context(products, low_stock, top_selling, top_products,
+                                    window_label)
     return render(request, 'inventory/stock_report.html', context)
 
 
 @login_required
+@versioned_page(versions.SUPPLIERS, versions.PRODUCTS)
 def supplier_list(request):
     query = {'active': True}
-
-    # Handle search
     search_query = request.GET.get('search')
+
+    # Search results are ranked by relevance and come as a single page;
+    # otherwise get one page of suppliers, ordered by name
     if search_query:
-        query['$or'] = [
-            {'name': {'$regex': search_query, '$options': 'i'}},
-            {'contact_person': {'$regex': search_query, '$options': 'i'}},
-            {'email': {'$regex': search_query, '$options': 'i'}}
-        ]
-
-    # Get all suppliers
-    suppliers = list(db.inventory_supplier.find(query))
-
-    # Ensure each supplier has an ID
-    for supplier in suppliers:
-        if '_id' in supplier and not supplier.get('id'):
-            supplier['id'] = str(supplier['_id'])
-
-    # Get product counts
-    for supplier in suppliers:
-        supplier['product_count'] = db.inventory_product.count_documents({
-            'supplier_id': supplier['id'],
-            'active': True
+        page = Page(search_suppliers(db, search_query, query, limit=page_size_from(request),
+                                     projection=SUPPLIER_LIST_FIELDS), None)
+    else:
+        try:
+            page = keyset_page(
+                db.inventory_supplier, query,
+                sort=[('name', ASCENDING), ('_id', ASCENDING)],
+                page_size=page_size_from(request),
+                cursor=request.GET.get('cursor'),
+                projection=SUPPLIER_LIST_FIELDS,
+            )
+        except InvalidCursor:
+            return HttpResponseBadRequest('Invalid cursor')
+    suppliers = page.items
+
+    # Get product counts in one grouped query
+    attach_product_counts(db, suppliers, 'supplier_id')
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'results': [jsonable(s) for s in suppliers],
+            'next_cursor': page.next_cursor,
         })
 
-    return render(request, 'inventory/supplier_list.html', {'suppliers': suppliers})
+    return render(request, 'inventory/supplier_list.html', {
+        'suppliers': suppliers,
+        'next_cursor': page.next_cursor,
+        'next_url': next_page_url(request, page.next_cursor),
+    })
 
 
 @login_required
 def supplier_detail(request, pk):
-    # First try to find by id field
-    supplier = db.inventory_supplier.find_one({'id': pk, 'active': True})
-
-    if not supplier:
-        # Try to find by _id if not found by id
-        supplier = db.inventory_supplier.find_one({'_id': pk, 'active': True})
-
+    supplier = repository.get(db, 'supplier', pk)
     if not supplier:
         raise Http404("Supplier not found")
 
-    if '_id' in supplier and not supplier.get('id'):
-        supplier['id'] = str(supplier['_id'])
-        db.inventory_supplier.update_one(
-            {'_id': supplier['_id']},
-            {'$set': {'id': str(supplier['_id'])}}
-        )
-
     # Get related products
     products = list(db.inventory_product.find({
         'supplier_id': supplier['id'],
@@ -785,44 +938,23 @@ def supplier_detail(request, pk):
 
 
 @login_required
+@versioned_page(versions.CATEGORIES, versions.PRODUCTS)
 def category_list(request):
     # Get all categories
     categories = list(db.inventory_category.find({'active': True}))
 
-    # Ensure each category has an ID
-    for category in categories:
-        if '_id' in category and not category.get('id'):
-            category['id'] = str(category['_id'])
-
-    # Get product counts for each category
-    for category in categories:
-        category['product_count'] = db.inventory_product.count_documents({
-            'category_id': category['id'],
-            'active': True
-        })
+    # Get product counts in one grouped query
+    attach_product_counts(db, categories, 'category_id')
 
     return render(request, 'inventory/category_list.html', {'categories': categories})
 
 
 @login_required
 def category_detail(request, pk):
-    # First try to find by id field
-    category = db.inventory_category.find_one({'id': pk, 'active': True})
-
-    if not category:
-        # Try to find by _id if not found by id
-        category = db.inventory_category.find_one({'_id': pk, 'active': True})
-
+    category = repository.get(db, 'category', pk)
     if not category:
         raise Http404("Category not found")
 
-    if '_id' in category and not category.get('id'):
-        category['id'] = str(category['_id'])
-        db.inventory_category.update_one(
-            {'_id': category['_id']},
-            {'$set': {'id': str(category['_id'])}}
-        )
-
     # Get related products
     products = list(db.inventory_product.find({
         'category_id': category['id'],
@@ -837,3 +969,12 @@ def category_detail(request, pk):
 
     return render(request, 'inventory/category_detail.html', context)
 
+
+@staff_member_required
+def mongo_pool_stats(request):
+    return JsonResponse(pool_stats())
+
+
+@staff_member_required
+def lookup_cache_stats(request):
+    return JsonResponse(lookups.cache.stats())
@@ -56,6 +56,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'inventory.profiling.QueryProfilerMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -95,9 +96,27 @@ DATABASES = {
         'HOST': 'localhost',
         'PORT': 27017,
         'DISABLE_SERVER_SIDE_CURSORS': True,
+        # Passed to MongoClient by djongo and by inventory.mongo. Each
+        # worker process gets its own pool of up to maxPoolSize sockets.
+        'CLIENT': {
+            'host': os.environ.get('MONGO_HOST', 'localhost'),
+            'port': int(os.environ.get('MONGO_PORT', 27017)),
+            'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 50)),
+            'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+            'maxIdleTimeMS': int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 300000)),
+            'waitQueueTimeoutMS': int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+            'connectTimeoutMS': int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+            'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+            'socketTimeoutMS': int(os.environ.get('MONGO_SOCKET_TIMEOUT_MS', 30000)),
+        },
     }
 }
 
+# Change streams (inventory/events.py) need a replica set, e.g. a single
+# local node started with --replSet rs0.
+if os.environ.get('MONGO_REPLICA_SET'):
+    DATABASES['default']['CLIENT']['replicaSet'] = os.environ['MONGO_REPLICA_SET']
+
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
 
@@ -153,3 +172,121 @@ CRISPY_TEMPLATE_PACK = "bootstrap5"
 LOGIN_REDIRECT_URL = 'dashboard'  # Changed from 'home' to 'dashboard'
 LOGOUT_REDIRECT_URL = 'dashboard'  # Changed from 'home' to 'dashboard'
 LOGIN_URL = 'login'
+
+# Record stock movements in multi-document transactions when the server
+# is a replica set or mongos; otherwise the per-product outbox is used.
+INVENTORY_USE_TRANSACTIONS = True
+
+# Keyset pagination for product, supplier and transaction lists
+INVENTORY_PAGE_SIZE = 50
+INVENTORY_MAX_PAGE_SIZE = 200
+
+# Category/supplier lookup cache: an in-process LRU per worker, optionally
+# backed by a shared Django cache alias (e.g. 'default') across workers.
+INVENTORY_CACHE = {
+    'LOCAL_MAXSIZE': 256,
+    'LOCAL_TTL': int(os.environ.get('INVENTORY_CACHE_LOCAL_TTL', 30)),
+    'SHARED_ALIAS': os.environ.get('INVENTORY_CACHE_SHARED_ALIAS') or None,
+    'SHARED_TTL': 300,
+}
+
+# Hourly stock movement rollups are kept this long; daily ones are kept.
+INVENTORY_ROLLUP_HOUR_RETENTION_DAYS = 14
+
+# Demand forecasting defaults for forecast_reorder_levels (see forecasting.py)
+INVENTORY_FORECAST = {
+    'HISTORY_DAYS': 365,
+    'WINDOW': 28,
+    'ALPHA': 0.3,
+    'METHOD': 'smoothing',
+    'LEAD_TIME_DAYS': 7,
+    'SERVICE_LEVEL': 0.95,
+}
+
+# Route dashboard, product_list, stock_report and supplier_detail to the
+# Motor-based async views (inventory/async_views.py). Enable for ASGI.
+INVENTORY_ASYNC_VIEWS = os.environ.get('INVENTORY_ASYNC_VIEWS', '').lower() in ('1', 'true', 'yes')
+
+# Rendered list/report pages, keyed by collection version counters (see
+# inventory/responsecache.py). ALIAS is a Django cache alias.
+INVENTORY_RESPONSE_CACHE = {
+    'ENABLED': True,
+    'ALIAS': os.environ.get('INVENTORY_RESPONSE_CACHE_ALIAS', 'default'),
+    'TIMEOUT': 300,
+}
+
+# Per-request Mongo profiling (see inventory/profiling.py): Server-Timing
+# header, one JSON log line per request, slow-command log and sampled
+# explain of query shapes to catch collection scans.
+INVENTORY_PROFILER = {
+    'ENABLED': os.environ.get('INVENTORY_PROFILER', '1').lower() not in ('0', 'false', 'no'),
+    'SLOW_MS': int(os.environ.get('INVENTORY_SLOW_QUERY_MS', 100)),
+    'SAMPLE_RATE': float(os.environ.get('INVENTORY_PROFILER_SAMPLE_RATE', 0.01)),
+    'EXPLAIN_TTL': 3600,
+    'SERVER_TIMING': True,
+    'LOG_REQUESTS': True,
+}
+
+# Product images (see inventory/images.py): variant sizes, background
+# resize workers per process and how bodies are sent. Set SENDFILE to
+# 'x-accel-redirect' behind nginx (with an internal location at
+# SENDFILE_PREFIX aliased to MEDIA_ROOT) or 'x-sendfile' behind Apache.
+INVENTORY_IMAGES = {
+    'SIZES': {'thumb': 128, 'large': 800},
+    'WORKERS': int(os.environ.get('INVENTORY_IMAGE_WORKERS', 2)),
+    'SENDFILE': os.environ.get('INVENTORY_IMAGE_SENDFILE') or None,
+    'SENDFILE_PREFIX': '/protected-media/',
+}
+
+# Stock ledger snapshots and verification (see inventory/ledger.py); take
+# snapshots periodically with "manage.py snapshot_stock".
+INVENTORY_LEDGER = {
+    'BATCH_SIZE': 500,
+    'WORKERS': int(os.environ.get('INVENTORY_LEDGER_WORKERS', 4)),
+}
+
+# Transaction history tiering (see inventory/archive.py), run with
+# "manage.py archive_transactions". TIER 'file' writes zstd NDJSON to ROOT.
+INVENTORY_ARCHIVE = {
+    'HORIZON_DAYS': int(os.environ.get('INVENTORY_ARCHIVE_HORIZON_DAYS', 365)),
+    'TIER': os.environ.get('INVENTORY_ARCHIVE_TIER', 'collection'),
+    'ROOT': BASE_DIR / 'archive',
+}
+
+# Stock transactions as a MongoDB time-series collection (see
+# inventory/timeseries.py). Migration 0006 converts when ENABLED; switch
+# later with "manage.py convert_transactions --to timeseries|regular".
+INVENTORY_TIMESERIES = {
+    'ENABLED': os.environ.get('INVENTORY_TIMESERIES', '').lower() in ('1', 'true', 'yes'),
+    'GRANULARITY': os.environ.get('INVENTORY_TIMESERIES_GRANULARITY', 'hours'),
+}
+
+# Change-stream event bus (see inventory/events.py), run with
+# "manage.py run_event_bus". SUBSCRIBERS None runs every subscriber.
+INVENTORY_EVENTS = {
+    'SUBSCRIBERS': None,
+    'BATCH_SIZE': 500,
+    'MAX_WAIT': 0.5,
+    'QUEUE_SIZE': 5000,
+    'RETRIES': 5,
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'inventory.profiling': {
+            'handlers': ['console'],
+            'level': os.environ.get('INVENTORY_PROFILER_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+        'inventory.events': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -117,4 +117,38 @@ document.addEventListener('DOMContentLoaded', function () {
         table.parentNode.insertBefore(wrapper, table);
         wrapper.appendChild(table);
     });
-});
\ No newline at end of file
+
+    // Remote autocomplete: inputs rendered by AutocompleteInput fetch their
+    // options as the user types instead of shipping them with the page.
+    document.querySelectorAll('[data-autocomplete-url]').forEach(input => {
+        const list = document.createElement('datalist');
+        list.id = input.id + '-options';
+        input.setAttribute('list', list.id);
+        input.after(list);
+
+        let timer = null;
+        let controller = null;
+        input.addEventListener('input', function () {
+            clearTimeout(timer);
+            const query = input.value.trim();
+            if (!query) return;
+            timer = setTimeout(() => {
+                if (controller) controller.abort();
+                controller = new AbortController();
+                const url = input.dataset.autocompleteUrl + '?q=' + encodeURIComponent(query);
+                fetch(url, { signal: controller.signal, credentials: 'same-origin' })
+                    .then(response => response.json())
+                    .then(data => {
+                        list.innerHTML = '';
+                        data.results.forEach(item => {
+                            const option = document.createElement('option');
+                            option.value = item.sku || item.name;
+                            option.label = item.sku ? item.sku + ' - ' + item.name : item.name;
+                            list.appendChild(option);
+                        });
+                    })
+                    .catch(() => {});
+            }, 150);
+        });
+    });
+});